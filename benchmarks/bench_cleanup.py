@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, obsolete key file cleanup benchmark
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Times finding the obsolete key files for increasing numbers of key files. Each key name
+# has one domain and files for three selectors, two of which are still referred to by the
+# update data. The time per file should stay about the same as the number of files grows.
+#
+# With --legacy the glob/list-based cleanup genkeys.py used to do is timed as well, for
+# sizes up to --legacy-max files since it's quadratic.
+
+import argparse
+import datetime
+import fnmatch
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'src' ) )
+
+import keyfiles
+import updatedata
+
+selectors = ['202601', '202602', '202603']
+
+
+# Creates the key files, returns the domain data and update data records
+def make_fleet( directory, file_count ):
+    key_count = max( 1, file_count // (2 * len( selectors )) )
+    domain_data = []
+    records = updatedata.UpdateData()
+    created = datetime.datetime( 2026, 3, 1 )
+    for i in range( key_count ):
+        key_name = "key%06d" % i
+        domain = "domain%06d.example" % i
+        domain_data.append( [domain, key_name, 'null'] )
+        for selector in selectors:
+            for suffix in keyfiles.key_file_suffixes:
+                open( os.path.join( directory, key_name + '.' + selector + suffix ), 'w' ).close()
+        for selector in selectors[1:]:
+            records.add( updatedata.UpdateRecord( domain, selector, created, ['-'] ) )
+    return domain_data, records
+
+
+def new_cleanup( directory, domain_data, records ):
+    key_names = [item[1] for item in domain_data]
+    domain_keys = { }
+    for item in domain_data:
+        domain_keys.setdefault( item[0], item[1] )
+    return keyfiles.obsolete_key_files( directory, key_names, records, domain_keys )
+
+
+# The cleanup genkeys.py did before keyfiles.py, with no failed domains
+def legacy_cleanup( directory, domain_data, records ):
+    def find_key_for_domain( domain ):
+        for domain_entry in domain_data:
+            if domain_entry[0] == domain:
+                return domain_entry[1]
+        return None
+
+    target_list = []
+    for item in domain_data:
+        target = os.path.join( directory, item[1] )
+        target_list += glob.glob( target + '.*.key' ) + glob.glob( target + '.*.txt' )
+    target_list = [os.path.basename( x ) for x in target_list]
+    for item in records:
+        domain_key = find_key_for_domain( item[0] )
+        if domain_key is not None:
+            for suffix in ['.key', '.txt']:
+                item_str = domain_key + '.' + item[1] + suffix
+                try:
+                    i = target_list.index( item_str )
+                except ValueError:
+                    i = -1
+                if i >= 0:
+                    del target_list[i]
+    return sorted( target_list )
+
+
+def time_cleanup( cleanup, directory, domain_data, records, repeat ):
+    best = None
+    result = None
+    for i in range( repeat ):
+        start = time.perf_counter()
+        result = cleanup( directory, domain_data, records )
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+parser = argparse.ArgumentParser( description = "Benchmark obsolete key file cleanup" )
+parser.add_argument( "--sizes", dest = 'sizes', action = 'store', default = '5000,10000,25000,50000',
+                     help = "Comma-separated numbers of key files to test with" )
+parser.add_argument( "--repeat", dest = 'repeat', action = 'store', type = int, default = 3,
+                     help = "Runs per size, the best time is reported" )
+parser.add_argument( "--legacy", dest = 'legacy', action = 'store_true',
+                     help = "Also time the old glob-based cleanup" )
+parser.add_argument( "--legacy-max", dest = 'legacy_max', action = 'store', type = int, default = 10000,
+                     help = "Largest number of files to time the old cleanup with" )
+args = parser.parse_args()
+
+print( "%10s %12s %14s %12s %14s" % ('files', 'scan (s)', 'us per file', 'legacy (s)', 'us per file') )
+for size in [int( x ) for x in args.sizes.split( ',' )]:
+    directory = tempfile.mkdtemp( prefix = 'genkeys-bench-' )
+    try:
+        domain_data, records = make_fleet( directory, size )
+        file_count = len( os.listdir( directory ) )
+        elapsed, obsolete = time_cleanup( new_cleanup, directory, domain_data, records, args.repeat )
+        expected = len( fnmatch.filter( os.listdir( directory ), '*.' + selectors[0] + '.*' ) )
+        if len( obsolete ) != expected:
+            print( "Cleanup found %d obsolete files, expected %d" % (len( obsolete ), expected) )
+            sys.exit( 1 )
+        line = "%10d %12.4f %14.2f" % (file_count, elapsed, elapsed * 1e6 / file_count)
+        if args.legacy and file_count <= args.legacy_max:
+            legacy_elapsed, legacy_obsolete = time_cleanup( legacy_cleanup, directory, domain_data, records, 1 )
+            if legacy_obsolete != obsolete:
+                print( "Old and new cleanup found different files" )
+                sys.exit( 1 )
+            line += " %12.4f %14.2f" % (legacy_elapsed, legacy_elapsed * 1e6 / file_count)
+        print( line )
+    finally:
+        shutil.rmtree( directory )
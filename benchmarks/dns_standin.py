@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, stand-in DNS server for propagation checks
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A tiny authoritative DNS server that answers TXT queries for DKIM records,
+# to run genkeys.py --check-propagation against without real nameservers:
+#
+#   dns_standin.py --port 5353 --sim-store sim.json --delay 10 &
+#   genkeys.py --check-propagation 60 --propagation-ns 127.0.0.1:5353 ...
+#
+# With --sim-store it serves the records the sim DNS API module has added (the store=
+# file from the sim entry in dnsapi.ini), re-reading the file and its log of changes
+# whenever they change, and --delay holds each record back until that many seconds after
+# it was added, the way a real provider takes a while to push records out to its
+# nameservers. --records serves the records in a file of "<name> <value>" lines instead.
+# --drop ignores that fraction of queries, to exercise the checker's retries.
+# --max-udp-size truncates UDP responses larger than that, and the same answers are
+# served over TCP on the same port, to exercise the checker's TCP fallback.
+#
+# With --bench N it serves N made-up records itself and times a propagation check of all
+# of them, optionally with --delay and --drop.
+
+import argparse
+import datetime
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'src' ) )
+
+import dnsapi_sim
+import propagation
+
+flag_response = 0x8000
+flag_authoritative = 0x0400
+flag_truncated = 0x0200
+rcode_refused = 5
+
+
+class StandIn( object ):
+    def __init__( self, delay = 0.0, drop = 0.0, sim_store = None, max_udp_size = None ):
+        self.delay = delay
+        self.drop = drop
+        self.max_udp_size = max_udp_size
+        self.sim_store = sim_store
+        self.sim_store_mtime = None
+        self.records = { }  # Key = record name, Value = list of (visible from, value)
+        self.random = random.Random()
+        self.queries = 0
+        self.answered = 0
+
+    def add( self, name, value, created = None ):
+        visible = (created if created is not None else time.time()) + self.delay
+        self.records.setdefault( propagation.normalize_name( name ), [] ).append( (visible, value) )
+
+    def load_records( self, filename ):
+        with open( filename, 'r' ) as records_file:
+            for line in records_file:
+                fields = line.split( None, 1 )
+                if len( fields ) == 2:
+                    self.add( fields[0], fields[1].strip() )
+
+    # Picks up the sim module's records whenever its store file changes
+    # Reloads the sim module's store when it or its log of changes has changed
+    def refresh_sim_store( self ):
+        mtime = []
+        for filename in [self.sim_store, self.sim_store + '.log']:
+            try:
+                stat = os.stat( filename )
+                mtime.append( (stat.st_mtime, stat.st_size) )
+            except OSError:
+                mtime.append( None )
+        if mtime == [None, None] or mtime == self.sim_store_mtime:
+            return
+        self.sim_store_mtime = mtime
+        next_id, records = dnsapi_sim.read_store( self.sim_store )
+        previous = self.records
+        self.records = { }
+        for record in records.values():
+            name = propagation.normalize_name( record[1] + '._domainkey.' + record[0] )
+            created = None
+            if len( record ) > 3:
+                created = datetime.datetime.strptime( record[3], '%Y-%m-%dT%H:%M:%S' ).replace(
+                    tzinfo = datetime.timezone.utc ).timestamp()
+            else:
+                # Records from before the sim module kept creation times keep the time
+                # they were first seen
+                for visible, value in previous.get( name, [] ):
+                    if value == record[2]:
+                        created = visible - self.delay
+            self.add( name, record[2], created )
+
+    # Returns the response to a query, or None to ignore it
+    def answer( self, data ):
+        self.queries += 1
+        if self.drop > 0 and self.random.random() < self.drop:
+            return None
+        try:
+            query_id, flags, qdcount = struct.unpack( '>HHH', data[:6] )
+            name, offset = propagation.read_name( data, 12 )
+            qtype, qclass = struct.unpack( '>HH', data[offset:offset + 4] )
+        except (ValueError, struct.error):
+            return None
+        question = data[12:offset + 4]
+        if self.sim_store:
+            self.refresh_sim_store()
+        now = time.time()
+        answers = []
+        if qtype == propagation.type_txt:
+            answers = [value for visible, value in self.records.get( name, [] ) if visible <= now]
+        if name in self.records:
+            rcode = 0
+        elif '_domainkey' in name:
+            rcode = propagation.rcode_nxdomain
+        else:
+            rcode = rcode_refused
+        response = struct.pack( '>HHHHHH', query_id, flag_response | flag_authoritative | rcode, 1, len( answers ),
+                                0, 0 ) + question
+        for value in answers:
+            value = value.encode( 'utf-8' )
+            rdata = b''.join( [struct.pack( 'B', len( value[i:i + 255] ) ) + value[i:i + 255] for i in
+                               range( 0, len( value ), 255 )] )
+            response += struct.pack( '>HHHIH', 0xC00C, propagation.type_txt, propagation.class_in, 300,
+                                     len( rdata ) ) + rdata
+        if answers:
+            self.answered += 1
+        return response
+
+    # Serves UDP queries until the socket is shut down or closed
+    def serve( self, sock ):
+        while True:
+            try:
+                data, address = sock.recvfrom( 65535 )
+            except OSError:
+                return
+            if address is None:
+                return
+            response = self.answer( data )
+            if response is None:
+                continue
+            if self.max_udp_size is not None and len( response ) > self.max_udp_size:
+                # Just the header and question, flagged as truncated
+                question_end = propagation.read_name( response, 12 )[1] + 4
+                flags = struct.unpack( '>H', response[2:4] )[0] | flag_truncated
+                response = response[:2] + struct.pack( '>HHHHH', flags, 1, 0, 0, 0 ) + response[12:question_end]
+            sock.sendto( response, address )
+
+    # Serves TCP queries, one connection at a time, until the listening socket is closed
+    def serve_tcp( self, listener ):
+        while True:
+            try:
+                conn, address = listener.accept()
+            except OSError:
+                return
+            with conn:
+                try:
+                    data = b''
+                    while len( data ) < 2 or len( data ) < struct.unpack( '>H', data[:2] )[0] + 2:
+                        chunk = conn.recv( 65535 )
+                        if not chunk:
+                            break
+                        data += chunk
+                    response = self.answer( data[2:] )
+                    if response is not None:
+                        conn.sendall( struct.pack( '>H', len( response ) ) + response )
+                except OSError:
+                    pass
+
+
+def bench( count, delay, drop, timeout ):
+    standin = StandIn( delay, drop )
+    checks = []
+    for i in range( count ):
+        domain = "domain%06d.example" % i
+        value = "v=DKIM1; k=rsa; p=MIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEA%06d" % i
+        standin.add( 'bench01._domainkey.' + domain, value )
+        checks.append( (domain, 'bench01._domainkey.' + domain, value) )
+    sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+    sock.bind( ('127.0.0.1', 0) )
+    thread = threading.Thread( target = standin.serve, args = (sock,) )
+    thread.daemon = True
+    thread.start()
+    # Make the checker poll often enough for short delays to show up
+    propagation.poll_interval = min( propagation.poll_interval, max( 0.5, delay / 2 ) )
+    start = time.perf_counter()
+    propagated = propagation.check_records( checks, timeout, [sock.getsockname()] )
+    seconds = time.perf_counter() - start
+    print( "%8d records  %6d propagated  %8.3f s  %8d queries" % (count, len( propagated ), seconds,
+                                                                     standin.queries) )
+
+
+def main():
+    parser = argparse.ArgumentParser( description = "Stand-in DNS server for DKIM propagation checks" )
+    parser.add_argument( "--address", default = '127.0.0.1', help = "Address to listen on" )
+    parser.add_argument( "--port", type = int, default = 5353, help = "UDP port to listen on" )
+    parser.add_argument( "--sim-store", help = "Serve the records in this sim DNS API module store file" )
+    parser.add_argument( "--records", help = "Serve the records in this file of <name> <value> lines" )
+    parser.add_argument( "--delay", type = float, default = 0.0,
+                         help = "Seconds before a record added is served" )
+    parser.add_argument( "--drop", type = float, default = 0.0, help = "Fraction of queries to ignore" )
+    parser.add_argument( "--max-udp-size", type = int,
+                         help = "Truncate larger UDP responses, the full answers are served over TCP" )
+    parser.add_argument( "--bench", type = int, metavar = 'N',
+                         help = "Time a propagation check of N records against a stand-in server and exit" )
+    parser.add_argument( "--timeout", type = float, default = 60.0,
+                         help = "Deadline for the --bench propagation check, in seconds" )
+    args = parser.parse_args()
+
+    if args.bench:
+        bench( args.bench, args.delay, args.drop, args.timeout )
+        return 0
+
+    standin = StandIn( args.delay, args.drop, args.sim_store, args.max_udp_size )
+    if args.records:
+        standin.load_records( args.records )
+    family = socket.AF_INET6 if ':' in args.address else socket.AF_INET
+    sock = socket.socket( family, socket.SOCK_DGRAM )
+    sock.bind( (args.address, args.port) )
+    if args.max_udp_size is not None:
+        listener = socket.socket( family, socket.SOCK_STREAM )
+        listener.bind( (args.address, args.port) )
+        listener.listen( 16 )
+        thread = threading.Thread( target = standin.serve_tcp, args = (listener,) )
+        thread.daemon = True
+        thread.start()
+    try:
+        standin.serve( sock )
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit( main() )
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, end-to-end scaling benchmarks
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Runs a full rotation with genkeys.py for synthetic fleets of increasing size (see
+# fleet.py) and reports the wall time, peak RSS and the time spent in each phase of the
+# run. Keys come from fake-opendkim-genkey and DNS updates go to the null and fail API
+# modules, so nothing needs network access. Results can be saved as JSON with --output
+# and a later run compared against them with --compare.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+benchmarks_dir = os.path.dirname( os.path.abspath( __file__ ) )
+src_dir = os.path.join( benchmarks_dir, '..', 'src' )
+genkeys_script = os.path.join( src_dir, 'genkeys.py' )
+
+sys.path.insert( 0, src_dir )
+
+import fleet
+import metrics
+
+
+# Runs genkeys.py in data_dir, returns a dict with the wall time, peak RSS in KiB, the
+# exit status and the phase report, or None if it couldn't be run.
+def run_genkeys( data_dir, bin_dir, genkeys_args ):
+    report_filename = os.path.join( data_dir, 'report.json' )
+    command = [sys.executable, genkeys_script, '--working-dir', data_dir, '--report-json', report_filename]
+    command += genkeys_args + [fleet.new_selector]
+    env = dict( os.environ )
+    env['PATH'] = bin_dir + os.pathsep + env.get( 'PATH', '' )
+    with open( os.path.join( data_dir, 'genkeys.log' ), 'w' ) as log_file:
+        start = time.perf_counter()
+        process = subprocess.Popen( command, env = env, stdout = log_file, stderr = subprocess.STDOUT )
+        pid, wait_status, rusage = os.wait4( process.pid, 0 )
+        wall_time = time.perf_counter() - start
+    # Let the Popen object know the process is gone
+    process.returncode = os.waitstatus_to_exitcode( wait_status ) if hasattr( os, 'waitstatus_to_exitcode' ) \
+        else wait_status >> 8
+    result = {
+        'wall_time': wall_time,
+        'user_time': rusage.ru_utime,
+        'system_time': rusage.ru_stime,
+        'peak_rss_kib': rusage.ru_maxrss,
+        'exit_status': process.returncode,
+        'phases': None,
+        'counts': None,
+    }
+    try:
+        with open( report_filename, 'r' ) as report_file:
+            report = json.load( report_file )
+        result['phases'] = report['phases']
+        result['counts'] = report['counts']
+    except (IOError, ValueError, KeyError):
+        pass
+    return result
+
+
+def git_commit():
+    try:
+        output = subprocess.check_output( ['git', 'rev-parse', '--short', 'HEAD'], cwd = benchmarks_dir,
+                                          stderr = subprocess.DEVNULL )
+        return output.decode( 'utf-8' ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results( results ):
+    columns = ['wall_time', 'peak_rss_kib'] + metrics.phase_names
+    print( "%8s " % 'domains' + ' '.join( ["%14s" % name for name in columns] ) )
+    for result in results:
+        values = [result['wall_time'], result['peak_rss_kib']]
+        phases = result['phases'] or { }
+        values += [phases.get( name ) for name in metrics.phase_names]
+        line = "%8d " % result['domains']
+        for value in values:
+            if value is None:
+                line += "%15s" % '-'
+            elif isinstance( value, float ):
+                line += "%15.3f" % value
+            else:
+                line += "%15d" % value
+        print( line )
+
+
+# Prints the ratio of each result to the baseline result for the same fleet size
+def print_comparison( results, baseline ):
+    baseline_results = dict( [(result['domains'], result) for result in baseline['results']] )
+    print( "" )
+    print( "Compared with %s (ratio, lower is better):" % (baseline.get( 'commit' ) or 'baseline') )
+    columns = ['wall_time', 'peak_rss_kib'] + metrics.phase_names
+    print( "%8s " % 'domains' + ' '.join( ["%14s" % name for name in columns] ) )
+    for result in results:
+        old = baseline_results.get( result['domains'] )
+        if old is None:
+            continue
+        line = "%8d " % result['domains']
+        for name in columns:
+            if name in metrics.phase_names:
+                new_value = (result['phases'] or { }).get( name )
+                old_value = (old['phases'] or { }).get( name )
+            else:
+                new_value = result.get( name )
+                old_value = old.get( name )
+            if new_value is None or not old_value:
+                line += "%15s" % '-'
+            else:
+                line += "%15.2f" % (float( new_value ) / old_value)
+        print( line )
+
+
+parser = argparse.ArgumentParser( description = "Run genkeys.py against synthetic fleets of increasing size" )
+parser.add_argument( "--sizes", dest = 'sizes', action = 'store', default = '100,10000,100000',
+                     help = "Comma-separated fleet sizes in domains" )
+parser.add_argument( "--domains-per-key", dest = 'domains_per_key', action = 'store', type = int, default = 1,
+                     help = "Number of domains sharing each key name" )
+parser.add_argument( "--fail-every", dest = 'fail_every', action = 'store', type = int, default = 20,
+                     help = "Use the fail DNS API for every Nth domain, 0 for none" )
+parser.add_argument( "-j", "--jobs", dest = 'jobs', action = 'store', type = int, default = os.cpu_count() or 1,
+                     help = "Number of keys genkeys.py generates in parallel" )
+parser.add_argument( "--genkeys-args", dest = 'genkeys_args', action = 'store', default = '',
+                     help = "Additional arguments for genkeys.py, eg. '--dns-jobs 8 --state-db state.db'" )
+parser.add_argument( "--output", dest = 'output', action = 'store', help = "Save the results to this JSON file" )
+parser.add_argument( "--compare", dest = 'compare', action = 'store',
+                     help = "Compare the results with ones saved earlier with --output" )
+parser.add_argument( "--keep", dest = 'keep', action = 'store_true', help = "Keep the fleet data directories" )
+args = parser.parse_args()
+
+work_dir = tempfile.mkdtemp( prefix = 'genkeys-bench-' )
+bin_dir = os.path.join( work_dir, 'bin' )
+os.mkdir( bin_dir )
+fake_genkey = os.path.join( bin_dir, 'opendkim-genkey' )
+shutil.copy( os.path.join( benchmarks_dir, 'fake-opendkim-genkey' ), fake_genkey )
+os.chmod( fake_genkey, os.stat( fake_genkey ).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH )
+genkeys_args = ['-j', str( args.jobs )] + args.genkeys_args.split()
+
+results = []
+try:
+    for size in [int( x ) for x in args.sizes.split( ',' )]:
+        data_dir = os.path.join( work_dir, "fleet-%d" % size )
+        fleet.make_fleet( data_dir, size, args.domains_per_key, args.fail_every )
+        result = run_genkeys( data_dir, bin_dir, genkeys_args )
+        result['domains'] = size
+        results.append( result )
+        if result['exit_status'] != 0:
+            print( "genkeys.py exited with status %d for %d domains, see %s" %
+                   (result['exit_status'], size, os.path.join( data_dir, 'genkeys.log' )) )
+            args.keep = True
+        elif not args.keep:
+            shutil.rmtree( data_dir )
+finally:
+    if args.keep:
+        print( "Fleet data left in %s" % work_dir )
+    else:
+        shutil.rmtree( work_dir )
+
+print_results( results )
+summary = {
+    'commit': git_commit(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'cpus': os.cpu_count(),
+    'arguments': vars( args ),
+    'results': results,
+}
+if args.output:
+    with open( args.output, 'w' ) as output_file:
+        json.dump( summary, output_file, indent = 2 )
+        output_file.write( '\n' )
+if args.compare:
+    with open( args.compare, 'r' ) as baseline_file:
+        print_comparison( results, json.load( baseline_file ) )
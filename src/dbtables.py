@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, key and signing tables as database files
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Uses the 'berkeleydb' or 'bsddb3' package if one is installed, otherwise the Berkeley DB
+# db_load utility.
+
+# Writes the key and signing tables as Berkeley DB hash files that OpenDKIM can use as
+# db: datasets, so it can look up a domain directly instead of scanning the text tables.
+# In the key table database the tag is the key and the domain:selector:key file is the
+# value. In the signing table database the domain is the key and the tag the value,
+# OpenDKIM looks up the sender's domain when it doesn't find the full address.
+
+import logging
+import os
+import subprocess
+
+try:
+    import berkeleydb as bdb
+except ImportError:
+    try:
+        import bsddb3 as bdb
+    except ImportError:
+        bdb = None
+
+db_load_command = 'db_load'
+
+
+# Writes the key table and signing table database files from rows of (tag, domain,
+# selector, key file). Returns False if either file couldn't be written.
+def write_db_tables( rows, key_db_filename, signing_db_filename ):
+    key_pairs = []
+    signing_pairs = []
+    for tag, domain, selector, key_file in rows:
+        key_pairs.append( (tag, "%s:%s:%s" % (domain, selector, key_file)) )
+        signing_pairs.append( (domain, tag) )
+    if not write_db( key_db_filename, key_pairs ):
+        return False
+    return write_db( signing_db_filename, signing_pairs )
+
+
+# Builds a hash database from a list of (key, value) pairs in a temporary file and then
+# renames it into place, so OpenDKIM never sees a partly-written database.
+def write_db( filename, pairs ):
+    temp_filename = filename + '.new'
+    try:
+        if os.path.exists( temp_filename ):
+            os.remove( temp_filename )
+        if bdb is not None:
+            db = bdb.hashopen( temp_filename, 'n', 0o644 )
+            try:
+                for key, value in pairs:
+                    db[key.encode( 'utf-8' )] = value.encode( 'utf-8' )
+            finally:
+                db.close()
+        else:
+            run_db_load( temp_filename, pairs )
+        os.rename( temp_filename, filename )
+    except Exception as e:
+        logging.critical( "Error writing database file %s", filename )
+        logging.error( "%s", str( e ) )
+        try:
+            os.remove( temp_filename )
+        except OSError:
+            pass
+        return False
+    return True
+
+
+# db_load -T reads alternating key and value lines, with backslashes escaped
+def run_db_load( filename, pairs ):
+    process = subprocess.Popen( [db_load_command, '-T', '-t', 'hash', filename], stdin = subprocess.PIPE,
+                                stdout = subprocess.PIPE, stderr = subprocess.STDOUT )
+    lines = []
+    for key, value in pairs:
+        lines.append( key.replace( '\\', '\\\\' ) )
+        lines.append( value.replace( '\\', '\\\\' ) )
+    output = process.communicate( ('\n'.join( lines ) + '\n').encode( 'utf-8' ) )[0]
+    if process.returncode != 0:
+        raise OSError( "%s failed: %s" % (db_load_command, output.decode( 'utf-8', 'replace' ).strip()) )
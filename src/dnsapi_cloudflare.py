@@ -21,11 +21,14 @@
 # Requires:
 # dnsapi_data[0]        : Global API key
 # dnsapi_data[1]        : Email address
-# dnsapi_domain_data[0] : Zone ID
+# dnsapi_domain_data[0] : Zone ID, looked up from the domain name if not given or "auto"
 # dnsapi_domain_data[1] : TTL in seconds, automatic if not specified
 # key_data['plain']     : TXT record value in plain unquoted format
 
 # POST URL: https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records
+# GET URL (listing records): the same, with the type, name filter and page as parameters
+# DELETE URL: https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records/{record_id}
+# POST URL (batches): https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records/batch
 
 # Parameters:
 # type    : 'TXT'
@@ -33,22 +36,277 @@
 # content : key_data['plain']
 # ttl     : dnsapi_domain_data[1]
 
+import collections
 import datetime
 import logging
 
 import requests
 
+import dnshttp
+import zonecache
 
-def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
+# Records asked for in each page when listing records
+records_per_page = 5000
+# Zones asked for in each page when listing zones, the most Cloudflare allows
+zones_per_page = 50
+# Changes sent in a single batch request, the most Cloudflare allows on every plan
+max_batch_changes = 200
+# Cloudflare error code for a record that doesn't exist
+error_record_not_found = 81044
+
+# Interface v2: returns a client for adding and deleting records that reuses one HTTP
+# session, and so one pool of connections, for every request it makes.
+def open( dnsapi_data, debugging = False ):
+    return Client( dnsapi_data )
+
+
+class Client( object ):
+    def __init__( self, dnsapi_data ):
+        self.dnsapi_data = dnsapi_data
+        self.session = dnshttp.new_session( 'cloudflare' )
+
+    def add( self, dnsapi_domain_data, key_data, debugging = False ):
+        return add( self.dnsapi_data, dnsapi_domain_data, key_data, debugging, self.session )
+
+    def delete( self, dnsapi_domain_data, record_data, debugging = False ):
+        return delete( self.dnsapi_data, dnsapi_domain_data, record_data, debugging, self.session )
+
+    def batch( self, operations, debugging = False ):
+        return batch( self.dnsapi_data, operations, debugging, self.session )
+
+    def list_records( self, dnsapi_domain_data, domain, debugging = False ):
+        return list_records( self.dnsapi_data, dnsapi_domain_data, domain, debugging, self.session )
+
+    def close( self ):
+        self.session.close()
+
+
+def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False, session = requests ):
     if len( dnsapi_data ) < 2:
         logging.error( "DNS API cloudflare: API credentials not configured" )
         return False,
-    api_key = dnsapi_data[0]
-    email = dnsapi_data[1]
-    if len( dnsapi_domain_data ) < 1:
-        logging.error( "DNS API cloudflare: domain data does not contain zone ID" )
+    change = add_change( dnsapi_domain_data, key_data )
+    if change is None:
         return False,
-    zone_id = dnsapi_domain_data[0]
+    if debugging:
+        return True, key_data['domain'], change['selector']
+    zone_id = get_zone_id( dnsapi_data, dnsapi_domain_data, change['domain'], session )
+    if zone_id is None:
+        return False,
+
+    endpoint = "https://api.cloudflare.com/client/v4/zones/{0}/dns_records".format( zone_id )
+    resp = session.post( endpoint, json = change['record'], headers = auth_headers( dnsapi_data ) )
+    logging.info( "HTTP status: %d", resp.status_code )
+
+    if resp.status_code == requests.codes.ok:
+        success = resp.json()['success']
+        if success:
+            data = resp.json()['result']
+            if data:
+                result = True, key_data['domain'], change['selector'], datetime.datetime.utcnow(), data['id']
+            else:
+                logging.error( "DNS API cloudflare: could not find result data in response" )
+                result = False,
+        else:
+            result = False,
+            logging.error( "DNS API cloudflare: failure:\n%s", resp.text )
+    else:
+        result = False,
+        logging.error( "DNS API cloudflare: HTTP error %d", resp.status_code )
+        logging.error( "DNS API cloudflare: error response body:\n%s", resp.text )
+
+    return result
+
+
+# Deletes a record by its record ID. Records saved without one (added by an older version
+# of the cloudflareapi module) are looked up by name.
+def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False, session = requests ):
+    if len( dnsapi_data ) < 2:
+        logging.error( "DNS API cloudflare: API credentials not configured" )
+        return False
+    if len( record_data ) < 2:
+        logging.error( "DNS API cloudflare: saved record does not contain required data" )
+        return False
+    if debugging:
+        return True
+    zone_id = get_zone_id( dnsapi_data, dnsapi_domain_data, record_data[0], session )
+    if zone_id is None:
+        return False
+    record_id = get_record_id( dnsapi_data, zone_id, record_data, session )
+    if record_id is None:
+        return False
+    return delete_record( dnsapi_data, zone_id, record_id, record_data, session )
+
+
+# Deletes a record by zone and record ID. A record that's already gone counts as deleted.
+def delete_record( dnsapi_data, zone_id, record_id, record_data, session = requests ):
+    endpoint = "https://api.cloudflare.com/client/v4/zones/{0}/dns_records/{1}".format( zone_id, record_id )
+    resp = session.delete( endpoint, headers = auth_headers( dnsapi_data ) )
+    logging.info( "HTTP status: %d", resp.status_code )
+    if resp.status_code == requests.codes.ok and resp.json()['success']:
+        return True
+    if record_not_found( resp ):
+        logging.warning( "DNS API cloudflare: record %s for %s:%s was already gone", record_id, record_data[0],
+                         record_data[1] )
+        return True
+    logging.error( "DNS API cloudflare: HTTP error %d", resp.status_code )
+    logging.error( "DNS API cloudflare: error response body:\n%s", resp.text )
+    return False
+
+
+# Applies a list of add and delete operations (see ModuleInterface.md). All the changes
+# for the same zone are sent together through the batch endpoint, max_batch_changes to a
+# request, which Cloudflare applies all or nothing with the deletes first. If a batch is
+# rejected the changes in it are made one at a time instead, to find out which ones can
+# be made. Returns the list of results, one per operation, in the same form add() and
+# delete() return them.
+def batch( dnsapi_data, operations, debugging = False, session = requests ):
+    results = [None] * len( operations )
+    if len( dnsapi_data ) < 2:
+        logging.error( "DNS API cloudflare: API credentials not configured" )
+        return [(False,) if operation[0] == 'add' else False for operation in operations]
+    zones = collections.OrderedDict()  # Key = zone ID, Value = list of (operation index, change)
+    for i, operation in enumerate( operations ):
+        failed = (False,) if operation[0] == 'add' else False
+        if operation[0] == 'add':
+            change = add_change( operation[1], operation[2] )
+            domain = operation[2].get( 'domain' )
+        elif len( operation[2] ) >= 2:
+            change = { 'domain': operation[2][0], 'selector': operation[2][1], 'record_data': operation[2] }
+            domain = operation[2][0]
+        else:
+            logging.error( "DNS API cloudflare: saved record does not contain required data" )
+            change = None
+        if change is None:
+            results[i] = failed
+            continue
+        if debugging:
+            results[i] = (True, domain, change['selector']) if operation[0] == 'add' else True
+            continue
+        zone_id = get_zone_id( dnsapi_data, operation[1], domain, session )
+        if zone_id is None:
+            results[i] = failed
+            continue
+        if operation[0] == 'delete':
+            change['record_id'] = get_record_id( dnsapi_data, zone_id, operation[2], session )
+            if change['record_id'] is None:
+                results[i] = failed
+                continue
+        zones.setdefault( zone_id, [] ).append( (i, change) )
+
+    for zone_id, zone_changes in zones.items():
+        for start in range( 0, len( zone_changes ), max_batch_changes ):
+            changes = zone_changes[start:start + max_batch_changes]
+            added = send_batch( dnsapi_data, zone_id, [change for i, change in changes], session )
+            if added is None:
+                logging.warning( "DNS API cloudflare: batch of %d changes failed, making them separately",
+                                 len( changes ) )
+                for i, change in changes:
+                    if 'record' in change:
+                        results[i] = add( dnsapi_data, [zone_id] + operations[i][1][1:], operations[i][2], False,
+                                          session )
+                    else:
+                        results[i] = delete_record( dnsapi_data, zone_id, change['record_id'], change['record_data'],
+                                                    session )
+                continue
+            for i, change in changes:
+                if 'record' in change:
+                    results[i] = True, change['domain'], change['selector'], datetime.datetime.utcnow(), \
+                                 added.pop( 0 )
+                else:
+                    results[i] = True
+    return results
+
+
+# Lists the DKIM TXT records in the domain's zone, a page of up to records_per_page at a
+# time. Returns a list of records in the same form add() returns them (without the success
+# flag), or None if they couldn't be listed.
+def list_records( dnsapi_data, dnsapi_domain_data, domain, debugging = False, session = requests ):
+    if len( dnsapi_data ) < 2:
+        logging.error( "DNS API cloudflare: API credentials not configured" )
+        return None
+    zone_id = get_zone_id( dnsapi_data, dnsapi_domain_data, domain, session )
+    if zone_id is None:
+        return None
+    endpoint = "https://api.cloudflare.com/client/v4/zones/{0}/dns_records".format( zone_id )
+    hdr = auth_headers( dnsapi_data )
+    suffix = '._domainkey.' + domain
+    records = []
+    page = 1
+    while True:
+        params = {
+            'type': 'TXT',
+            'name.endswith': suffix,
+            'per_page': records_per_page,
+            'page': page
+        }
+        resp = session.get( endpoint, params = params, headers = hdr )
+        logging.info( "HTTP status: %d", resp.status_code )
+        if resp.status_code != requests.codes.ok or not resp.json()['success']:
+            logging.error( "DNS API cloudflare: error listing records for %s, HTTP status %d", domain,
+                           resp.status_code )
+            logging.error( "DNS API cloudflare: error response body:\n%s", resp.text )
+            return None
+        body = resp.json()
+        for record in body['result']:
+            name = record['name']
+            if name.endswith( suffix ):
+                records.append( (domain, name[:-len( suffix )], parse_created( record.get( 'created_on' ) ),
+                                 record['id']) )
+        total_pages = body.get( 'result_info', { } ).get( 'total_pages', 1 )
+        if page >= total_pages:
+            break
+        page += 1
+    return records
+
+
+# Cloudflare timestamps are ISO 8601 in UTC with fractional seconds. Records without one
+# are treated as created now.
+def parse_created( text ):
+    try:
+        return datetime.datetime.strptime( text[:19], '%Y-%m-%dT%H:%M:%S' )
+    except (TypeError, ValueError):
+        return datetime.datetime.utcnow()
+
+
+# Returns the zone ID from the domain data, or looks it up from the domain name if the
+# domain data doesn't have one or has "auto" (see zonecache.py). Returns None if there's
+# no zone for the domain.
+def get_zone_id( dnsapi_data, dnsapi_domain_data, domain, session = requests ):
+    if len( dnsapi_domain_data ) > 0 and not zonecache.wants_lookup( dnsapi_domain_data[0] ):
+        return dnsapi_domain_data[0]
+    return zonecache.lookup( 'cloudflare', dnsapi_data[:2], domain, lambda: list_zones( dnsapi_data, session ) )
+
+
+# Lists every zone in the account, fetching the pages after the first at the same time, or
+# only the zone with the given name if there is one. Returns a dict of zone name and zone
+# ID, or None if the zones couldn't be listed.
+def list_zones( dnsapi_data, session = requests, name = None ):
+    hdr = auth_headers( dnsapi_data )
+
+    def fetch_page( page ):
+        params = { 'page': page, 'per_page': zones_per_page }
+        if name is not None:
+            params['name'] = name
+        resp = session.get( "https://api.cloudflare.com/client/v4/zones", params = params, headers = hdr )
+        logging.info( "HTTP status: %d", resp.status_code )
+        if resp.status_code != requests.codes.ok or not resp.json()['success']:
+            logging.error( "DNS API cloudflare: error listing zones, HTTP status %d", resp.status_code )
+            logging.error( "DNS API cloudflare: error response body:\n%s", resp.text )
+            return None
+        body = resp.json()
+        return ([(zone['name'].lower(), zone['id']) for zone in body['result']],
+                body.get( 'result_info', { } ).get( 'total_pages', 1 ))
+
+    zones = zonecache.fetch_all_pages( fetch_page )
+    if zones is None:
+        return None
+    return dict( zones )
+
+
+# Returns the change that creates the record for key_data, or None if the information
+# needed is missing.
+def add_change( dnsapi_domain_data, key_data ):
     if len( dnsapi_domain_data ) > 1:
         try:
             ttl = int( dnsapi_domain_data[1] )
@@ -64,45 +322,72 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
         domain_suffix = key_data['domain']
     except KeyError as e:
         logging.error( "DNS API cloudflare: required information not present: %s", str( e ) )
-        return False,
-    if debugging:
-        return True, key_data['domain'], selector
-
-    endpoint = "https://api.cloudflare.com/client/v4/zones/{0}/dns_records".format( zone_id )
-    hdr = {
-        'Content-Type': 'application/json',
-        'X-Auth-Key': api_key,
-        'X-Auth-Email': email
-    }
-    body = {
+        return None
+    record = {
         'type': 'TXT',
         'name': selector + '._domainkey.' + domain_suffix,
         'content': data,
         'ttl': ttl
     }
-    resp = requests.post( endpoint, json = body, headers = hdr )
+    return { 'selector': selector, 'domain': domain_suffix, 'record': record }
+
+
+# Sends a batch of changes for one zone. Returns the record IDs of the records added, in
+# the same order as the changes, or None if the batch was rejected.
+def send_batch( dnsapi_data, zone_id, changes, session = requests ):
+    body = {
+        'deletes': [{ 'id': change['record_id'] } for change in changes if 'record' not in change],
+        'posts': [change['record'] for change in changes if 'record' in change]
+    }
+    endpoint = "https://api.cloudflare.com/client/v4/zones/{0}/dns_records/batch".format( zone_id )
+    resp = session.post( endpoint, json = body, headers = auth_headers( dnsapi_data ) )
     logging.info( "HTTP status: %d", resp.status_code )
+    if resp.status_code != requests.codes.ok or not resp.json()['success']:
+        logging.error( "DNS API cloudflare: batch HTTP error %d", resp.status_code )
+        logging.error( "DNS API cloudflare: error response body:\n%s", resp.text )
+        return None
+    posts = resp.json()['result'].get( 'posts' ) or []
+    if len( posts ) != len( body['posts'] ):
+        logging.error( "DNS API cloudflare: batch response has %d records for %d added", len( posts ),
+                       len( body['posts'] ) )
+        return None
+    return [record['id'] for record in posts]
 
-    if resp.status_code == requests.codes.ok:
-        success = resp.json()['success']
-        if success:
-            data = resp.json()['result']
-            if data:
-                result = True, key_data['domain'], selector, datetime.datetime.utcnow(), data['id']
-            else:
-                logging.error( "DNS API cloudflare: could not find result data in response" )
-                result = False,
-        else:
-            result = False,
-            logging.error( "DNS API cloudflare: failure:\n%s", resp.text )
-    else:
-        result = False,
-        logging.error( "DNS API cloudflare: HTTP error %d", resp.status_code )
+
+# Returns the record ID of a saved record, looking it up by name if the record wasn't
+# saved with one. Returns None if the record can't be found, or if more than one record
+# has its name and there's no telling which one it is.
+def get_record_id( dnsapi_data, zone_id, record_data, session = requests ):
+    if len( record_data ) > 3 and record_data[3] not in ('', '-'):
+        return record_data[3]
+    name = record_data[1] + '._domainkey.' + record_data[0]
+    endpoint = "https://api.cloudflare.com/client/v4/zones/{0}/dns_records".format( zone_id )
+    resp = session.get( endpoint, params = { 'type': 'TXT', 'name': name }, headers = auth_headers( dnsapi_data ) )
+    logging.info( "HTTP status: %d", resp.status_code )
+    if resp.status_code != requests.codes.ok or not resp.json()['success']:
+        logging.error( "DNS API cloudflare: error looking up %s, HTTP status %d", name, resp.status_code )
         logging.error( "DNS API cloudflare: error response body:\n%s", resp.text )
+        return None
+    records = resp.json()['result']
+    if len( records ) != 1:
+        logging.error( "DNS API cloudflare: found %d records for %s, expected 1", len( records ), name )
+        return None
+    return records[0]['id']
 
-    return result
+
+# Whether a failed request failed because the record doesn't exist
+def record_not_found( resp ):
+    if resp.status_code != requests.codes.not_found:
+        return False
+    try:
+        return any( [error.get( 'code' ) == error_record_not_found for error in resp.json()['errors']] )
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
 
 
-def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False ):
-    # TODO delete record
-    return None
+def auth_headers( dnsapi_data ):
+    return {
+        'Content-Type': 'application/json',
+        'X-Auth-Key': dnsapi_data[0],
+        'X-Auth-Email': dnsapi_data[1]
+    }
@@ -18,11 +18,15 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Uses the 'python-cloudflare' package.
+#
+# Batches of changes (see ModuleInterface.md) go through the Cloudflare batch endpoint using
+# the REST requests of the cloudflare module, the SDK has no call for it. Records are listed
+# for --reconcile the same way.
 
 # Requires:
 # dnsapi_data[0]        : Global API key
 # dnsapi_data[1]        : Email address
-# dnsapi_domain_data[0] : Zone ID
+# dnsapi_domain_data[0] : Zone ID, looked up from the domain name if not given or "auto"
 # dnsapi_domain_data[1] : TTL in seconds, automatic if not specified
 # key_data['plain']     : TXT record value in plain unquoted format
 
@@ -35,19 +39,69 @@
 import datetime
 import logging
 
-import CloudFlare
+import dnsapi_cloudflare
+import dnshttp
 
 
-def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
+# Interface v2: returns a client for adding and deleting records that creates one
+# CloudFlare API object and reuses it for every request.
+def open( dnsapi_data, debugging = False ):
+    return Client( dnsapi_data )
+
+
+class Client( object ):
+    def __init__( self, dnsapi_data ):
+        self.dnsapi_data = dnsapi_data
+        self.cf = None
+        # Zone IDs are looked up through the REST API, the same as the cloudflare module
+        self.session = None
+
+    def add( self, dnsapi_domain_data, key_data, debugging = False ):
+        self.connect( debugging )
+        return add( self.dnsapi_data, dnsapi_domain_data, key_data, debugging, self.cf, self.session )
+
+    def delete( self, dnsapi_domain_data, record_data, debugging = False ):
+        self.connect( debugging )
+        return delete( self.dnsapi_data, dnsapi_domain_data, record_data, debugging, self.cf, self.session )
+
+    def batch( self, operations, debugging = False ):
+        self.connect( debugging )
+        return dnsapi_cloudflare.batch( self.dnsapi_data, operations, debugging, self.session )
+
+    # Listing goes through the REST API like batches, and is done even when debugging
+    def list_records( self, dnsapi_domain_data, domain, debugging = False ):
+        if self.session is None:
+            self.session = dnshttp.new_session( 'cloudflareapi' )
+        return dnsapi_cloudflare.list_records( self.dnsapi_data, dnsapi_domain_data, domain, debugging, self.session )
+
+    # Creates the CloudFlare API object and the HTTP session when the first request is made
+    def connect( self, debugging = False ):
+        if debugging or len( self.dnsapi_data ) < 2:
+            return
+        if self.cf is None:
+            self.cf = cloudflare_sdk().CloudFlare( email = self.dnsapi_data[1], token = self.dnsapi_data[0] )
+        if self.session is None:
+            self.session = dnshttp.new_session( 'cloudflareapi' )
+
+    def close( self ):
+        self.cf = None
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+
+# The CloudFlare SDK takes a while to import, so it's only imported once a request is made
+def cloudflare_sdk():
+    import CloudFlare
+    return CloudFlare
+
+
+def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False, cf = None, session = None ):
     if len( dnsapi_data ) < 2:
         logging.error( "DNS API Cloudflare: API credentials not configured" )
         return False,
     api_key = dnsapi_data[0]
     email = dnsapi_data[1]
-    if len( dnsapi_domain_data ) < 1:
-        logging.error( "DNS API Cloudflare: domain data does not contain zone ID" )
-        return False,
-    zone_id = dnsapi_domain_data[0]
     if len( dnsapi_domain_data ) > 1:
         try:
             ttl = int( dnsapi_domain_data[1] )
@@ -66,8 +120,15 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
         return False,
     if debugging:
         return True, key_data['domain'], selector
+    if session is None:
+        session = dnshttp.new_session( 'cloudflareapi' )
+    zone_id = dnsapi_cloudflare.get_zone_id( dnsapi_data, dnsapi_domain_data, domain_suffix, session )
+    if zone_id is None:
+        return False,
 
-    cf = CloudFlare.CloudFlare( email = email, token = api_key, debug = debugging )
+    CloudFlare = cloudflare_sdk()
+    if cf is None:
+        cf = CloudFlare.CloudFlare( email = email, token = api_key, debug = debugging )
 
     request_params = {
         'type': 'TXT',
@@ -78,22 +139,65 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
 
     try:
         response = cf.zones.dns_records.post( zone_id, data = request_params )
-        if response:
-            # TODO need resource ID appended to result
-            result = True, key_data['domain'], selector, datetime.datetime.utcnow()
+        if response and 'id' in response:
+            result = True, key_data['domain'], selector, datetime.datetime.utcnow(), response['id']
         else:
+            logging.error( "DNS API Cloudflare: could not find result data in response" )
             result = False,
     except CloudFlare.exceptions.CloudFlareAPIError as e:
         result = False,
-        if len( e ) > 0:
-            for ex in e:
-                logging.error( 'DNS API Cloudflare: [%d] %s', ex, ex )
+        log_api_error( e )
+
+    return result
+
+
+# Deletes a record by its record ID. Records saved before the record ID was kept are looked
+# up by name.
+def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False, cf = None, session = None ):
+    if len( dnsapi_data ) < 2:
+        logging.error( "DNS API Cloudflare: API credentials not configured" )
+        return False
+    if len( record_data ) < 2:
+        logging.error( "DNS API Cloudflare: saved record does not contain required data" )
+        return False
+    if debugging:
+        return True
+    if session is None:
+        session = dnshttp.new_session( 'cloudflareapi' )
+    zone_id = dnsapi_cloudflare.get_zone_id( dnsapi_data, dnsapi_domain_data, record_data[0], session )
+    if zone_id is None:
+        return False
+
+    CloudFlare = cloudflare_sdk()
+    if cf is None:
+        cf = CloudFlare.CloudFlare( email = dnsapi_data[1], token = dnsapi_data[0] )
+
+    try:
+        if len( record_data ) > 3 and record_data[3] not in ('', '-'):
+            record_id = record_data[3]
         else:
-            logging.error( 'DNS API Cloudflare: [%d] %s', e, e )
+            name = record_data[1] + '._domainkey.' + record_data[0]
+            records = cf.zones.dns_records.get( zone_id, params = { 'type': 'TXT', 'name': name } )
+            if len( records ) != 1:
+                logging.error( "DNS API Cloudflare: found %d records for %s, expected 1", len( records ), name )
+                return False
+            record_id = records[0]['id']
+        cf.zones.dns_records.delete( zone_id, record_id )
+        result = True
+    except CloudFlare.exceptions.CloudFlareAPIError as e:
+        if int( e ) == dnsapi_cloudflare.error_record_not_found:
+            logging.warning( "DNS API Cloudflare: record for %s:%s was already gone", record_data[0], record_data[1] )
+            result = True
+        else:
+            result = False
+            log_api_error( e )
 
     return result
 
 
-def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False ):
-    # TODO delete record
-    return None
+def log_api_error( e ):
+    if len( e ) > 0:
+        for ex in e:
+            logging.error( 'DNS API Cloudflare: [%d] %s', ex, ex )
+    else:
+        logging.error( 'DNS API Cloudflare: [%d] %s', e, e )
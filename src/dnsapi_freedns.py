@@ -43,16 +43,88 @@
 #   ttl = empty
 #   ref = unknown, apparently not used
 #   send = "Save!"
+#
+# Both saving and deleting a record answer with the account's subdomain listing, which is
+# the only place the record's data_id can be found. The listing is parsed into an index of
+# record names and data IDs as the response arrives, and the client keeps the index from
+# the latest listing for the rest of the run.
+#
+# delete2.php takes any number of data_id[] values, so a batch of changes deletes all its
+# records in a few requests and checks them against the listing that comes back from the
+# last request of the batch.
 
 import datetime
 import logging
 import re
+import threading
 
 import requests
-import w3lib.html
 
+import dnshttp
+
+# Link to a record's edit page in the subdomain listing, with its data ID and name
+subdomain_link_pattern = re.compile( r'<a href=edit\.php\?data_id=([0-9]+)>([^<]*)</a>' )
+listing_form_start = '<form action=delete2.php>'
+listing_form_end = '</form>'
+# Characters of a response read at a time while parsing the listing
+listing_chunk_size = 65536
+# Records deleted by a single delete2.php request, keeping its URL to a reasonable length
+max_batch_deletes = 100
+
+# Interface v2: returns a client for adding and deleting records that reuses one HTTP
+# session, and so one pool of connections, for every request it makes.
+def open( dnsapi_data, debugging = False ):
+    return Client( dnsapi_data )
+
+
+class Client( object ):
+    def __init__( self, dnsapi_data ):
+        self.dnsapi_data = dnsapi_data
+        self.session = dnshttp.new_session( 'freedns' )
+        self.index = SubdomainIndex()
+        # Each add needs a request of its own, only deletes are worth batching
+        self.batch_adds = False
+
+    def add( self, dnsapi_domain_data, key_data, debugging = False ):
+        return add( self.dnsapi_data, dnsapi_domain_data, key_data, debugging, self.session, self.index )
+
+    def delete( self, dnsapi_domain_data, record_data, debugging = False ):
+        return delete( self.dnsapi_data, dnsapi_domain_data, record_data, debugging, self.session, self.index )
+
+    def batch( self, operations, debugging = False ):
+        return batch( self.dnsapi_data, operations, debugging, self.session, self.index )
+
+    def close( self ):
+        self.session.close()
+
+
+# Record names and data IDs from the latest subdomain listing. A client's requests can be
+# made from several threads at once, so it's only used under its lock.
+class SubdomainIndex( object ):
+    def __init__( self ):
+        self.names = { }  # Key = record name in lower case, Value = list of data IDs
+        self.data_ids = set()
+        self.lock = threading.Lock()
+
+    # Replaces the index with a newly parsed listing. Returns the data IDs that weren't in
+    # the previous listing.
+    def update( self, names ):
+        with self.lock:
+            previous = self.data_ids
+            self.names = names
+            self.data_ids = set( [data_id for data_ids in names.values() for data_id in data_ids] )
+            return self.data_ids - previous
 
-def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
+    def lookup( self, record_name ):
+        with self.lock:
+            return list( self.names.get( record_name.lower(), [] ) )
+
+    def contains( self, data_id ):
+        with self.lock:
+            return data_id in self.data_ids
+
+
+def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False, session = requests, index = None ):
     if len( dnsapi_data ) < 1:
         logging.error( "DNS API freedns: authentication cookie not configured" )
         return False,
@@ -70,26 +142,28 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
     if debugging:
         return True, key_data['domain'], selector
 
-    resp = requests.post( 'https://freedns.afraid.org/subdomain/save.php?step=2',
-                          data = {
-                              'type': 'TXT',
-                              'subdomain': selector + '._domainkey',
-                              'domain_id': domain_id,
-                              'address': data,
-                              'ttl': '',
-                              'send': 'Save!'
-                          },
-                          cookies = { 'dns_cookie': cookie_value } )
+    resp = session.post( 'https://freedns.afraid.org/subdomain/save.php?step=2',
+                         data = {
+                             'type': 'TXT',
+                             'subdomain': selector + '._domainkey',
+                             'domain_id': domain_id,
+                             'address': data,
+                             'ttl': '',
+                             'send': 'Save!'
+                         },
+                         cookies = { 'dns_cookie': cookie_value },
+                         stream = True )
     logging.info( "HTTP status: %d", resp.status_code )
 
     if resp.status_code == requests.codes.ok:
-        form_start = resp.text.find( '<form action=delete2.php>' )
-        if form_start >= 0:
-            form_end = resp.text.find( '</form>', form_start ) + 6
-            form_string = w3lib.html.replace_entities( resp.text[form_start:form_end] )
-        else:
-            form_string = ''
-        record_id = extract_record_id( form_string, selector + '._domainkey.' + key_data['domain'] )
+        if index is None:
+            index = SubdomainIndex()
+        names = parse_listing( resp )
+        new_ids = index.update( names ) if names is not None else set()
+        data_ids = index.lookup( selector + '._domainkey.' + key_data['domain'] )
+        # If the name has more than one record, the one just added is the one that's new
+        added_ids = [data_id for data_id in data_ids if data_id in new_ids]
+        record_id = (added_ids or data_ids or [None])[0]
         if record_id is None:
             logging.error( "DNS API freedns: could not locate record ID in subdomains page" )
             result = False,
@@ -103,51 +177,139 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
     return result
 
 
-def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False ):
+def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False, session = requests, index = None ):
+    record_id = get_record_id( dnsapi_data, record_data )
+    if record_id is None:
+        return False
+    if debugging:
+        return True
+
+    if index is None:
+        index = SubdomainIndex()
+    if not send_deletes( dnsapi_data[0], [record_id], session, index ):
+        return False
+    if index.contains( record_id ):
+        logging.error( "DNS API freedns: still found record ID in subdomains page" )
+        return False
+    return True
+
+
+# Applies a list of add and delete operations (see ModuleInterface.md). All the records to
+# be deleted are deleted first, max_batch_deletes to a request, then the records are added
+# one at a time. Once everything's been sent the deleted records are checked against the
+# latest listing. Returns the list of results, one per operation, in the same form add()
+# and delete() return them.
+def batch( dnsapi_data, operations, debugging = False, session = requests, index = None ):
+    if index is None:
+        index = SubdomainIndex()
+    results = [None] * len( operations )
+    deletes = []  # (operation index, record ID)
+    for i, operation in enumerate( operations ):
+        if operation[0] != 'delete':
+            continue
+        record_id = get_record_id( dnsapi_data, operation[2] )
+        if record_id is None:
+            results[i] = False
+        elif debugging:
+            results[i] = True
+        else:
+            deletes.append( (i, record_id) )
+
+    for start in range( 0, len( deletes ), max_batch_deletes ):
+        chunk = deletes[start:start + max_batch_deletes]
+        sent = send_deletes( dnsapi_data[0], [record_id for i, record_id in chunk], session, index )
+        for i, record_id in chunk:
+            results[i] = sent
+    for i, operation in enumerate( operations ):
+        if operation[0] == 'add':
+            results[i] = add( dnsapi_data, operation[1], operation[2], debugging, session, index )
+
+    for i, record_id in deletes:
+        if results[i] and index.contains( record_id ):
+            logging.error( "DNS API freedns: still found record ID %s in subdomains page", record_id )
+            results[i] = False
+    return results
+
+
+# Returns the data ID of the record described by record_data, or None if the information
+# needed is missing.
+def get_record_id( dnsapi_data, record_data ):
     if len( dnsapi_data ) < 1:
         logging.error( "DNS API freedns: authentication cookie not configured" )
-        return False
-    cookie_value = dnsapi_data[0]
+        return None
     try:
-        domain = record_data[0]
-        selector = record_data[1]
-        record_id = record_data[3]
-    except KeyError as e:
+        return str( record_data[3] )
+    except (KeyError, IndexError) as e:
         logging.error( "DNS API freedns: required information not present: %s", str( e ) )
-        return False
-    if debugging:
-        return True
+        return None
 
-    resp = requests.get( 'https://freedns.afraid.org/subdomain/delete2.php',
-                         { 'data_id[]': record_id, 'submit': 'delete selected' },
-                         cookies = { 'dns_cookie': cookie_value } )
+
+# Deletes a list of records by data ID in one delete2.php request and updates the index
+# from the listing in the response. Returns True if the request succeeded, whether the
+# records are actually gone is up to the caller to check against the index. A response
+# without the listing (eg. the login page, when the cookie has expired) is a failure, since
+# there's nothing to check the records against.
+def send_deletes( cookie_value, record_ids, session = requests, index = None ):
+    resp = session.get( 'https://freedns.afraid.org/subdomain/delete2.php',
+                        params = { 'data_id[]': record_ids, 'submit': 'delete selected' },
+                        cookies = { 'dns_cookie': cookie_value },
+                        stream = True )
     logging.info( "HTTP status: %d", resp.status_code )
 
-    if resp.status_code == requests.codes.ok:
-        form_start = resp.text.find( '<form action=delete2.php>' )
-        if form_start >= 0:
-            form_end = resp.text.find( '</form>', form_start ) + 6
-            form_string = w3lib.html.replace_entities( resp.text[form_start:form_end] )
-        else:
-            form_string = ''
-        record_id = extract_record_id( form_string, selector + '._domainkey.' + domain )
-        if record_id is not None:
-            logging.error( "DNS API freedns: still found record ID in subdomains page" )
-            result = False
-        else:
-            result = True
-    else:
-        result = False
+    if resp.status_code != requests.codes.ok:
         logging.error( "DNS API freedns: HTTP error %d", resp.status_code )
         logging.error( "DNS API freedns: error response body:\n%s", resp.text )
+        return False
+    names = parse_listing( resp )
+    if names is None:
+        logging.error( "DNS API freedns: no subdomain listing in delete response, check the authentication cookie" )
+        return False
+    if index is not None:
+        index.update( names )
+    return True
 
-    return result
 
+# w3lib is only imported once there's a response to decode
+def replace_entities( text ):
+    import w3lib.html
+    return w3lib.html.replace_entities( text )
 
-def extract_record_id( form_string, record_name ):
-    match = re.search( '<a href=edit.php\?data_id=([0-9]+)>' + record_name + '</a>', form_string )
-    if match:
-        result = match.group( 1 )
-    else:
-        result = None
-    return result
+
+# Parses the subdomain listing in a response into a dict of record names (in lower case)
+# and their data IDs, in a single pass over the body as it arrives instead of reading the
+# whole page in first. Returns None if the response doesn't contain the listing.
+def parse_listing( resp ):
+    if resp.encoding is None:
+        resp.encoding = 'utf-8'
+    names = None
+    finished = False
+    buffer = ''
+    for chunk in resp.iter_content( chunk_size = listing_chunk_size, decode_unicode = True ):
+        if finished:
+            # Read the rest of the page so the connection can be reused
+            continue
+        buffer += chunk
+        if names is None:
+            start = buffer.find( listing_form_start )
+            if start < 0:
+                buffer = buffer[-len( listing_form_start ):]
+                continue
+            names = { }
+            buffer = buffer[start + len( listing_form_start ):]
+        end = buffer.find( listing_form_end )
+        last = 0
+        for match in subdomain_link_pattern.finditer( buffer if end < 0 else buffer[:end] ):
+            name = match.group( 2 )
+            if '&' in name:
+                name = replace_entities( name )
+            names.setdefault( name.lower(), [] ).append( match.group( 1 ) )
+            last = match.end()
+        if end >= 0:
+            finished = True
+        else:
+            # Keep a link or the end of the form that's been cut off by the end of the chunk
+            keep = buffer.rfind( '<a ', last )
+            if keep < 0:
+                keep = max( last, len( buffer ) - len( listing_form_end ) )
+            buffer = buffer[keep:]
+    return names
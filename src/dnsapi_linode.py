@@ -20,7 +20,7 @@
 
 # Requires:
 # dnsapi_data[0]        : API key
-# dnsapi_domain_data[0] : Domain ID
+# dnsapi_domain_data[0] : Domain ID, looked up from the domain name if not given or "auto"
 # key_data['plain']     : TXT record value in plain unquoted format
 
 # POST URL: https://api.linode.com/
@@ -30,7 +30,8 @@
 # api_action         : "domain.resource.create"
 # DomainID           : dnsapi_domain_data[0]
 # Type               : "TXT"
-# Name               : selector + "._domainkey"
+# Name               : selector + "._domainkey", followed by the labels of the domain below
+#                      the Linode domain when that's a parent of it (see get_domain())
 # Target             : key_data['plain']
 
 import datetime
@@ -38,16 +39,38 @@ import logging
 
 import requests
 
+import dnshttp
+import zonecache
 
-def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
+# Interface v2: returns a client for adding and deleting records that reuses one HTTP
+# session, and so one pool of connections, for every request it makes.
+def open( dnsapi_data, debugging = False ):
+    return Client( dnsapi_data )
+
+
+class Client( object ):
+    def __init__( self, dnsapi_data ):
+        self.dnsapi_data = dnsapi_data
+        self.session = dnshttp.new_session( 'linode' )
+
+    def add( self, dnsapi_domain_data, key_data, debugging = False ):
+        return add( self.dnsapi_data, dnsapi_domain_data, key_data, debugging, self.session )
+
+    def delete( self, dnsapi_domain_data, record_data, debugging = False ):
+        return delete( self.dnsapi_data, dnsapi_domain_data, record_data, debugging, self.session )
+
+    def list_records( self, dnsapi_domain_data, domain, debugging = False ):
+        return list_records( self.dnsapi_data, dnsapi_domain_data, domain, debugging, self.session )
+
+    def close( self ):
+        self.session.close()
+
+
+def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False, session = requests ):
     if len( dnsapi_data ) < 1:
         logging.error( "DNS API linode: API key not configured" )
         return False,
     api_key = dnsapi_data[0]
-    if len( dnsapi_domain_data ) < 1:
-        logging.error( "DNS API linode: domain data does not contain domain ID" )
-        return False,
-    domain_id = dnsapi_domain_data[0]
     try:
         selector = key_data['selector']
         data = key_data['plain']
@@ -56,16 +79,20 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
         return False,
     if debugging:
         return True,
-
-    resp = requests.post( "https://api.linode.com/",
-                          data = {
-                              'api_key': api_key,
-                              'api_action': 'domain.resource.create',
-                              'DomainID': domain_id,
-                              'Type': 'TXT',
-                              'Name': selector + "._domainkey",
-                              'Target': data
-                          } )
+    linode_domain = get_domain( dnsapi_data, dnsapi_domain_data, key_data['domain'], session )
+    if linode_domain is None:
+        return False,
+    domain_id, subdomain = linode_domain
+
+    resp = session.post( "https://api.linode.com/",
+                         data = {
+                             'api_key': api_key,
+                             'api_action': 'domain.resource.create',
+                             'DomainID': domain_id,
+                             'Type': 'TXT',
+                             'Name': selector + "._domainkey" + subdomain,
+                             'Target': data
+                         } )
     logging.info( "HTTP status: %d", resp.status_code )
 
     if resp.status_code == requests.codes.ok:
@@ -89,15 +116,11 @@ def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
     return result
 
 
-def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False ):
+def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False, session = requests ):
     if len(dnsapi_data) < 1:
         logging.error("DNS API linode: API key not configured")
         return False
     api_key = dnsapi_data[0]
-    if len(dnsapi_domain_data) < 1:
-        logging.error("DNS API linode: domain data does not contain domain ID")
-        return False
-    domain_id = dnsapi_domain_data[0]
     try:
         resource_id = record_data[3]
     except KeyError as e:
@@ -105,13 +128,16 @@ def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False ):
         return False
     if debugging:
         return True
+    domain_id = get_domain_id( dnsapi_data, dnsapi_domain_data, record_data[0], session )
+    if domain_id is None:
+        return False
 
-    resp = requests.post("https://api.linode.com/",
-                         data = {'api_key':    api_key,
-                                 'api_action': 'domain.resource.delete',
-                                 'DomainID':   domain_id,
-                                 'ResourceID': resource_id,
-                         })
+    resp = session.post("https://api.linode.com/",
+                        data = {'api_key':    api_key,
+                                'api_action': 'domain.resource.delete',
+                                'DomainID':   domain_id,
+                                'ResourceID': resource_id,
+                        })
     logging.info("HTTP status: %d", resp.status_code)
 
     if resp.status_code == requests.codes.ok:
@@ -133,3 +159,95 @@ def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False ):
         logging.error("DNS API linode: error response body:\n%s", resp.text)
 
     return result
+
+
+# Lists the DKIM TXT records for the domain, all in a single domain.resource.list call.
+# Linode doesn't say when a record was created, so they're treated as created now. Returns
+# a list of records in the same form add() returns them (without the success flag), or None
+# if they couldn't be listed.
+def list_records( dnsapi_data, dnsapi_domain_data, domain, debugging = False, session = requests ):
+    if len( dnsapi_data ) < 1:
+        logging.error( "DNS API linode: API key not configured" )
+        return None
+    linode_domain = get_domain( dnsapi_data, dnsapi_domain_data, domain, session )
+    if linode_domain is None:
+        return None
+    domain_id, subdomain = linode_domain
+
+    resp = session.post( "https://api.linode.com/",
+                         data = {
+                             'api_key': dnsapi_data[0],
+                             'api_action': 'domain.resource.list',
+                             'DomainID': domain_id
+                         } )
+    logging.info( "HTTP status: %d", resp.status_code )
+    if resp.status_code != requests.codes.ok:
+        logging.error( "DNS API linode: HTTP error %d", resp.status_code )
+        logging.error( "DNS API linode: error response body:\n%s", resp.text )
+        return None
+    error_array = resp.json()['ERRORARRAY']
+    if len( error_array ) > 0:
+        for error in error_array:
+            logging.error( "DNS API linode: error %d: %s", error['ERRORCODE'], error['ERRORMESSAGE'] )
+        return None
+
+    now = datetime.datetime.utcnow()
+    suffix = '._domainkey' + subdomain
+    records = []
+    for resource in resp.json()['DATA']:
+        name = resource.get( 'NAME', '' )
+        # The selector is the first label, records for other subdomains have more labels
+        if resource.get( 'TYPE', '' ).upper() == 'TXT' and name.lower().endswith( suffix ) and \
+                '.' not in name[:-len( suffix )]:
+            records.append( (domain, name[:-len( suffix )], now, str( resource['RESOURCEID'] )) )
+    return records
+
+
+# Returns the domain ID from the domain data, or looks it up from the domain name if the
+# domain data doesn't have one or has "auto" (see zonecache.py). Returns None if there's
+# no Linode domain for it.
+def get_domain_id( dnsapi_data, dnsapi_domain_data, domain, session = requests ):
+    linode_domain = get_domain( dnsapi_data, dnsapi_domain_data, domain, session )
+    if linode_domain is None:
+        return None
+    return linode_domain[0]
+
+
+# Returns (domain ID, subdomain suffix) for the domain, or None if there's no Linode domain
+# for it. Record names are relative to the Linode domain, so when the lookup finds a parent
+# domain (sub.example.com in example.com) the suffix is the rest of the name ('.sub') and
+# goes after '._domainkey'. A domain ID given in the domain data is taken to be the
+# domain's own, with an empty suffix.
+def get_domain( dnsapi_data, dnsapi_domain_data, domain, session = requests ):
+    if len( dnsapi_domain_data ) > 0 and not zonecache.wants_lookup( dnsapi_domain_data[0] ):
+        return dnsapi_domain_data[0], ''
+    zone = zonecache.lookup_zone( 'linode', dnsapi_data[:1], domain, lambda: list_domains( dnsapi_data, session ) )
+    if zone is None:
+        return None
+    zone_name, domain_id = zone
+    name = domain.rstrip( '.' ).lower()
+    if name == zone_name:
+        return domain_id, ''
+    return domain_id, '.' + name[:-len( zone_name ) - 1]
+
+
+# Lists every domain in the account. Linode returns them all from a single domain.list
+# call, so there are no pages to fetch. Returns a dict of domain name and domain ID, or
+# None if the domains couldn't be listed.
+def list_domains( dnsapi_data, session = requests ):
+    resp = session.post( "https://api.linode.com/",
+                         data = {
+                             'api_key': dnsapi_data[0],
+                             'api_action': 'domain.list'
+                         } )
+    logging.info( "HTTP status: %d", resp.status_code )
+    if resp.status_code != requests.codes.ok:
+        logging.error( "DNS API linode: HTTP error %d", resp.status_code )
+        logging.error( "DNS API linode: error response body:\n%s", resp.text )
+        return None
+    error_array = resp.json()['ERRORARRAY']
+    if len( error_array ) > 0:
+        for error in error_array:
+            logging.error( "DNS API linode: error %d: %s", error['ERRORCODE'], error['ERRORMESSAGE'] )
+        return None
+    return dict( [(item['DOMAIN'].lower(), str( item['DOMAINID'] )) for item in resp.json()['DATA']] )
@@ -21,13 +21,17 @@
 # Requires:
 # dnsapi_data[0]        : AWS key ID
 # dnsapi_data[1]        : AWS secret key
-# dnsapi_domain_data[0] : AWS region (always us-east-1)
-# dnsapi_domain_data[1] : Hosted domain ID
+# dnsapi_domain_data[0] : AWS region (always us-east-1, used if empty)
+# dnsapi_domain_data[1] : Hosted domain ID, looked up from the domain name if not given or "auto"
 # dnsapi_domain_data[2] : Time-to-live, default 3600 seconds (1 hour)
 # key_data['plain']     : TXT record value in plain unquoted format
 
 # POST URL: https://route53.amazonaws.com/2013-04-01/hostedzone/rrset
 
+# A change is only counted as made once Route 53 reports it INSYNC, that is it's reached
+# all the Route 53 nameservers. The IDs of the changes sent are polled with GetChange
+# until then, all of them together, for up to change_timeout seconds.
+
 # Parameters:
 # api_key            : dnsapi_data[0]
 # api_action         : "domain.resource.create"
@@ -36,208 +40,483 @@
 # Name               : selector + "._domainkey"
 # Target             : key_data['plain']
 
+import collections
+import concurrent.futures
 import datetime
 import logging
-import xml.dom.minidom
+import threading
+import time
+import xml.etree.ElementTree
+import xml.sax.saxutils
 
 import requests
-from requests_aws4auth import AWS4Auth
+
+import dnshttp
+import zonecache
+
+# Limits on the size of a single ChangeResourceRecordSets request
+max_batch_records = 1000
+max_batch_value_length = 32000
+# Record sets asked for in each ListResourceRecordSets request
+list_max_items = 300
+# Hosted zones asked for in each ListHostedZones request, the most Route 53 allows
+zones_max_items = 100
+# Route 53 is a global service signed for this region
+default_region = 'us-east-1'
+# Seconds to wait for changes to reach INSYNC before they're counted as failed
+change_timeout = 300.0
+# Seconds between GetChange polls, doubling after each round of polls up to the maximum
+change_poll_interval = 2.0
+change_poll_max_interval = 16.0
+# GetChange requests made at the same time
+change_poll_jobs = 8
+# Bytes of a response fed to the XML parser at a time
+response_chunk_size = 16384
+
+xml_namespace = 'https://route53.amazonaws.com/doc/2013-04-01/'
+# ChangeResourceRecordSets request, filled in with the changes
+request_template = ('<?xml version="1.0" encoding="utf-8"?>'
+                    '<ChangeResourceRecordSetsRequest xmlns="' + xml_namespace + '">'
+                    '<ChangeBatch><Changes>{0}</Changes></ChangeBatch></ChangeResourceRecordSetsRequest>')
+change_template = ('<Change><Action>{action}</Action><ResourceRecordSet><Name>{name}</Name><Type>TXT</Type>'
+                   '<TTL>{ttl}</TTL><ResourceRecords><ResourceRecord><Value>{value}</Value></ResourceRecord>'
+                   '</ResourceRecords></ResourceRecordSet></Change>')
+
+# Request signers, created once for each region and set of credentials and shared by
+# every client since creating one derives the signing key
+signers = { }  # Key = (region, AWS key ID, AWS secret key), Value = AWS4Auth signer
+signers_lock = threading.Lock()
+
+
+# Interface v2: returns a client for adding and deleting records that reuses one HTTP
+# session, and so one pool of connections, for every request it makes.
+def open( dnsapi_data, debugging = False ):
+    return Client( dnsapi_data )
+
+
+class Client( object ):
+    def __init__( self, dnsapi_data ):
+        self.dnsapi_data = dnsapi_data
+        self.session = dnshttp.new_session( 'route53' )
+
+    def add( self, dnsapi_domain_data, key_data, debugging = False ):
+        return add( self.dnsapi_data, dnsapi_domain_data, key_data, debugging, self.session )
+
+    def delete( self, dnsapi_domain_data, record_data, debugging = False ):
+        return delete( self.dnsapi_data, dnsapi_domain_data, record_data, debugging, self.session )
+
+    def batch( self, operations, debugging = False ):
+        return batch( self.dnsapi_data, operations, debugging, self.session )
+
+    def list_records( self, dnsapi_domain_data, domain, debugging = False ):
+        return list_records( self.dnsapi_data, dnsapi_domain_data, domain, debugging, self.session )
+
+    def close( self ):
+        self.session.close()
 
 
-def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False ):
+def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False, session = requests ):
     if len( dnsapi_data ) < 2:
         logging.error( "DNS API route53: AWS key not configured" )
         return False,
-    aws_key_id = dnsapi_data[0]
-    aws_key = dnsapi_data[1]
-    if len( dnsapi_domain_data ) < 2:
-        logging.error( "DNS API route53: domain data does not contain required data" )
+    change = add_change( dnsapi_domain_data, key_data )
+    if change is None:
         return False,
-    region = dnsapi_domain_data[0]
-    zone_id = dnsapi_domain_data[1]
-    if len( dnsapi_domain_data ) > 2:
-        try:
-            ttl = int( dnsapi_domain_data[2] )
-            if ttl < 5:
-                ttl = 5
-        except Exception:
-            ttl = 3600
+    if debugging:
+        return True,
+    if not resolve_zone( dnsapi_data, change, session ):
+        return False,
+
+    change_id = send_changes( dnsapi_data, change['region'], change['zone_id'], [change], session )
+    if change_id is None or change_id not in wait_for_changes( dnsapi_data, { change_id: change['region'] }, session ):
+        return False,
+    return True, key_data['domain'], change['selector'], datetime.datetime.utcnow(), change_id, change['data']
+
+
+def delete(dnsapi_data, dnsapi_domain_data, record_data, debugging = False, session = requests ):
+    if len(dnsapi_data) < 2:
+        logging.error("DNS API route53: AWS key not configured")
+        return False
+    change = delete_change( dnsapi_domain_data, record_data )
+    if change is None:
+        return False
+    if debugging:
+        return True
+    if not resolve_zone( dnsapi_data, change, session ):
+        return False
+
+    change_id = send_changes( dnsapi_data, change['region'], change['zone_id'], [change], session )
+    return change_id is not None and change_id in wait_for_changes( dnsapi_data, { change_id: change['region'] },
+                                                                     session )
+
+
+# Applies a list of add and delete operations (see ModuleInterface.md). All the changes for
+# the same hosted zone are sent together in as few ChangeResourceRecordSets requests as the
+# Route 53 limits allow, then all the changes are waited for at once. Returns the list of
+# results, one per operation, in the same form add() and delete() return them.
+def batch( dnsapi_data, operations, debugging = False, session = requests ):
+    results = [None] * len( operations )
+    change_ids = { }  # Key = operation index, Value = ID of the change that carried it out
+    zones = collections.OrderedDict()  # Key = (region, zone ID), Value = list of (operation index, change)
+    for i, operation in enumerate( operations ):
+        if operation[0] == 'add':
+            change = add_change( operation[1], operation[2] ) if len( dnsapi_data ) >= 2 else None
+            results[i] = (False,) if change is None else (True,)
+        else:
+            change = delete_change( operation[1], operation[2] ) if len( dnsapi_data ) >= 2 else None
+            results[i] = change is not None
+        if change is not None and not debugging and not resolve_zone( dnsapi_data, change, session ):
+            results[i] = (False,) if operation[0] == 'add' else False
+            change = None
+        if change is not None and not debugging:
+            zones.setdefault( (change['region'], change['zone_id']), [] ).append( (i, change) )
+    if len( dnsapi_data ) < 2:
+        logging.error( "DNS API route53: AWS key not configured" )
+
+    for zone, zone_changes in zones.items():
+        for changes in split_changes( zone_changes ):
+            change_id = send_changes( dnsapi_data, zone[0], zone[1], [change for i, change in changes], session )
+            if change_id is None and len( changes ) > 1:
+                # The whole batch is rejected if any one change in it is bad, so fall back to
+                # sending the changes one at a time to find out which ones can be applied.
+                logging.warning( "DNS API route53: batch of %d changes failed, retrying them separately",
+                                 len( changes ) )
+                for i, change in changes:
+                    change_ids[i] = send_changes( dnsapi_data, zone[0], zone[1], [change], session )
+                    set_result( results, i, change, change_ids[i] )
+            else:
+                for i, change in changes:
+                    change_ids[i] = change_id
+                    set_result( results, i, change, change_id )
+
+    regions = dict( [(change_ids[i], change['region']) for zone_changes in zones.values()
+                     for i, change in zone_changes if change_ids.get( i ) is not None] )
+    in_sync = wait_for_changes( dnsapi_data, regions, session )
+    for i, change_id in change_ids.items():
+        if change_id is not None and change_id not in in_sync:
+            results[i] = (False,) if operations[i][0] == 'add' else False
+    return results
+
+
+# Polls GetChange for changes until they're all INSYNC or change_timeout seconds have gone
+# by. Each round polls every change still pending at the same time, then waits before the
+# next round, longer each time. changes is a dict of change ID and the region its request
+# was signed for. Returns the set of IDs of the changes that reached INSYNC.
+def wait_for_changes( dnsapi_data, changes, session = requests ):
+    pending = dict( changes )
+    in_sync = set()
+    deadline = time.monotonic() + change_timeout
+    interval = change_poll_interval
+    with concurrent.futures.ThreadPoolExecutor( max_workers = change_poll_jobs ) as executor:
+        while len( pending ) > 0:
+            change_ids = list( pending.keys() )
+            polls = executor.map( lambda change_id: get_change_status( dnsapi_data, pending[change_id], change_id,
+                                                                       session ), change_ids )
+            for change_id, status in zip( change_ids, polls ):
+                if status == 'INSYNC':
+                    in_sync.add( change_id )
+                if status != 'PENDING':
+                    del pending[change_id]
+            remaining = deadline - time.monotonic()
+            if len( pending ) == 0 or remaining <= 0:
+                break
+            time.sleep( min( interval, remaining ) )
+            interval = min( interval * 2, change_poll_max_interval )
+    for change_id in pending:
+        logging.error( "DNS API route53: change %s still pending after %d seconds", change_id, change_timeout )
+    return in_sync
+
+
+# Returns the status of a change (PENDING or INSYNC), or None if it couldn't be found out
+def get_change_status( dnsapi_data, region, change_id, session = requests ):
+    if not change_id.startswith( '/' ):
+        change_id = '/change/' + change_id
+    resp = session.get( "https://route53.amazonaws.com/2013-04-01" + change_id,
+                        auth = get_signer( dnsapi_data[0], dnsapi_data[1], region ) )
+    logging.info( "HTTP status: %d", resp.status_code )
+    if resp.status_code != requests.codes.ok:
+        logging.error( "DNS API route53: HTTP error %d : %s", resp.status_code, get_error( resp ) )
+        return None
+    for tag, element in iter_elements( resp, ('Status',) ):
+        return element.text
+    logging.error( "DNS API route53: cannot find status of change %s in response", change_id )
+    return None
+
+
+# Lists the DKIM TXT records for the domain. Route 53 lists record sets in DNS order, so
+# listing starts at _domainkey.<domain> and stops at the first name that isn't under it,
+# following NextRecordName from one page to the next. Each value of a record set is a
+# separate record. Route 53 doesn't say when a record was created or give it an ID, so
+# records are treated as created now and get "-" in place of the change ID. Returns a list
+# of records in the same form add() returns them (without the success flag), or None if
+# they couldn't be listed.
+def list_records( dnsapi_data, dnsapi_domain_data, domain, debugging = False, session = requests ):
+    if len( dnsapi_data ) < 2:
+        logging.error( "DNS API route53: AWS key not configured" )
+        return None
+    region = get_region( dnsapi_domain_data )
+    zone_id = get_zone_field( dnsapi_domain_data )
+    if zonecache.wants_lookup( zone_id ):
+        zone_id = get_zone_id( dnsapi_data, region, domain, session )
+        if zone_id is None:
+            return None
+    aws4_auth = get_signer( dnsapi_data[0], dnsapi_data[1], region )
+    endpoint = "https://route53.amazonaws.com/2013-04-01/hostedzone/{0}/rrset".format( zone_id )
+    suffix = '._domainkey.' + domain.rstrip( '.' ) + '.'
+    now = datetime.datetime.utcnow()
+    records = []
+    params = { 'name': suffix[1:], 'type': 'TXT', 'maxitems': str( list_max_items ) }
+    while params is not None:
+        resp = session.get( endpoint, params = params, auth = aws4_auth, stream = True )
+        logging.info( "HTTP status: %d", resp.status_code )
+        if resp.status_code != requests.codes.ok:
+            logging.error( "DNS API route53: HTTP error %d : %s", resp.status_code, get_error( resp ) )
+            return None
+        params = None
+        page = { }
+        for tag, element in iter_elements( resp, ('ResourceRecordSet', 'IsTruncated', 'NextRecordName',
+                                                  'NextRecordType') ):
+            if tag != 'ResourceRecordSet':
+                page[tag] = element.text or ''
+                continue
+            name = get_child_text( element, 'Name' )
+            if name == suffix[1:]:
+                continue
+            if not name.endswith( suffix ):
+                page['past_end'] = True
+                break
+            if get_child_text( element, 'Type' ) != 'TXT':
+                continue
+            for value in element.iter( '{' + xml_namespace + '}Value' ):
+                records.append( (domain, name[:-len( suffix )], now, '-') + tuple( (value.text or '').split() ) )
+        resp.close()
+        if page.get( 'past_end' ) is None and page.get( 'IsTruncated' ) == 'true':
+            params = { 'name': page.get( 'NextRecordName' ), 'type': page.get( 'NextRecordType' ),
+                       'maxitems': str( list_max_items ) }
+    return records
+
+
+# Text of the first child element with the tag name (without the namespace), '' if there
+# isn't one
+def get_child_text( element, tag_name ):
+    child = element.find( '{' + xml_namespace + '}' + tag_name )
+    if child is None:
+        child = element.find( tag_name )
+    if child is None or child.text is None:
+        return ''
+    return child.text
+
+
+# Splits a hosted zone's list of (operation index, change) into batches no larger than a
+# single ChangeResourceRecordSets request will accept.
+def split_changes( zone_changes ):
+    batches = []
+    changes = []
+    value_length = 0
+    for i, change in zone_changes:
+        if len( changes ) > 0 and (len( changes ) >= max_batch_records or
+                                   value_length + len( change['data'] ) > max_batch_value_length):
+            batches.append( changes )
+            changes = []
+            value_length = 0
+        changes.append( (i, change) )
+        value_length += len( change['data'] )
+    if len( changes ) > 0:
+        batches.append( changes )
+    return batches
+
+
+def set_result( results, i, change, change_id ):
+    if change['action'] == 'CREATE':
+        if change_id is None:
+            results[i] = False,
+        else:
+            results[i] = True, change['domain'], change['selector'], datetime.datetime.utcnow(), change_id, \
+                         change['data']
     else:
-        ttl = 3600
+        results[i] = change_id is not None
+
+
+# Returns the change that creates the record for key_data, or None if the information
+# needed is missing.
+def add_change( dnsapi_domain_data, key_data ):
     try:
         selector = key_data['selector']
         data = key_data['chunked']
         domain_suffix = key_data['domain']
     except KeyError as e:
         logging.error( "DNS API route53: required information not present: %s", str( e ) )
-        return False,
-    if debugging:
-        return True,
+        return None
+    return { 'action': 'CREATE', 'region': get_region( dnsapi_domain_data ),
+             'zone_id': get_zone_field( dnsapi_domain_data ),
+             'ttl': get_ttl( dnsapi_domain_data ), 'selector': selector, 'domain': domain_suffix, 'data': data }
 
-    aws4_auth = AWS4Auth( aws_key_id, aws_key, region, 'route53' )
 
-    # Construct Route53 XML for the ChangeResourceRecordSets request
-    route53_xml = create_xml( 'CREATE', selector, domain_suffix, ttl, data )
+# Returns the change that deletes the record described by record_data, or None if the
+# information needed is missing.
+def delete_change(dnsapi_domain_data, record_data):
+    if len(record_data) < 5:
+        logging.error("DNS API route53: saved record does not contain required data")
+        return None
+    domain_suffix = record_data[0]
+    selector = record_data[1]
+    data = ' '.join( record_data[4:] )
+    return { 'action': 'DELETE', 'region': get_region( dnsapi_domain_data ),
+             'zone_id': get_zone_field( dnsapi_domain_data ),
+             'ttl': get_ttl( dnsapi_domain_data ), 'selector': selector, 'domain': domain_suffix, 'data': data }
 
-    endpoint = "https://route53.amazonaws.com/2013-04-01/hostedzone/{0}/rrset".format(zone_id)
-    headers = {'Content-Type': 'text/xml; charset=utf-8'}
-    resp = requests.post(endpoint, data = route53_xml, auth = aws4_auth, headers = headers)
-    logging.info("HTTP status: %d", resp.status_code)
 
-    if resp.status_code == requests.codes.ok:
-        doc = xml.dom.minidom.parseString(resp.text)
-        id = doc.getElementsByTagName('Id')
-        if id:
-            result = True, key_data['domain'], selector, datetime.datetime.utcnow(), \
-                     get_text( id.item( 0 ).childNodes ), data
-        else:
-            logging.error("DNS API route53: cannot find ID in response")
-            result = False,
-    else:
-        result = False,
-        error_text = get_error(resp)
-        logging.error("DNS API route53: HTTP error %d : %s", resp.status_code, error_text)
-        if error_text == '':
-            logging.error("DNS API route53: error response body:\n%s", resp.text)
+def get_region( dnsapi_domain_data ):
+    if len( dnsapi_domain_data ) > 0 and dnsapi_domain_data[0]:
+        return dnsapi_domain_data[0]
+    return default_region
 
-    return result
 
+# The hosted zone ID from the domain data, None if it isn't given
+def get_zone_field( dnsapi_domain_data ):
+    if len( dnsapi_domain_data ) > 1:
+        return dnsapi_domain_data[1]
+    return None
 
-def delete(dnsapi_data, dnsapi_domain_data, record_data, debugging = False):
-    if len(dnsapi_data) < 2:
-        logging.error("DNS API route53: AWS key not configured")
-        return False
-    aws_key_id = dnsapi_data[0]
-    aws_key = dnsapi_data[1]
-    if len(dnsapi_domain_data) < 2:
-        logging.error("DNS API route53: domain data does not contain required data")
-        return False
-    region = dnsapi_domain_data[0]
-    zone_id = dnsapi_domain_data[1]
-    if len(dnsapi_domain_data) > 2:
+
+# Fills in a change's hosted zone ID if the domain data doesn't have one or has "auto",
+# looking it up from the domain name (see zonecache.py). Returns False if there's no hosted
+# zone for the domain.
+def resolve_zone( dnsapi_data, change, session = requests ):
+    if not zonecache.wants_lookup( change['zone_id'] ):
+        return True
+    change['zone_id'] = get_zone_id( dnsapi_data, change['region'], change['domain'], session )
+    return change['zone_id'] is not None
+
+
+def get_zone_id( dnsapi_data, region, domain, session = requests ):
+    return zonecache.lookup( 'route53', dnsapi_data[:2], domain,
+                             lambda: list_hosted_zones( dnsapi_data, region, session ) )
+
+
+# Lists every public hosted zone in the account. ListHostedZones pages are chained by
+# NextMarker, each page only says where the next one starts, so they have to be fetched
+# one after another. Private zones are left out, their records aren't visible to anyone
+# checking DKIM signatures. Returns a dict of zone name and hosted zone ID, or None if the
+# zones couldn't be listed.
+def list_hosted_zones( dnsapi_data, region, session = requests ):
+    aws4_auth = get_signer( dnsapi_data[0], dnsapi_data[1], region )
+    zones = { }
+    params = { 'maxitems': str( zones_max_items ) }
+    while params is not None:
+        resp = session.get( "https://route53.amazonaws.com/2013-04-01/hostedzone", params = params,
+                            auth = aws4_auth, stream = True )
+        logging.info( "HTTP status: %d", resp.status_code )
+        if resp.status_code != requests.codes.ok:
+            logging.error( "DNS API route53: HTTP error %d : %s", resp.status_code, get_error( resp ) )
+            return None
+        page = { }
+        for tag, element in iter_elements( resp, ('HostedZone', 'IsTruncated', 'NextMarker') ):
+            if tag != 'HostedZone':
+                page[tag] = element.text or ''
+                continue
+            config = element.find( '{' + xml_namespace + '}Config' )
+            if config is not None and get_child_text( config, 'PrivateZone' ) == 'true':
+                continue
+            zone_id = get_child_text( element, 'Id' )
+            if zone_id.startswith( '/hostedzone/' ):
+                zone_id = zone_id[len( '/hostedzone/' ):]
+            zones[get_child_text( element, 'Name' ).rstrip( '.' ).lower()] = zone_id
+        params = None
+        if page.get( 'IsTruncated' ) == 'true':
+            params = { 'maxitems': str( zones_max_items ), 'marker': page.get( 'NextMarker' ) }
+    return zones
+
+
+def get_ttl( dnsapi_domain_data ):
+    if len( dnsapi_domain_data ) > 2:
         try:
-            ttl = int(dnsapi_domain_data[2])
+            ttl = int( dnsapi_domain_data[2] )
             if ttl < 5:
                 ttl = 5
         except Exception:
             ttl = 3600
     else:
         ttl = 3600
-    if len(record_data) < 5:
-        logging.error("DNS API route54: saved record does not contain required data")
-        return False
-    try:
-        domain_suffix = record_data[0]
-        selector = record_data[1]
-        data = ' '.join( record_data[4:] )
-    except KeyError as e:
-        logging.error("DNS API route53: required information not present: %s", str(e))
-        return False
-    if debugging:
-        return True
+    return ttl
+
 
-    aws4_auth = AWS4Auth(aws_key_id, aws_key, region, 'route53')
+# Sends a ChangeResourceRecordSets request with a list of changes for one hosted zone.
+# Returns the ID of the change, or None if the request failed.
+def send_changes( dnsapi_data, region, zone_id, changes, session = requests ):
+    aws4_auth = get_signer( dnsapi_data[0], dnsapi_data[1], region )
 
     # Construct Route53 XML for the ChangeResourceRecordSets request
-    route53_xml = create_xml( 'DELETE', selector, domain_suffix, ttl, data )
+    route53_xml = create_xml( changes )
 
     endpoint = "https://route53.amazonaws.com/2013-04-01/hostedzone/{0}/rrset".format(zone_id)
     headers = {'Content-Type': 'text/xml; charset=utf-8'}
-    resp = requests.post(endpoint, data = route53_xml, auth = aws4_auth, headers = headers)
+    resp = session.post(endpoint, data = route53_xml, auth = aws4_auth, headers = headers)
     logging.info("HTTP status: %d", resp.status_code)
 
     if resp.status_code == requests.codes.ok:
-        doc = xml.dom.minidom.parseString(resp.text)
-        id = doc.getElementsByTagName('Id')
-        if id:
-            result = True
-        else:
+        change_id = None
+        for tag, element in iter_elements( resp, ('Id',) ):
+            change_id = element.text
+            break
+        if change_id is None:
             logging.error("DNS API route53: cannot find ID in response")
-            result = False
     else:
-        result = False
+        change_id = None
         error_text = get_error(resp)
         logging.error("DNS API route53: HTTP error %d : %s", resp.status_code, error_text)
         if error_text == '':
             logging.error("DNS API route53: error response body:\n%s", resp.text)
 
-    return result
+    return change_id
 
 
-def create_xml( action_str, selector, domain_suffix, ttl, data ):
-    # Construct Route53 XML for the ChangeResourceRecordSets request
-    impl = xml.dom.minidom.getDOMImplementation()
-    doc = impl.createDocument( 'https://route53.amazonaws.com/doc/2013-04-01/',
-                               'ChangeResourceRecordSetsRequest', None )
-    root = doc.documentElement
-    root.setAttribute('xmlns', 'https://route53.amazonaws.com/doc/2013-04-01/')
-    chg_batch = doc.createElement('ChangeBatch')
-    root.appendChild(chg_batch)
-    changes = doc.createElement('Changes')
-    chg_batch.appendChild(changes)
-    change = doc.createElement('Change')
-    changes.appendChild(change)
-    action = doc.createElement('Action')
-    action_text = doc.createTextNode(action_str)
-    action.appendChild(action_text)
-    change.appendChild(action)
-    rrset = doc.createElement('ResourceRecordSet')
-    change.appendChild(rrset)
-    name = doc.createElement('Name')
-    name_text = doc.createTextNode(selector + '._domainkey.' + domain_suffix)
-    name.appendChild(name_text)
-    rrset.appendChild(name)
-    rrtype = doc.createElement('Type')
-    rrtype_text = doc.createTextNode('TXT')
-    rrtype.appendChild(rrtype_text)
-    rrset.appendChild(rrtype)
-    rrttl = doc.createElement('TTL')
-    rrttl_text = doc.createTextNode(str(ttl))
-    rrttl.appendChild(rrttl_text)
-    rrset.appendChild(rrttl)
-    rrs = doc.createElement('ResourceRecords')
-    rrset.appendChild(rrs)
-    rr = doc.createElement('ResourceRecord')
-    rrs.appendChild(rr)
-    value = doc.createElement('Value')
-    value_text = doc.createTextNode(data)
-    value.appendChild(value_text)
-    rr.appendChild(value)
-    route53_xml = doc.toxml('utf-8')
-    doc.unlink()  # Let things we don't need anymore be GC'd
-    return route53_xml
-
-
-def get_error( resp):
+# Returns the request signer for a region and set of credentials, creating it the first
+# time it's needed. requests_aws4auth is only imported once a request is signed.
+def get_signer( aws_key_id, aws_key, region ):
+    key = (region, aws_key_id, aws_key)
+    with signers_lock:
+        aws4_auth = signers.get( key )
+        if aws4_auth is None:
+            from requests_aws4auth import AWS4Auth
+            aws4_auth = signers[key] = AWS4Auth( aws_key_id, aws_key, region, 'route53' )
+    return aws4_auth
+
+
+# Changes are dicts with the action, selector, domain, ttl and data for the record. The
+# request is filled into a template, escaping the text that goes into it.
+def create_xml( changes ):
+    escape = xml.sax.saxutils.escape
+    body = ''.join( [change_template.format( action = escape( change['action'] ),
+                                             name = escape( change['selector'] + '._domainkey.' + change['domain'] ),
+                                             ttl = int( change['ttl'] ), value = escape( change['data'] ) )
+                     for change in changes] )
+    return request_template.format( body ).encode( 'utf-8' )
+
+
+# Parses an XML response a chunk at a time as it arrives, yielding (tag, element) for each
+# element whose tag (without the namespace) is one of tag_names once the element is
+# complete. Elements are cleared once they've been dealt with, so a large response never
+# has to be held in memory as a whole. Stops quietly if the response isn't valid XML.
+def iter_elements( resp, tag_names ):
+    parser = xml.etree.ElementTree.XMLPullParser( events = ('end',) )
     try:
-        doc = xml.dom.minidom.parseString(resp.text)
-        doc.normalize()
-        error_type = doc.getElementsByTagName('Type')
-        if error_type and error_type.length > 0:
-            error_type_text = get_text(error_type.item(0).childNodes)
-        else:
-            error_type_text = ''
-        code = doc.getElementsByTagName('Code')
-        if code and code.length > 0:
-            code_text = get_text(code.item(0).childNodes)
-        else:
-            code_text = ''
-        message = doc.getElementsByTagName('Message')
-        if message and message.length > 0:
-            message_text = get_text(message.item(0).childNodes)
-        else:
-            message_text = ''
-        error_text = error_type_text + ' : ' + code_text + ' : ' + message_text
-        doc.unlink()
-    except Exception as e:
-        logging.error("XML exception: %s", str(e))
-        error_text = ''
-    return error_text
-
-
-def get_text(nodelist):
-    rc = []
-    for node in nodelist:
-        if node.nodeType == node.TEXT_NODE:
-            rc.append( node.data )
-    return ''.join( rc )
+        for chunk in resp.iter_content( chunk_size = response_chunk_size ):
+            parser.feed( chunk )
+            for event, element in parser.read_events():
+                tag = element.tag.rpartition( '}' )[2]
+                if tag in tag_names:
+                    yield tag, element
+                    element.clear()
+        parser.close()
+    except xml.etree.ElementTree.ParseError as e:
+        logging.error( "XML exception: %s", str( e ) )
+
+
+def get_error( resp ):
+    error = { }
+    for tag, element in iter_elements( resp, ('Type', 'Code', 'Message') ):
+        error.setdefault( tag, element.text or '' )
+    if len( error ) == 0:
+        return ''
+    return error.get( 'Type', '' ) + ' : ' + error.get( 'Code', '' ) + ' : ' + error.get( 'Message', '' )
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, simulated DNS provider for load testing
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Requires:
+# Nothing
+
+# To use this module, add a 'sim' entry to dnsapi.ini. Instead of talking to a real DNS
+# provider it behaves like one: each add or delete is a simulated request that takes
+# time, can fail, and can be turned away when requests come in faster than the provider
+# allows. Records are kept in memory so a delete only succeeds for a record that exists,
+# and the client can list a domain's records (a page of list_page_size per request) for
+# genkeys.py --reconcile.
+# Settings are given as name=value fields after the 'sim', all optional:
+#
+# latency=<distribution> : Time each request takes, in milliseconds, one of
+#                          fixed:<ms>, uniform:<min>:<max>, normal:<mean>:<stddev>,
+#                          lognormal:<median>:<sigma> or exp:<mean>. Default none.
+# errors=<fraction>      : Fraction of requests that fail with an HTTP 500 error.
+# limit=<per second>     : Requests per second the provider accepts, requests beyond that
+#                          get an HTTP 429 response with a Retry-After header. Default no limit.
+# limit_burst=<count>    : Requests the provider accepts in a burst before limiting, default
+#                          the same as limit.
+# store=<filename>       : JSON file the records are loaded from and saved to, so they carry
+#                          over between runs. Each add and delete is appended to
+#                          <filename>.log as it happens, so runs that crash carry over too,
+#                          and the log is folded into the store file when the client is
+#                          closed. Without it, deleting a record the simulator hasn't seen is
+#                          assumed to be a record from before it started and succeeds.
+# seed=<number>          : Random number seed, for repeatable runs.
+#
+# Requests are counted by status and the counts are logged when the client is closed.
+# Requests go through ratelimit the same way HTTP requests to a real provider do, under
+# the API name the client was opened with, so the rate=, burst= and retries= options for
+# genkeys.py work with the simulator too.
+
+import builtins
+import collections
+import datetime
+import functools
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+import ratelimit
+
+# Records returned by each simulated list request
+list_page_size = 100
+
+simulators = { }  # Key = tuple of dnsapi_data, Value = Simulator, for module-level add/delete
+simulators_lock = threading.Lock()
+
+
+# Interface v2: the client shares the simulated provider with any module-level calls
+# using the same settings. Requests are paced under the configured API name.
+def open( dnsapi_data, debugging = False, dnsapi_name = 'sim' ):
+    return Client( dnsapi_data, dnsapi_name )
+
+
+class Client( object ):
+    def __init__( self, dnsapi_data, dnsapi_name = 'sim' ):
+        self.dnsapi_data = dnsapi_data
+        self.dnsapi_name = dnsapi_name
+        self.simulator = get_simulator( dnsapi_data )
+
+    def add( self, dnsapi_domain_data, key_data, debugging = False ):
+        return add( self.dnsapi_data, dnsapi_domain_data, key_data, debugging, self.simulator, self.dnsapi_name )
+
+    def delete( self, dnsapi_domain_data, record_data, debugging = False ):
+        return delete( self.dnsapi_data, dnsapi_domain_data, record_data, debugging, self.simulator,
+                       self.dnsapi_name )
+
+    def list_records( self, dnsapi_domain_data, domain, debugging = False ):
+        return list_records( self.dnsapi_data, dnsapi_domain_data, domain, debugging, self.simulator,
+                             self.dnsapi_name )
+
+    def close( self ):
+        self.simulator.save()
+        self.simulator.log_counts()
+
+
+# Simulated response to a request
+class Response( object ):
+    def __init__( self, status_code, body = None, headers = None ):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers if headers is not None else { }
+
+
+class Simulator( object ):
+    def __init__( self, dnsapi_data ):
+        settings = { }
+        for field in dnsapi_data:
+            name, sep, value = field.partition( '=' )
+            if sep:
+                settings[name] = value
+        self.random = random.Random( settings.get( 'seed' ) )
+        self.latency = parse_latency( settings.get( 'latency' ) )
+        self.error_rate = float( settings.get( 'errors', 0 ) )
+        self.limit = float( settings['limit'] ) if 'limit' in settings else None
+        self.limit_burst = float( settings.get( 'limit_burst', self.limit or 0 ) )
+        self.tokens = self.limit_burst
+        self.tokens_updated = time.monotonic()
+        self.store_filename = settings.get( 'store' )
+        self.records = { }  # Key = record ID, Value = [domain, selector, value, created]
+        self.domain_records = collections.defaultdict( set )  # Key = domain, Value = set of record IDs
+        self.next_id = 1
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.log_file = None
+        if self.store_filename:
+            self.load()
+
+    # Handles one request, returns a Response. Only the provider's bookkeeping is done
+    # while holding the lock, the simulated request time is spent without it so requests
+    # overlap the way they would with a real provider.
+    def request( self, method, domain, selector = None, value = None, record_id = None, page = 1 ):
+        delay = self.latency( self.random ) if self.latency is not None else 0.0
+        with self.lock:
+            response = self.check_limit()
+            if response is None and self.error_rate > 0 and self.random.random() < self.error_rate:
+                response = Response( 500, "Internal server error" )
+            if response is None:
+                if method == 'add':
+                    record_id = "sim-%d" % self.next_id
+                    self.next_id += 1
+                    self.records[record_id] = [domain, selector, value,
+                                               datetime.datetime.utcnow().strftime( '%Y-%m-%dT%H:%M:%S' )]
+                    self.domain_records[domain].add( record_id )
+                    self.log_change( { 'op': 'add', 'id': record_id, 'record': self.records[record_id] } )
+                    response = Response( 200, record_id )
+                elif method == 'list':
+                    record_ids = sorted( self.domain_records.get( domain, () ) )
+                    start = (page - 1) * list_page_size
+                    response = Response( 200, {
+                        'records': [[record_id] + self.records[record_id][1:]
+                                    for record_id in record_ids[start:start + list_page_size]],
+                        'total_pages': max( 1, (len( record_ids ) + list_page_size - 1) // list_page_size )
+                    } )
+                elif record_id in self.records:
+                    self.domain_records[self.records[record_id][0]].discard( record_id )
+                    del self.records[record_id]
+                    self.log_change( { 'op': 'delete', 'id': record_id } )
+                    response = Response( 200 )
+                elif self.store_filename:
+                    response = Response( 404, "Record %s not found" % record_id )
+                else:
+                    response = Response( 200 )
+            self.counts[(method, response.status_code)] += 1
+        if delay > 0:
+            time.sleep( delay )
+        return response
+
+    # Token bucket refilled at limit tokens per second. Returns a 429 response if there's
+    # no token for this request, None if it can go ahead.
+    def check_limit( self ):
+        if self.limit is None:
+            return None
+        now = time.monotonic()
+        self.tokens = min( self.limit_burst, self.tokens + (now - self.tokens_updated) * self.limit )
+        self.tokens_updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return None
+        retry_after = int( math.ceil( (1 - self.tokens) / self.limit ) )
+        return Response( 429, "Rate limit exceeded", { 'Retry-After': str( retry_after ) } )
+
+    def load( self ):
+        self.next_id, self.records = read_store( self.store_filename )
+        for record_id, record in self.records.items():
+            self.domain_records[record[0]].add( record_id )
+
+    # Appends a change to the store's log, called with the lock held. Each change is written
+    # out as it's made, so a run that dies doesn't leave the store behind the provider's
+    # state and the next run doesn't hand out record IDs that are already in use.
+    def log_change( self, change ):
+        if not self.store_filename:
+            return
+        try:
+            if self.log_file is None:
+                self.log_file = builtins.open( self.store_filename + '.log', 'a' )
+            self.log_file.write( json.dumps( change ) + '\n' )
+            self.log_file.flush()
+        except (IOError, OSError) as e:
+            logging.error( "DNS API sim: error writing store log %s.log: %s", self.store_filename, str( e ) )
+
+    # Writes the store file, if there is one, and removes the log of changes now folded into it
+    def save( self ):
+        if not self.store_filename:
+            return
+        with self.lock:
+            store = { 'next_id': self.next_id, 'records': self.records }
+            temp_filename = self.store_filename + '.new'
+            try:
+                with builtins.open( temp_filename, 'w' ) as store_file:
+                    json.dump( store, store_file )
+                os.rename( temp_filename, self.store_filename )
+                if self.log_file is not None:
+                    self.log_file.close()
+                    self.log_file = None
+                if os.path.exists( self.store_filename + '.log' ):
+                    os.remove( self.store_filename + '.log' )
+            except (IOError, OSError) as e:
+                logging.error( "DNS API sim: error writing store file %s: %s", self.store_filename, str( e ) )
+
+    def log_counts( self ):
+        with self.lock:
+            for (method, status), count in sorted( self.counts.items() ):
+                logging.info( "DNS API sim: %d %s requests returned %d", count, method, status )
+
+
+# Returns a function taking a random.Random and returning a request time in seconds, or
+# None if requests take no time. Raises ValueError for an invalid distribution.
+def parse_latency( text ):
+    if not text:
+        return None
+    parts = text.split( ':' )
+    kind = parts[0]
+    values = [float( x ) for x in parts[1:]]
+    if kind == 'fixed' and len( values ) == 1:
+        return lambda r: values[0] / 1000.0
+    elif kind == 'uniform' and len( values ) == 2:
+        return lambda r: r.uniform( values[0], values[1] ) / 1000.0
+    elif kind == 'normal' and len( values ) == 2:
+        return lambda r: max( 0.0, r.gauss( values[0], values[1] ) ) / 1000.0
+    elif kind == 'lognormal' and len( values ) == 2 and values[0] > 0:
+        mu = math.log( values[0] )
+        return lambda r: r.lognormvariate( mu, values[1] ) / 1000.0
+    elif kind == 'exp' and len( values ) == 1 and values[0] > 0:
+        return lambda r: r.expovariate( 1.0 / values[0] ) / 1000.0
+    raise ValueError( "invalid latency distribution %s" % text )
+
+
+# Reads a store file and replays its log of changes made since it was written. Returns
+# (next record ID number, records), where records is a dict with key = record ID, value =
+# [domain, selector, value, created]. A missing store file is an empty store, and a change
+# cut short by a crash at the end of the log is ignored.
+def read_store( filename ):
+    next_id = 1
+    records = { }
+    try:
+        with builtins.open( filename, 'r' ) as store_file:
+            store = json.load( store_file )
+        records = store.get( 'records', { } )
+        next_id = store.get( 'next_id', 1 )
+    except IOError:
+        pass
+    except ValueError as e:
+        logging.error( "DNS API sim: invalid store file %s: %s", filename, str( e ) )
+    try:
+        with builtins.open( filename + '.log', 'r' ) as log_file:
+            for line in log_file:
+                try:
+                    change = json.loads( line )
+                except ValueError:
+                    break
+                if change['op'] == 'add':
+                    records[change['id']] = change['record']
+                    next_id = max( next_id, int( change['id'].rpartition( '-' )[2] ) + 1 )
+                else:
+                    records.pop( change['id'], None )
+    except IOError:
+        pass
+    return next_id, records
+
+
+def get_simulator( dnsapi_data ):
+    key = tuple( dnsapi_data )
+    with simulators_lock:
+        simulator = simulators.get( key )
+        if simulator is None:
+            simulator = Simulator( dnsapi_data )
+            simulators[key] = simulator
+    return simulator
+
+
+def add( dnsapi_data, dnsapi_domain_data, key_data, debugging = False, simulator = None, dnsapi_name = 'sim' ):
+    try:
+        domain = key_data['domain']
+        selector = key_data['selector']
+        value = key_data['plain']
+    except KeyError as e:
+        logging.error( "DNS API sim: required information not present: %s", str( e ) )
+        return False,
+    if debugging:
+        return True,
+    if simulator is None:
+        try:
+            simulator = get_simulator( dnsapi_data )
+        except ValueError as e:
+            logging.error( "DNS API sim: %s", str( e ) )
+            return False,
+    response = ratelimit.call( dnsapi_name, functools.partial( simulator.request, 'add', domain, selector, value ),
+                               idempotent = False )
+    if response.status_code != 200:
+        log_error( "add", domain, selector, response )
+        return False,
+    return True, domain, selector, datetime.datetime.utcnow(), response.body
+
+
+def delete( dnsapi_data, dnsapi_domain_data, record_data, debugging = False, simulator = None, dnsapi_name = 'sim' ):
+    if len( record_data ) < 4:
+        logging.error( "DNS API sim: record data does not contain record ID" )
+        return False
+    domain = record_data[0]
+    selector = record_data[1]
+    record_id = record_data[3]
+    if debugging:
+        return True
+    if simulator is None:
+        try:
+            simulator = get_simulator( dnsapi_data )
+        except ValueError as e:
+            logging.error( "DNS API sim: %s", str( e ) )
+            return False
+    response = ratelimit.call( dnsapi_name,
+                               functools.partial( simulator.request, 'delete', domain, record_id = record_id ) )
+    if response.status_code != 200:
+        log_error( "delete", domain, selector, response )
+        return False
+    return True
+
+
+def log_error( operation, domain, selector, response ):
+    logging.error( "DNS API sim: HTTP error in %s for %s:%s", operation, domain, selector )
+    logging.error( "DNS API sim: error code %d", response.status_code )
+    if 'Retry-After' in response.headers:
+        logging.error( "DNS API sim: Retry-After %s", response.headers['Retry-After'] )
+    if response.body:
+        logging.error( "DNS API sim: response: %s", response.body )
+
+
+# Lists the domain's records a page at a time. Records from a store file written before
+# records had creation times are treated as created now.
+def list_records( dnsapi_data, dnsapi_domain_data, domain, debugging = False, simulator = None,
+                  dnsapi_name = 'sim' ):
+    if simulator is None:
+        try:
+            simulator = get_simulator( dnsapi_data )
+        except ValueError as e:
+            logging.error( "DNS API sim: %s", str( e ) )
+            return None
+    records = []
+    page = 1
+    while True:
+        response = ratelimit.call( dnsapi_name, functools.partial( simulator.request, 'list', domain, page = page ) )
+        if response.status_code != 200:
+            log_error( "list", domain, None, response )
+            return None
+        for record in response.body['records']:
+            created = record[3] if len( record ) > 3 else None
+            records.append( (domain, record[1], created or datetime.datetime.utcnow(), record[0]) )
+        if page >= response.body['total_pages']:
+            break
+        page += 1
+    return records
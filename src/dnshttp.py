@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, shared HTTP support for DNS API modules
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Uses the 'requests' package.
+
+# Not a DNS API module itself. DNS API modules that make HTTP requests use this to get
+# the session their client (see ModuleInterface.md) makes all its requests through.
+# Only requests through a Session are paced and retried. The modules' add and delete
+# functions called without a session use the requests package directly, and get neither.
+
+import functools
+
+import requests
+import requests.adapters
+
+import ratelimit
+
+# Maximum number of connections to a single API host kept open for reuse. This should be
+# at least as large as the number of domains updated through one API at the same time.
+pool_size = 32
+
+# Methods that can be repeated without changing the result
+idempotent_methods = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+# Session whose requests are paced and retried by ratelimit using the settings for the
+# DNS API it was created for.
+class Session( requests.Session ):
+    def __init__( self, dnsapi_name ):
+        super( Session, self ).__init__()
+        self.dnsapi_name = dnsapi_name
+
+    def request( self, method, url, *args, **kwargs ):
+        send = functools.partial( super( Session, self ).request, method, url, *args, **kwargs )
+        return ratelimit.call( self.dnsapi_name, send, method.upper() in idempotent_methods, transient_error )
+
+
+# Connection failures can always be retried if the connection was never made, anything
+# else (eg. the connection dropping while waiting for the response) only if the request
+# is idempotent since the provider may already have carried it out.
+def transient_error( e, idempotent ):
+    if isinstance( e, requests.exceptions.ConnectTimeout ):
+        return True
+    if isinstance( e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout) ):
+        return idempotent
+    return False
+
+
+# Creates a requests session. Connections (and their TLS sessions) are kept open and
+# reused for all the requests made through the session. If dnsapi_name is given, requests
+# are paced and retried according to that API's settings (see ratelimit.py).
+def new_session( dnsapi_name = None ):
+    if dnsapi_name is not None:
+        session = Session( dnsapi_name )
+    else:
+        session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter( pool_maxsize = pool_size )
+    session.mount( 'https://', adapter )
+    session.mount( 'http://', adapter )
+    return session
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, DNS API module registry
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Finds and loads DNS API modules. Modules are only loaded the first time an API is
+# asked for, so a run only pays for importing the modules (and the packages they use)
+# that its domains actually need, and a missing package for an unused API doesn't matter.
+#
+# The module for API X is dnsapi_X, found on the module search path as always (normally
+# the dnsapi_X.py file alongside genkeys.py). If there's no such module, installed
+# packages are checked for an entry point named X in the 'opendkim_genkeys.dnsapi' group,
+# which lets third-party DNS API modules be installed as ordinary packages:
+#
+#   [project.entry-points."opendkim_genkeys.dnsapi"]
+#   example = "example_dns.genkeys_module"
+
+import importlib
+import inspect
+import logging
+import threading
+
+entry_point_group = 'opendkim_genkeys.dnsapi'
+
+# Options for genkeys.py itself that can be given in dnsapi.ini as name=value fields
+# following the API name. They're removed before the fields are passed to the API module.
+#   concurrency: maximum number of domains updated through that API at the same time
+#   rate, burst, retries: request pacing and retries for the API, see ratelimit.py
+#   zone_cache_ttl: seconds the API's zone ID lookups are cached for, see zonecache.py
+option_names = ['concurrency', 'rate', 'burst', 'retries', 'zone_cache_ttl']
+
+modules = { }  # Key = DNS API name, Value = module, or None if it couldn't be loaded
+modules_lock = threading.Lock()
+
+
+# Returns the module for a DNS API, or None if there isn't one. Errors are only logged the
+# first time an API is asked for.
+def load( dnsapi_name ):
+    with modules_lock:
+        if dnsapi_name in modules:
+            return modules[dnsapi_name]
+        module = find_module( dnsapi_name )
+        modules[dnsapi_name] = module
+    return module
+
+
+# Separates the genkeys.py options (see option_names) from the API module's data in a
+# dnsapi.ini entry. Returns a tuple of the module data list and a dict of options.
+def split_options( fields ):
+    dnsapi_data = []
+    options = { }
+    for field in fields:
+        name, sep, value = field.partition( '=' )
+        if sep and name in option_names:
+            options[name] = value
+        else:
+            dnsapi_data.append( field )
+    return dnsapi_data, options
+
+
+def find_module( dnsapi_name ):
+    module_name = "dnsapi_" + dnsapi_name
+    try:
+        module = importlib.import_module( module_name )
+        logging.debug( "DNS API module %s loaded", dnsapi_name )
+        return module
+    except ImportError as e:
+        # Only a missing dnsapi_X means there's no local module, a missing package the
+        # module itself imports is an error in the module
+        if getattr( e, 'name', None ) != module_name:
+            logging.error( "Module %s for DNS API %s could not be loaded", module_name, dnsapi_name )
+            logging.error( "%s", str( e ) )
+            return None
+        not_found = e
+    entry_point = find_entry_point( dnsapi_name )
+    if entry_point is None:
+        logging.error( "Module %s for DNS API %s not found", module_name, dnsapi_name )
+        logging.info( "%s", str( not_found ) )
+        return None
+    try:
+        module = entry_point.load()
+    except Exception as e:
+        logging.error( "Module %s for DNS API %s could not be loaded", entry_point.value, dnsapi_name )
+        logging.error( "%s", str( e ) )
+        return None
+    logging.debug( "DNS API module %s loaded from %s", dnsapi_name, entry_point.value )
+    return module
+
+
+def find_entry_point( dnsapi_name ):
+    try:
+        import importlib.metadata
+    except ImportError:
+        return None
+    entry_points = importlib.metadata.entry_points()
+    if hasattr( entry_points, 'select' ):
+        candidates = entry_points.select( group = entry_point_group, name = dnsapi_name )
+    else:
+        candidates = [ep for ep in entry_points.get( entry_point_group, [] ) if ep.name == dnsapi_name]
+    for entry_point in candidates:
+        return entry_point
+    return None
+
+
+# Wraps a DNS API module that only has the original add and delete functions so it can be
+# used the same way as a client returned by open() in modules that support interface v2.
+class ModuleClient( object ):
+    def __init__( self, module, dnsapi_data ):
+        self.module = module
+        self.dnsapi_data = dnsapi_data
+
+    def add( self, dnsapi_domain_data, key_data, debugging = False ):
+        return self.module.add( self.dnsapi_data, dnsapi_domain_data, key_data, debugging )
+
+    def delete( self, dnsapi_domain_data, record_data, debugging = False ):
+        return self.module.delete( self.dnsapi_data, dnsapi_domain_data, record_data, debugging )
+
+    def close( self ):
+        pass
+
+
+# Returns a client for a DNS API module, opened with the module's open() function if it
+# has one (interface v2), otherwise wrapping the module's add and delete functions. The
+# API name is passed to open() if it takes a dnsapi_name argument. Returns None if the
+# module failed to open a client.
+def open_client( module, dnsapi_name, dnsapi_data, debugging = False ):
+    if not hasattr( module, 'open' ):
+        return ModuleClient( module, dnsapi_data )
+    try:
+        if 'dnsapi_name' in inspect.signature( module.open ).parameters:
+            return module.open( dnsapi_data, debugging, dnsapi_name = dnsapi_name )
+        return module.open( dnsapi_data, debugging )
+    except Exception as e:
+        logging.error( "Error opening DNS API %s", dnsapi_name )
+        logging.error( "%s", str( e ) )
+        return None
@@ -18,14 +18,32 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import base64
+import collections
+import concurrent.futures
 import datetime
-import glob
-import importlib
+import errno
+import functools
 import logging
+import multiprocessing
 import os
 import os.path
+import shutil
 import string
 import sys
+import tempfile
+import time
+import uuid
+import zlib
+
+import dnsregistry
+import keyfiles
+import metrics
+import updatedata
+
+# The modules for optional features (dbtables, journal, propagation, ratelimit, reconcile,
+# statedb and zonecache) are imported where they're used, so runs that don't use a
+# feature don't pay for loading it and whatever it imports.
 
 # Settings, edit as appropriate for your environment
 
@@ -45,16 +63,33 @@ never_update_dns = False
 domain_filename = 'domains.ini'
 dns_api_defs_filename = 'dnsapi.ini'
 dns_update_data_filename = 'dns_update_data.ini'
+key_table_filename = 'key.table'
+signing_table_filename = 'signing.table'
+key_db_filename = 'key.db'
+signing_db_filename = 'signing.db'
+journal_filename = 'genkeys.journal'
 
 VERSION = '1.5.1'
 
+# Key generation backends, opendkim-genkey or in-process
+keygen_backends = ['opendkim', 'native']
+# Maximum length of each quoted chunk of the public key TXT record
+txt_chunk_size = 250
+
 
 # Creates the private-key file, and the public-key txt-record file in chunked (BIND) form.
 # Returns a public key record dict, or None in the event of an error:
 #   selector: real selector value used if asked to avoid overwrites instead of failing
 #   plain:    unquoted unchunked data
 #   chunked:  BIND-format quoted chunked data
-def gen_key( target_name, selector, find_unused_selector = False ):
+# The key itself is created by the given backend, one of keygen_backends. The opendkim
+# backend's own output files are created in scratch_dir, which must not be shared with
+# any other gen_key() call running at the same time. If pool_key names a key pool entry
+# (see list_key_pool()) that pre-generated key is claimed instead, falling back to the
+# backend if another run claimed it first. The files are left under their pending names
+# (see install_key_files()).
+def gen_key( target_name, selector, find_unused_selector = False, scratch_dir = '.', backend = 'opendkim',
+             pool_key = None ):
     # Check for existence of resulting files and handle it
     suffix_list = ['']
     if find_unused_selector:
@@ -74,9 +109,65 @@ def gen_key( target_name, selector, find_unused_selector = False ):
     if real_selector != selector:
         logging.warning( "Avoided overwriting keys for %s by using selector %s", target_name, real_selector )
 
-    # Use the OpenDKIM tool to generate the key data files
+    # Pending files left by a run that died before journaling the key are of no use
+    private_key_filename = pending_filename( private_key_filename )
+    public_key_filename = pending_filename( public_key_filename )
+    for filename in [private_key_filename, public_key_filename]:
+        if os.path.exists( filename ):
+            logging.warning( "Removing incomplete key file %s", filename )
+            os.remove( filename )
+
+    chunks = None
+    if pool_key is not None:
+        chunks = claim_pool_key( pool_key, private_key_filename, public_key_filename )
+    if chunks is None:
+        if backend == 'native':
+            chunks = gen_native_key( private_key_filename )
+        else:
+            chunks = gen_opendkim_key( target_name, selector, private_key_filename, scratch_dir )
+        if chunks is None:
+            return None
+        write_txt_file = True
+    else:
+        write_txt_file = False
+    value = ''.join( chunks )
+    chunked_value = ' '.join( ['"' + chunk + '"' for chunk in chunks] )
+
+    if write_txt_file:
+        output_file = open( public_key_filename, 'w' )
+        output_file.write( chunked_value + '\n' )
+        output_file.close()
+
+    return { 'selector': real_selector, 'plain': value, 'chunked': chunked_value }
+
+
+# Key files are generated under pending names and only renamed into place once the key has
+# been journaled, so a run that dies never leaves key files behind that its journal
+# doesn't know about.
+def pending_filename( filename ):
+    return filename + '.new'
+
+
+# Renames a generated key's pending files into place, the .txt file first so a .key file
+# always means the pair is complete. Returns False if they couldn't be renamed.
+def install_key_files( target_name, selector ):
+    for filename in [target_name + "." + selector + ".txt", target_name + "." + selector + ".key"]:
+        try:
+            os.rename( pending_filename( filename ), filename )
+        except OSError as e:
+            logging.critical( "Cannot rename key file %s into place", pending_filename( filename ) )
+            logging.error( "%s", str( e ) )
+            return False
+    return True
+
+
+# Uses the OpenDKIM tool to generate the key data files, leaving the private key
+# in private_key_filename. Returns the list of TXT record chunks for the public key,
+# or None in the event of an error.
+def gen_opendkim_key( target_name, selector, private_key_filename, scratch_dir ):
     try:
-        wait_status = os.system( "opendkim-genkey -b 2048 -r -s " + selector + " -d " + target_name )
+        wait_status = os.system( "opendkim-genkey -b 2048 -r -D " + scratch_dir + " -s " + selector +
+                                 " -d " + target_name )
     except OSError as e:
         logging.critical( "Error running opendkim-genkey" )
         logging.error( "%s", str( e ) )
@@ -86,9 +177,12 @@ def gen_key( target_name, selector, find_unused_selector = False ):
         logging.critical( "Error status %d returned by opendkim-genkey", status )
         return None
 
+    genkey_private_filename = os.path.join( scratch_dir, selector + ".private" )
+    genkey_public_filename = os.path.join( scratch_dir, selector + ".txt" )
+
     # The private key always ends up as target_name.selector.key
     try:
-        os.rename( selector + ".private", private_key_filename )
+        os.rename( genkey_private_filename, private_key_filename )
     except OSError as e:
         logging.critical( "Cannot rename the private key file %s.private", selector )
         logging.error( "%s", str( e ) )
@@ -98,7 +192,7 @@ def gen_key( target_name, selector, find_unused_selector = False ):
 
     # Snarf in the public key file for processing
     try:
-        pubkey_file = open( selector + ".txt", 'r' )
+        pubkey_file = open( genkey_public_filename, 'r' )
     except IOError as e:
         logging.critical( "Error accessing the public key file %s.txt", selector )
         logging.error( "%s", str( e ) )
@@ -108,23 +202,36 @@ def gen_key( target_name, selector, find_unused_selector = False ):
     if len( input_text ) <= 0:
         logging.critical( "No input found" )
         return None
+    chunks = parse_txt_chunks( input_text )
+
+    # Clean up the file opendkim-genkey created, we don't need it anymore
+    try:
+        os.remove( genkey_public_filename )
+    except OSError as e:
+        logging.error( "Could not delete origin file %s.txt", selector )
+        logging.error( "%s", str( e ) )
+        return None
+
+    return chunks
+
 
+# Extracts the quoted chunks of TXT record data from BIND-format text. Returns the
+# list of chunks without their quotes, or None if no record data could be found.
+def parse_txt_chunks( input_text ):
     # Find the first double-quote, and the double-quote after it. If we can't
     # find the first one, we're either done (if we processed at least one chunk
     # of data) or we have a syntax problem. If we can't find the second one, we
     # definitely have a syntax problem. If we found both, extract the chunk of
-    # data between them and add it to the accumulated key data value (with or
-    # without the enclosing quotes and spacing depending on the format). Repeat
-    # until we can't find an opening double-quote.
-    value = ''
-    chunked_value = ''
+    # data between them and add it to the list of chunks. Repeat until we can't
+    # find an opening double-quote.
+    chunks = []
     start = 0
     while start >= 0:
         first_quote = input_text.find( '"', start )
         if first_quote >= start:
             second_quote = input_text.find( '"', first_quote + 1 )
         else:
-            if len( value ) == 0:
+            if len( chunks ) == 0:
                 # Error, we couldn't find the start
                 logging.critical( "Cannot find start of DNS record value" )
                 return None
@@ -132,35 +239,220 @@ def gen_key( target_name, selector, find_unused_selector = False ):
                 # We're done when we can't find the start of the next chunk
                 break
         if second_quote >= 0:
-            # Unchunked form
-            value += input_text[first_quote + 1:second_quote]
-            # Chunked form
-            if len( chunked_value ) > 0:
-                chunked_value += ' '
-            chunked_value += input_text[first_quote:second_quote + 1]
+            chunks.append( input_text[first_quote + 1:second_quote] )
             start = second_quote + 1
         else:
             logging.error( "Syntax error in record data: no closing quote found" )
             break
 
     # We should've found at least one chunk of key data
-    if len( value ) == 0:
+    if len( ''.join( chunks ) ) == 0:
         logging.critical( "No DNS record value found" )
         return None
+    return chunks
 
-    output_file = open( public_key_filename, 'w' )
-    output_file.write( chunked_value + '\n' )
-    output_file.close()
 
-    # Clean up the file opendkim-genkey created, we don't need it anymore
+# Generates the RSA key in-process and writes it to private_key_filename. Returns the
+# list of TXT record chunks for the public key in the same form opendkim-genkey uses,
+# or None in the event of an error.
+def gen_native_key( private_key_filename ):
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+    except ImportError as e:
+        logging.critical( "The native key generator requires the 'cryptography' package" )
+        logging.error( "%s", str( e ) )
+        return None
+
+    private_key = rsa.generate_private_key( public_exponent = 65537, key_size = 2048 )
+    private_pem = private_key.private_bytes( serialization.Encoding.PEM,
+                                             serialization.PrivateFormat.TraditionalOpenSSL,
+                                             serialization.NoEncryption() )
+    public_der = private_key.public_key().public_bytes( serialization.Encoding.DER,
+                                                        serialization.PublicFormat.SubjectPublicKeyInfo )
+
     try:
-        os.remove( selector + ".txt" )
+        fd = os.open( private_key_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600 )
+        with os.fdopen( fd, 'wb' ) as private_key_file:
+            private_key_file.write( private_pem )
     except OSError as e:
-        logging.error( "Could not delete origin file %s.txt", selector )
+        logging.critical( "Cannot write the private key file %s", private_key_filename )
         logging.error( "%s", str( e ) )
         return None
 
-    return { 'selector': real_selector, 'plain': value, 'chunked': chunked_value }
+    # Same tags, in the same order, as opendkim-genkey -r: h=sha256 since the key is only for
+    # rsa-sha256 signatures and s=email since it's restricted to email. The key is split
+    # into chunks of txt_chunk_size characters.
+    key_text = 'p=' + base64.b64encode( public_der ).decode( 'ascii' )
+    chunks = ['v=DKIM1; h=sha256; k=rsa; s=email; ']
+    for i in range( 0, len( key_text ), txt_chunk_size ):
+        chunks.append( key_text[i:i + txt_chunk_size] )
+    return chunks
+
+
+# Runs gen_key() in a process pool worker. Every call gets a private scratch
+# directory under the working directory so parallel opendkim-genkey runs don't
+# overwrite each other's <selector>.private and <selector>.txt files.
+# Returns the key data from gen_key() and the time taken to generate the key.
+def gen_key_worker( target_name, selector, find_unused_selector, backend, pool_key ):
+    start = time.perf_counter()
+    scratch_dir = tempfile.mkdtemp( prefix = '.genkeys-', dir = '.' )
+    try:
+        return gen_key( target_name, selector, find_unused_selector, scratch_dir, backend,
+                        pool_key ), time.perf_counter() - start
+    finally:
+        shutil.rmtree( scratch_dir, True )
+
+
+# Generates one key per key name, using up to jobs worker processes. Returns
+# the keys dict (key = key name, value = key data dict from gen_key()) filled
+# in key_names order, or None if generating any key failed. If pool_dir is given,
+# spare keys from that key pool are used before generating any new ones. If key_times is
+# given, the time taken to generate each key is added to it. If on_key is given, it's
+# called with the key name and key data as soon as each key has been generated, before
+# its files are renamed into place.
+def gen_keys( key_names, selector, find_unused_selector = False, jobs = 1, backend = 'opendkim', pool_dir = None,
+              key_times = None, on_key = None ):
+    if key_times is None:
+        key_times = { }
+    keys = { }
+    # The pool is only listed once, each key name is handed its own entry to claim
+    pool_keys = []
+    if pool_dir is not None:
+        pool_keys = list_key_pool( pool_dir )
+        logging.info( "%d spare keys available in key pool %s", len( pool_keys ), pool_dir )
+    pool_keys = pool_keys[:len( key_names )]
+    pool_keys += [None] * (len( key_names ) - len( pool_keys ))
+
+    if jobs <= 1:
+        for target, pool_key in zip( key_names, pool_keys ):
+            logging.info( "Generating key %s", target )
+            start = time.perf_counter()
+            key_data = gen_key( target, selector, find_unused_selector, '.', backend, pool_key )
+            key_times[target] = time.perf_counter() - start
+            if key_data is None:
+                logging.critical( "    Error generating key %s", target )
+                return None
+            keys[target] = key_data
+            if on_key is not None:
+                on_key( target, key_data )
+            if not install_key_files( target, key_data['selector'] ):
+                return None
+        return keys
+
+    # The main program runs at module level, so workers must be forked rather
+    # than spawned to avoid re-running it in every worker.
+    executor = concurrent.futures.ProcessPoolExecutor( max_workers = jobs,
+                                                       mp_context = multiprocessing.get_context( 'fork' ) )
+    try:
+        futures = []
+        for target, pool_key in zip( key_names, pool_keys ):
+            logging.info( "Generating key %s", target )
+            futures.append( (target, executor.submit( gen_key_worker, target, selector, find_unused_selector,
+                                                      backend, pool_key )) )
+        # Collect results in submission order so the outcome doesn't depend on
+        # which worker finishes first.
+        for target, future in futures:
+            try:
+                key_data, key_times[target] = future.result()
+            except Exception as e:
+                logging.error( "%s", str( e ) )
+                key_data = None
+            if key_data is None:
+                logging.critical( "    Error generating key %s", target )
+                executor.shutdown( wait = True, cancel_futures = True )
+                return None
+            keys[target] = key_data
+            if on_key is not None:
+                on_key( target, key_data )
+            if not install_key_files( target, key_data['selector'] ):
+                executor.shutdown( wait = True, cancel_futures = True )
+                return None
+    finally:
+        executor.shutdown( wait = True )
+    return keys
+
+
+# Key pool entries are pairs of files <pool_dir>/<id>.key and <pool_dir>/<id>.txt. While
+# being generated they're named <id>.new.key and <id>.new.txt, and the .txt file is always
+# put in place before the .key file so any entry with a .key file is complete. Returns the
+# list of complete entries as <pool_dir>/<id> paths.
+def list_key_pool( pool_dir ):
+    pool_keys = []
+    try:
+        for entry in os.scandir( pool_dir ):
+            name = entry.name
+            if name.endswith( '.key' ) and name.count( '.' ) == 1:
+                pool_keys.append( os.path.join( pool_dir, name[:-4] ) )
+    except OSError as e:
+        logging.warning( "Error accessing key pool %s", pool_dir )
+        logging.warning( "%s", str( e ) )
+        return []
+    pool_keys.sort()
+    return pool_keys
+
+
+# Claims a key pool entry by renaming its files to the given key file names. The rename of
+# the .key file is the claim, so two runs can never get the same key. Returns the list of
+# TXT record chunks for the claimed key, or None if it couldn't be claimed.
+def claim_pool_key( pool_key, private_key_filename, public_key_filename ):
+    try:
+        os.rename( pool_key + '.key', private_key_filename )
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            logging.warning( "Cannot claim key pool entry %s", pool_key )
+            logging.warning( "%s", str( e ) )
+        return None
+    try:
+        os.rename( pool_key + '.txt', public_key_filename )
+        pubkey_file = open( public_key_filename, 'r' )
+        input_text = pubkey_file.read()
+        pubkey_file.close()
+    except (IOError, OSError) as e:
+        logging.error( "Error accessing the public key file for key pool entry %s", pool_key )
+        logging.error( "%s", str( e ) )
+        input_text = ''
+    chunks = None
+    if len( input_text ) > 0:
+        chunks = parse_txt_chunks( input_text )
+    if chunks is None:
+        # Unusable entry, put the files out of the way so we can generate a key normally
+        for filename, suffix in [(private_key_filename, '.key'), (public_key_filename, '.txt')]:
+            if os.path.exists( filename ):
+                os.rename( filename, pool_key + '.bad' + suffix )
+    return chunks
+
+
+# Generates spare keys into the key pool directory until it holds target_size complete
+# entries. Returns False if generating any of the keys failed.
+def fill_key_pool( pool_dir, target_size, jobs = 1, backend = 'opendkim' ):
+    if not os.path.isdir( pool_dir ):
+        try:
+            os.makedirs( pool_dir )
+        except OSError as e:
+            logging.critical( "Cannot create key pool %s", pool_dir )
+            logging.error( "%s", str( e ) )
+            return False
+    available = len( list_key_pool( pool_dir ) )
+    logging.info( "%d spare keys available in key pool %s", available, pool_dir )
+    if available >= target_size:
+        return True
+
+    pool_keys = []
+    for i in range( target_size - available ):
+        pool_keys.append( os.path.join( pool_dir, uuid.uuid4().hex ) )
+    if gen_keys( pool_keys, 'new', False, jobs, backend ) is None:
+        return False
+    for pool_key in pool_keys:
+        try:
+            os.rename( pool_key + '.new.txt', pool_key + '.txt' )
+            os.rename( pool_key + '.new.key', pool_key + '.key' )
+        except OSError as e:
+            logging.critical( "Cannot add key %s to key pool", pool_key )
+            logging.error( "%s", str( e ) )
+            return False
+    logging.info( "Added %d keys to key pool %s", len( pool_keys ), pool_dir )
+    return True
 
 
 def process_ini_file( filename, critical = True ):
@@ -196,48 +488,254 @@ def fields_to_line( fields ):
     return line
 
 
-def write_ini_file( filename, records ):
+# Updates DNS for a list of domains using one DNS API. Each update is a tuple of the domain's
+# DNS API data from domains.ini, its key name, the key data and the list of its old records.
+# The old records created before the cutoff (see expired_records()) are removed, then the
+# record for the new key is added. This runs in a DNS update worker thread, so it only reports what it did rather than
+# modifying the update data itself. Returns a list with a tuple for each update, holding the
+# list of old records removed and the new record (None if adding it failed).
+def update_domains_dns( dnsapi_client, dnsapi_name, updates, cutoff, debugging = False ):
+    if hasattr( dnsapi_client, 'batch' ) and getattr( dnsapi_client, 'batch_adds', True ):
+        return batch_update_domains_dns( dnsapi_client, dnsapi_name, updates, cutoff, debugging )
+    results = []
+    for dnsapi_domain_data, key_name, key_data, old_records in updates:
+        domain = key_data['domain']
+        removed_records = []
+        expired = expired_records( old_records, key_data, cutoff )
+        if len( expired ) > 0:
+            logging.info( "Removing old records for %s", domain )
+        for record in expired:
+            result = dnsapi_client.delete( dnsapi_domain_data, record, debugging )
+            if log_delete_result( dnsapi_name, record, result ):
+                removed_records.append( record )
+        # Add new record
+        logging.info( "Updating selector %s for %s with key %s", key_data['selector'], domain, key_name )
+        result = dnsapi_client.add( dnsapi_domain_data, key_data, debugging )
+        results.append( (removed_records, log_add_result( dnsapi_name, key_name, key_data, result )) )
+    return results
+
+
+# Same as update_domains_dns(), for clients that can apply a whole list of changes with a
+# single batch() call.
+def batch_update_domains_dns( dnsapi_client, dnsapi_name, updates, cutoff, debugging = False ):
+    operations = []
+    expired_records = []
+    for dnsapi_domain_data, key_name, key_data, old_records in updates:
+        expired = expired_records( old_records, key_data, cutoff )
+        if len( expired ) > 0:
+            logging.info( "Removing old records for %s", key_data['domain'] )
+        for record in expired:
+            operations.append( ('delete', dnsapi_domain_data, record) )
+        expired_records.append( expired )
+        logging.info( "Updating selector %s for %s with key %s", key_data['selector'], key_data['domain'],
+                      key_name )
+        operations.append( ('add', dnsapi_domain_data, key_data) )
+
+    operation_results = dnsapi_client.batch( operations, debugging )
+    results = []
+    i = 0
+    for update, expired in zip( updates, expired_records ):
+        removed_records = []
+        for record in expired:
+            if log_delete_result( dnsapi_name, record, operation_results[i] ):
+                removed_records.append( record )
+            i += 1
+        results.append( (removed_records, log_add_result( dnsapi_name, update[1], update[2], operation_results[i] )) )
+        i += 1
+    return results
+
+
+# Deletes the old records created before the cutoff for a list of updates (as for
+# update_domains_dns()) in a single batch, without adding any new records. Returns a list
+# with the old records removed for each update.
+def delete_old_records( dnsapi_client, dnsapi_name, updates, cutoff, debugging = False ):
+    deletes = []
+    for dnsapi_domain_data, key_name, key_data, old_records in updates:
+        expired = expired_records( old_records, key_data, cutoff )
+        if len( expired ) > 0:
+            logging.info( "Removing old records for %s", key_data['domain'] )
+        deletes.extend( [(dnsapi_domain_data, record) for record in expired] )
+    removed = set( [id( record ) for record in delete_dns_records( dnsapi_client, dnsapi_name, deletes, debugging )] )
+    return [[record for record in update[3] if id( record ) in removed] for update in updates]
+
+
+# The old records to remove before adding the record for key_data: those created before the
+# cutoff, and any record for the selector being added. That can only be a record for a key
+# that's since been replaced (a resumed run whose key files were lost), and leaving it
+# would publish two different keys under one selector.
+def expired_records( old_records, key_data, cutoff ):
+    return [record for record in old_records if
+            record.created_before( cutoff ) or record.selector == key_data['selector']]
+
+
+# Splits a batch client's updates between up to task_count tasks, keeping updates with the
+# same DNS API data (normally the domains in one zone) next to each other so they still go
+# in the same batches where they can. Returns the list of updates for each task.
+def split_batch_updates( updates, task_count ):
+    updates = sorted( updates, key = lambda update: tuple( update[0] ) )
+    size = -(-len( updates ) // max( 1, task_count ))
+    return [updates[i:i + size] for i in range( 0, len( updates ), size )]
+
+
+# Logs the result of deleting an old record. Returns True if the record was removed.
+def log_delete_result( dnsapi_name, record, result ):
+    if result is None:
+        logging.info( "No support for removing old record for %s:%s via %s API", record[0], record[1], dnsapi_name )
+        return False
+    elif result:
+        logging.info( "Removing %s:%s created at %s", record[0], record[1], record[2].strftime( '%Y-%m-%d %H:%M:%S' ) )
+        return True
+    else:
+        logging.error( "Error removing old record for %s:%s via %s API", record[0], record[1], dnsapi_name )
+        return False
+
+
+# Logs the result of adding a new record. Returns the new update data record, or None if
+# adding it failed.
+def log_add_result( dnsapi_name, key_name, key_data, result ):
+    if result[0]:
+        logging.info( "Update succeeded for %s.", key_data['domain'] )
+        return list( result[1:] )
+    else:
+        logging.error( "Error adding new record for %s with key %s via %s API", key_data['domain'], key_name,
+                       dnsapi_name )
+        return None
+
+
+def close_dnsapi_clients( dnsapi_clients ):
+    for dnsapi_name, dnsapi_client in dnsapi_clients.items():
+        if dnsapi_client is None:
+            continue
+        try:
+            dnsapi_client.close()
+        except Exception as e:
+            logging.warning( "Error closing DNS API %s", dnsapi_name )
+            logging.warning( "%s", str( e ) )
+
+
+# Runs DNS update tasks using up to jobs worker threads. Each task is a tuple of the DNS API
+# name and a function taking no arguments, and no more than caps[API name] tasks for the
+# same API are run at the same time. Tasks waiting on a busy API don't hold up tasks for
+# other APIs. Returns the list of task results in task order, with None for any task that
+# raised an exception.
+def run_dns_tasks( tasks, jobs = 1, caps = None ):
+    if caps is None:
+        caps = { }
+    results = [None] * len( tasks )
+    if jobs <= 1:
+        for i, task in enumerate( tasks ):
+            results[i] = run_dns_task( task[1] )
+        return results
+
+    pending = collections.OrderedDict()  # Key = DNS API name, Value = deque of task indexes
+    for i, task in enumerate( tasks ):
+        pending.setdefault( task[0], collections.deque() ).append( i )
+    running = { }  # Key = future, Value = (task index, DNS API name)
+    in_flight = collections.Counter()  # Key = DNS API name, Value = tasks running
+    executor = concurrent.futures.ThreadPoolExecutor( max_workers = jobs )
     try:
-        ini_file = open( filename, 'w' )
+        while pending or running:
+            # Start tasks until we're out of threads, taking turns between the APIs
+            started = True
+            while started and len( running ) < jobs:
+                started = False
+                for dnsapi_name in list( pending.keys() ):
+                    if len( running ) >= jobs:
+                        break
+                    cap = caps.get( dnsapi_name )
+                    if cap is not None and in_flight[dnsapi_name] >= cap:
+                        continue
+                    i = pending[dnsapi_name].popleft()
+                    if len( pending[dnsapi_name] ) == 0:
+                        del pending[dnsapi_name]
+                    future = executor.submit( run_dns_task, tasks[i][1] )
+                    running[future] = (i, dnsapi_name)
+                    in_flight[dnsapi_name] += 1
+                    started = True
+            done, not_done = concurrent.futures.wait( list( running.keys() ),
+                                                      return_when = concurrent.futures.FIRST_COMPLETED )
+            for future in done:
+                i, dnsapi_name = running.pop( future )
+                in_flight[dnsapi_name] -= 1
+                results[i] = future.result()
+    finally:
+        executor.shutdown( wait = True )
+    return results
+
+
+# Deletes a list of (DNS API domain data, record) through a client, in a single batch if
+# the client can do that. Returns the list of records deleted.
+def delete_dns_records( dnsapi_client, dnsapi_name, deletes, debugging = False ):
+    if hasattr( dnsapi_client, 'batch' ):
+        results = dnsapi_client.batch( [('delete',) + delete for delete in deletes], debugging )
+    else:
+        results = [dnsapi_client.delete( dnsapi_domain_data, record, debugging )
+                   for dnsapi_domain_data, record in deletes]
+    return [record for (dnsapi_domain_data, record), result in zip( deletes, results ) if
+            log_delete_result( dnsapi_name, record, result )]
+
+
+# Maximum number of concurrent DNS update tasks for an API from its concurrency= option,
+# None if there's no limit
+def dnsapi_concurrency( dnsapi_name ):
+    if 'concurrency' not in dnsapi_options.get( dnsapi_name, { } ):
+        return None
+    try:
+        return max( 1, int( dnsapi_options[dnsapi_name]['concurrency'] ) )
+    except ValueError:
+        logging.error( "Invalid concurrency setting for DNS API %s", dnsapi_name )
+        return None
+
+
+def run_dns_task( task ):
+    try:
+        return task()
+    except Exception as e:
+        logging.error( "DNS update failed: %s", str( e ) )
+        return None
+
+
+# Writes the run's metrics to the files asked for on the command line
+def write_metrics():
+    run_metrics.log_summary()
+    if args.report_json:
+        run_metrics.write_json( args.report_json )
+    if args.metrics_textfile:
+        run_metrics.write_textfile( args.metrics_textfile )
+
+
+# Writes the key.table and signing.table files from rows of (tag, domain, selector,
+# key file), and key.db and signing.db as well if db_tables is True. Returns False if
+# the files couldn't be written.
+def write_tables( rows, db_tables = False ):
+    if db_tables:
+        import dbtables
+        rows = list( rows )
+        if not dbtables.write_db_tables( rows, key_db_filename, signing_db_filename ):
+            return False
+    try:
+        with open( key_table_filename, 'w' ) as key_table_file, \
+                open( signing_table_filename, 'w' ) as signing_table_file:
+            for tag, domain, row_selector, key_file in rows:
+                key_table_file.write( "%s\t%s:%s:%s\n" % (tag, domain, row_selector, key_file) )
+                signing_table_file.write( "*@%s\t%s\n" % (domain, tag) )
     except IOError as e:
-        logging.critical( "Error writing file %s", filename )
+        logging.critical( "Error writing new key or signing table file" )
         logging.error( "%s", str( e ) )
-        return
-    for record in records:
-        line = fields_to_line( record ) + '\n'
-        ini_file.write( line )
-    ini_file.close()
-    return
-
-
-def find_key_for_domain( domain_data, domain ):
-    for domain_entry in domain_data:
-        if domain_entry[0] == domain:
-            return domain_entry[1]
-    return None
-
-
-def find_dnsapi_modules( pn ):
-    # Go through all possible names (pulled from what's mentioned in the
-    # dnsapi.ini file) and for each one X see if we can load a module named
-    # dnsapi_X (file will be dnsapi_X.py).
-    dnsapis = { }
-    possible_names = pn
-    # Make sure null is included
-    if 'null' not in possible_names:
-        possible_names.append( 'null' )
-    for api_name in possible_names:
-        module_name = "dnsapi_" + api_name
-        try:
-            module = importlib.import_module( module_name )
-        except ImportError as e:
-            module = None
-            logging.error( "Module %s for DNS API %s not found", module_name, api_name )
-            logging.info( "%s", str( e ) )
-        if module is not None:
-            logging.debug( "DNS API module %s loaded", api_name )
-            dnsapis[api_name] = module
-    return dnsapis
+        return False
+    return True
+
+
+# Key table row for a domain using a newly-generated key
+def new_table_row( domain, key_name, key_data ):
+    return (domain.replace( '.', '-' ), domain, key_data['selector'],
+            "%s/%s.%s.key" % (opendkim_dir, key_name, key_data['selector']))
+
+
+# Stagger bucket a key name belongs to, from 0 to buckets - 1. This has to come out the
+# same on every run, so it uses a fixed hash of the name rather than Python's hash().
+def stagger_bucket( key_name, buckets ):
+    return zlib.crc32( key_name.encode( 'utf-8' ) ) % buckets
 
 
 # Set up command-line argument parser and parse arguments
@@ -250,6 +748,40 @@ parser.add_argument( "-a", "--avoid-overwrite", dest = 'avoid_collisions', actio
                      help = "Add a suffix to the selector if needed to avoid overwriting existing files" )
 parser.add_argument( "-s", "--selector", dest = 'output_selector', action = 'store_true',
                      help = "Causes the generated selector to be output" )
+parser.add_argument( "-j", "--jobs", dest = 'jobs', action = 'store', type = int, default = 1,
+                     help = "Number of keys to generate in parallel" )
+parser.add_argument( "--dns-jobs", dest = 'dns_jobs', action = 'store', type = int, default = 1,
+                     help = "Number of domains to update DNS records for in parallel" )
+parser.add_argument( "--keygen", dest = 'keygen', action = 'store', choices = keygen_backends,
+                     default = 'opendkim', help = "Key generation backend to use" )
+parser.add_argument( "--pool-dir", dest = 'pool_dir', action = 'store',
+                     help = "Use pre-generated keys from this key pool directory when available" )
+parser.add_argument( "--fill-pool", dest = 'fill_pool', action = 'store', type = int,
+                     help = "Fill the key pool up to this many spare keys and exit" )
+parser.add_argument( "--stagger", dest = 'stagger', action = 'store', type = int,
+                     help = "Spread rotations over this many daily buckets, rotating only the bucket due today" )
+parser.add_argument( "--bucket", dest = 'bucket', action = 'store', type = int,
+                     help = "With --stagger, rotate this bucket instead of the one due today" )
+parser.add_argument( "--db-tables", dest = 'db_tables', action = 'store_true',
+                     help = "Also write the key and signing tables as database files" )
+parser.add_argument( "--state-db", dest = 'state_db', action = 'store',
+                     help = "Keep update data and table entries in an SQLite database instead of the flat files" )
+parser.add_argument( "--export-state", dest = 'export_state', action = 'store_true',
+                     help = "Write the update data and table files from the state database and exit" )
+parser.add_argument( "--resume", dest = 'resume', action = 'store_true',
+                     help = "Finish an interrupted run from its journal" )
+parser.add_argument( "--reconcile", dest = 'reconcile', action = 'store_true',
+                     help = "Compare the update data with the DKIM records in DNS, fix the differences and exit" )
+parser.add_argument( "--check-propagation", dest = 'check_propagation', action = 'store', type = float,
+                     metavar = 'SECONDS',
+                     help = "Wait up to this long for new records to reach the domains' nameservers, keeping the "
+                            "old table entries for domains whose records haven't" )
+parser.add_argument( "--propagation-ns", dest = 'propagation_ns', action = 'append', metavar = 'HOST:PORT',
+                     help = "Check propagation with this nameserver instead of each domain's own nameservers" )
+parser.add_argument( "--report-json", dest = 'report_json', action = 'store',
+                     help = "Write timing and DNS API call metrics for the run to this file as JSON" )
+parser.add_argument( "--metrics-textfile", dest = 'metrics_textfile', action = 'store',
+                     help = "Write timing and DNS API call metrics to this Prometheus textfile" )
 parser.add_argument( "--working-dir", dest = 'working_dir', action = 'store',
                      help = "Set the working directory for DKIM data files" )
 parser.add_argument( "--no-dns", dest = 'update_dns', action = 'store_false',
@@ -292,6 +824,13 @@ if args.working_dir:
 
 logging.basicConfig( level = level, format = "%(levelname)s: %(message)s" )
 
+propagation_ns = None  # Nameservers to check propagation with, None for each domain's own
+if args.propagation_ns:
+    import propagation
+    propagation_ns = [propagation.parse_server( text ) for text in args.propagation_ns]
+    if None in propagation_ns:
+        sys.exit( 1 )
+
 # If we weren't given an explicit selector, the default is YYYYMM based on
 # either this month or next month.
 selector = args.selector
@@ -306,7 +845,6 @@ if selector is None:
             y += 1
         selector_date = selector_date.replace( year = y, month = m )
     selector = selector_date.strftime( "%Y%m" )
-logging.info( "Selector: %s", selector )
 if should_output_selector:
     print( selector )
     sys.exit( 0 )
@@ -316,19 +854,88 @@ if working_dir:
     logging.info( "Setting working directory to %s", working_dir )
     os.chdir( working_dir )
 
+# Refilling the key pool is done ahead of time, separately from a rotation
+if args.fill_pool is not None:
+    if not args.pool_dir:
+        logging.critical( "No key pool directory given" )
+        sys.exit( 1 )
+    if not fill_key_pool( args.pool_dir, args.fill_pool, args.jobs, args.keygen ):
+        sys.exit( 1 )
+    sys.exit( 0 )
+
+# Open the state database, starting it off with the contents of the flat files if it's new
+state = None
+if args.state_db:
+    import sqlite3
+    import statedb
+    try:
+        state = statedb.StateDB( args.state_db )
+        if state.is_new:
+            logging.info( "Creating state database %s", args.state_db )
+            state.import_files( dns_update_data_filename, key_table_filename )
+    except sqlite3.Error as e:
+        logging.critical( "Error opening state database %s", args.state_db )
+        logging.error( "%s", str( e ) )
+        sys.exit( 1 )
+if args.export_state:
+    if state is None:
+        logging.critical( "No state database given" )
+        sys.exit( 1 )
+    state.write( dns_update_data_filename )
+    if not write_tables( state.table_rows(), args.db_tables ):
+        sys.exit( 1 )
+    sys.exit( 0 )
+
+# A journal left behind means the last run didn't finish. Starting a fresh run would
+# generate new keys and add another record for every domain it already updated, so
+# that run has to be resumed first.
+run_state = None
+if os.path.exists( journal_filename ):
+    if not args.resume:
+        logging.critical( "Journal %s from an unfinished run found, use --resume to finish that run",
+                          journal_filename )
+        sys.exit( 1 )
+    import journal
+    run_state = journal.load( journal_filename )
+    if run_state is None:
+        sys.exit( 1 )
+    if run_state.selector is not None:
+        if args.selector is not None and args.selector != run_state.selector:
+            logging.critical( "Unfinished run used selector %s, not %s", run_state.selector, args.selector )
+            sys.exit( 1 )
+        selector = run_state.selector
+    logging.info( "Resuming run with selector %s: %d keys generated, %d records added, %d removed", selector,
+                  len( run_state.keys ), len( run_state.adds ), len( run_state.deletes ) )
+elif args.resume:
+    logging.warning( "No journal %s found, nothing to resume", journal_filename )
+# Only known once a resumed run has taken its selector from the journal
+logging.info( "Selector: %s", selector )
+
+run_metrics = metrics.Metrics()
+run_metrics.phase( 'ini_parse' )
+
 # Process dnsapi.ini
 # If we're supposed to update DNS records but don't have any definitions for
 # the DNS APIs, we record an error but we can continue to generate the keys
 # and public key files anyway. The admin will just have to update the DNS
 # records manually.
 dnsapi_info = { }  # Key = DNS API name, Value = remainder of fields
+dnsapi_options = { }  # Key = DNS API name, Value = dict of genkeys.py options for the API
 dnsapi_data = process_ini_file( dns_api_defs_filename )
 if dnsapi_data is None and should_update_dns:
     logging.error( "No DNS API definitions found in %s", dns_api_defs_filename )
     should_update_dns = False
 else:
     for item in dnsapi_data:
-        dnsapi_info[item[0]] = item[1:len( item )]
+        dnsapi_info[item[0]], dnsapi_options[item[0]] = dnsregistry.split_options( item[1:len( item )] )
+        # APIs without settings for them get the default pacing and zone cache when
+        # those modules are first used
+        if set( dnsapi_options[item[0]] ).intersection( ['rate', 'burst', 'retries'] ):
+            import ratelimit
+            ratelimit.configure( item[0], dnsapi_options[item[0]] )
+        if 'zone_cache_ttl' in dnsapi_options[item[0]]:
+            import zonecache
+            zonecache.configure( item[0], dnsapi_options[item[0]] )
 # Insure we have the null API
 if dnsapi_info['null'] is None:
     dnsapi_info['null'] = []
@@ -342,46 +949,262 @@ if domain_data is None:
 for item in domain_data:
     if len( item ) < 3 or item[2] is None:
         item[2] = 'null'
-# We'll need a list of all the key names used by domains
+
+# Read contents of the existing key table file in case we need to leave existing
+# lines in place because of a DNS update failure. The state database already has them.
+key_table_data = []
+if state is None:
+    key_table_data = process_ini_file( key_table_filename, False )
+    if key_table_data == None:
+        key_table_data = []
+
+# Reconciling lists the DKIM records each domain actually has in DNS, for the APIs that can
+# list them, and brings the update data and DNS back in line with each other (see
+# reconcile.py) instead of rotating keys.
+if args.reconcile:
+    if run_state is not None:
+        logging.critical( "Finish the interrupted run with --resume before reconciling" )
+        sys.exit( 1 )
+    import reconcile
+    if state is not None:
+        update_data = state
+        current_rows = state.table_rows()
+    else:
+        update_data = updatedata.load( dns_update_data_filename )
+        if update_data is None:
+            update_data = updatedata.UpdateData()
+        current_rows = [[key_item[0]] + key_item[1].split( ':', 2 ) for key_item in key_table_data]
+    current_selectors = { }  # Key = domain, Value = selector in the key table
+    for row in current_rows:
+        if len( row ) == 4:
+            current_selectors[row[1]] = row[2]
+    managed_selectors = set( current_selectors.values() ).union( [record.selector for record in update_data] )
+
+    run_metrics.phase( 'dns_update' )
+    logging.info( "Listing DNS records" )
+    dnsapi_clients = { }  # Key = DNS API name, Value = client, opened when first needed
+    dns_caps = { }  # Key = DNS API name, Value = maximum concurrent tasks
+    list_tasks = []  # (DNS API name, task function)
+    list_items = []  # domains.ini item for each task
+    for item in domain_data:
+        dnsapi_name = item[2]
+        if dnsapi_name not in dnsapi_clients:
+            if args.use_null_dnsapi and dnsapi_name != 'fail':
+                dnsapi_module = dnsregistry.load( 'null' )
+            else:
+                dnsapi_module = dnsregistry.load( dnsapi_name )
+            dnsapi_client = None
+            if dnsapi_module is not None and dnsapi_name in dnsapi_info:
+                dnsapi_client = run_metrics.timed_client(
+                    dnsregistry.open_client( dnsapi_module, dnsapi_name, dnsapi_info[dnsapi_name], args.log_debug ),
+                    dnsapi_name )
+            dnsapi_clients[dnsapi_name] = dnsapi_client
+            dns_caps[dnsapi_name] = dnsapi_concurrency( dnsapi_name )
+        dnsapi_client = dnsapi_clients[dnsapi_name]
+        if dnsapi_client is None or not hasattr( dnsapi_client, 'list_records' ):
+            logging.info( "DNS API %s can't list records, not reconciling %s", dnsapi_name, item[0] )
+            continue
+        list_tasks.append( (dnsapi_name, functools.partial( reconcile.list_domain_records, dnsapi_client,
+                                                            item[3:len( item )], item[0], args.log_debug )) )
+        list_items.append( item )
+    listings = run_dns_tasks( list_tasks, args.dns_jobs, dns_caps )
+
+    run_metrics.phase( 'record_cleanup' )
+    orphans = collections.OrderedDict()  # Key = DNS API name, Value = list of (DNS API domain data, record)
+    missing_count = 0
+    stale_count = 0
+    reconciled_domains = set()
+    for item, records in zip( list_items, listings ):
+        domain = item[0]
+        if records is None:
+            logging.error( "Could not list DNS records for %s", domain )
+            continue
+        if domain in reconciled_domains:
+            continue
+        reconciled_domains.add( domain )
+        in_use = lambda record_selector: record_selector == current_selectors.get( domain ) or \
+            os.path.exists( "%s.%s.key" % (item[1], record_selector) )
+        domain_orphans, missing, stale = reconcile.diff_records( records, list( update_data.records_for( domain ) ),
+                                                                 in_use, managed_selectors )
+        with update_data.transaction():
+            for record in stale:
+                logging.info( "Removing %s:%s from update data, it's no longer in DNS", domain, record.selector )
+                update_data.remove( record )
+            for record in missing:
+                logging.info( "Restoring %s:%s to update data", domain, record.selector )
+                update_data.add( record )
+        missing_count += len( missing )
+        stale_count += len( stale )
+        for record in domain_orphans:
+            logging.info( "Orphaned record %s:%s found", domain, record.selector )
+            orphans.setdefault( item[2], [] ).append( (item[3:len( item )], record) )
+
+    # Orphans are deleted in one batch per API if the client can batch, otherwise one at a time
+    run_metrics.phase( 'dns_update' )
+    delete_tasks = []
+    for dnsapi_name, deletes in orphans.items():
+        if hasattr( dnsapi_clients[dnsapi_name], 'batch' ):
+            deletes = [deletes]
+        else:
+            deletes = [[delete] for delete in deletes]
+        for task_deletes in deletes:
+            delete_tasks.append( (dnsapi_name, functools.partial( delete_dns_records, dnsapi_clients[dnsapi_name],
+                                                                  dnsapi_name, task_deletes, args.log_debug )) )
+    deleted_count = sum( [len( deleted ) for deleted in run_dns_tasks( delete_tasks, args.dns_jobs, dns_caps ) if
+                          deleted is not None] )
+    close_dnsapi_clients( dnsapi_clients )
+
+    run_metrics.phase( 'record_cleanup' )
+    if state is None:
+        update_data.write( dns_update_data_filename )
+    else:
+        state.close()
+    logging.info( "Reconciled %d domains: %d orphaned records of %d deleted, %d records restored, %d stale removed",
+                  len( reconciled_domains ), deleted_count, sum( [len( deletes ) for deletes in orphans.values()] ),
+                  missing_count, stale_count )
+    run_metrics.count( 'domains_reconciled', len( reconciled_domains ) )
+    run_metrics.count( 'orphans_deleted', deleted_count )
+    run_metrics.count( 'records_restored', missing_count )
+    run_metrics.count( 'records_stale', stale_count )
+    write_metrics()
+    sys.exit( 0 )
+
+# With staggered rotation only the domains whose key name falls in the bucket that's due
+# are rotated, the rest keep their current entries. Domains sharing a key name share the
+# key files so they always rotate together. A domain with no entry in the key table yet
+# needs a key now, so its key name is treated as due. A resumed run finishes rotating the
+# key names it started with, whichever bucket is due now.
+rotate_data = domain_data  # Domains being rotated this run
+skipped_domains = set()  # Domains keeping their current entries
+due_keys = None  # Key names being rotated, None for all of them
+due_bucket = None
+if run_state is not None and run_state.key_names is not None:
+    due_keys = set( run_state.key_names )
+elif args.stagger:
+    if args.stagger < 1:
+        logging.critical( "Invalid number of stagger buckets %d", args.stagger )
+        sys.exit( 1 )
+    due_bucket = args.bucket
+    if due_bucket is None:
+        # Buckets past the end of a short month would never come due, so they're limited to 28
+        if args.stagger > 28:
+            logging.critical( "No more than 28 stagger buckets can be used with daily rotation" )
+            sys.exit( 1 )
+        # Days past the last bucket have nothing due except new domains
+        due_bucket = datetime.date.today().day - 1
+    elif due_bucket < 0 or due_bucket >= args.stagger:
+        logging.critical( "Stagger bucket %d out of range", due_bucket )
+        sys.exit( 1 )
+    due_keys = set( [item[1] for item in domain_data if stagger_bucket( item[1], args.stagger ) == due_bucket] )
+if due_keys is not None:
+    if state is not None:
+        current_domains = set( [row[1] for row in state.table_rows()] )
+    else:
+        current_domains = set( [key_item[1].split( ':' )[0] for key_item in key_table_data] )
+    for item in domain_data:
+        if item[0] not in current_domains:
+            due_keys.add( item[1] )
+    rotate_data = [item for item in domain_data if item[1] in due_keys]
+    skipped_domains = set( [item[0] for item in domain_data if item[1] not in due_keys] )
+if due_bucket is not None:
+    if due_bucket < args.stagger:
+        logging.info( "Rotating bucket %d of %d: %d of %d domains", due_bucket, args.stagger, len( rotate_data ),
+                      len( domain_data ) )
+    else:
+        logging.info( "No bucket due, rotating %d new domains", len( rotate_data ) )
+# We'll need a list of all the key names used by the domains being rotated
 key_names = []
-for item in domain_data:
+for item in rotate_data:
     if item[1] not in key_names:
         key_names.append( item[1] )
 
-# Generate our keys, one per key name
-keys = { }  # Key = key name (field 1) from domain_data[n], Value = key data dict
-for target in key_names:
-    logging.info( "Generating key %s", target )
-    key_data = gen_key( target, selector, avoid_collisions )
-    if key_data is None:
-        logging.critical( "    Error generating key %s", target )
-        sys.exit( 1 )
-    keys[target] = key_data
-# That also gives us the private key and public key txt files needed
+# Everything the run does from here on is journaled so it can be resumed
+import journal
+run_journal = journal.Journal( journal_filename )
+if run_state is None:
+    run_journal.start( selector, key_names )
 
-# Read contents of the existing key table file in case we need to leave existing
-# lines in place because of a DNS update failure
-key_table_data = process_ini_file( "key.table", False )
-if key_table_data == None:
-    key_table_data = []
+# Generate our keys, one per key name. Keys a resumed run already generated are reused
+# as long as their key files are still there, or still waiting to be renamed into place.
+# A key whose files are gone is generated again, and the domains using it need their DNS
+# records added again for the new key.
+# Key = key name, Value = key data dict
+run_metrics.phase( 'keygen' )
+resumed_keys = { }
+replaced_keys = set()  # Key names whose journaled key had to be generated again
+if run_state is not None:
+    for key_name in key_names:
+        key_data = run_state.keys.get( key_name )
+        if key_data is None:
+            continue
+        private_key_filename = "%s.%s.key" % (key_name, key_data['selector'])
+        if not os.path.exists( private_key_filename ) and \
+                os.path.exists( pending_filename( private_key_filename ) ):
+            install_key_files( key_name, key_data['selector'] )
+        if os.path.exists( private_key_filename ):
+            resumed_keys[key_name] = key_data
+        else:
+            logging.warning( "Key files for %s selector %s are missing, generating a new key", key_name,
+                             key_data['selector'] )
+            replaced_keys.add( key_name )
+            # Whatever is left of the lost key is no use without its private key
+            public_key_filename = "%s.%s.txt" % (key_name, key_data['selector'])
+            if os.path.exists( public_key_filename ):
+                os.remove( public_key_filename )
+generated_keys = { }  # Key = key name, Value = key data, for keys this run has generated
 
-# Check for our DNS API modules. If we don't have any, there's no sense in
-# trying to do automatic updating even if we're supposed to.
-if should_update_dns:
-    dnsapis = find_dnsapi_modules( dnsapi_info.keys() )  # Key = DNS API name, Value = module
-    if len( dnsapis ) == 0:
-        logging.warning( "No DNS API modules found at %s", os.path.dirname( __file__ ) )
-        should_update_dns = False
 
-if should_update_dns:
-    update_data = process_ini_file( dns_update_data_filename, False )
+def journal_key( key_name, key_data ):
+    run_journal.key( key_name, key_data )
+    generated_keys[key_name] = key_data
 
-    if update_data is not None:
-        # Convert update data timestamp field to a datetime
-        for record in update_data:
-            if record[2] is not None:
-                dt = datetime.datetime.strptime( record[2], '%Y-%m-%dT%H:%M:%S' )
-                record[2] = dt
+
+key_times = { }  # Key = key name, Value = seconds taken to generate the key
+keys = gen_keys( [key_name for key_name in key_names if key_name not in resumed_keys], selector,
+                 avoid_collisions, args.jobs, args.keygen, args.pool_dir, key_times, journal_key )
+for seconds in key_times.values():
+    run_metrics.observe_keygen( seconds )
+if keys is None:
+    if run_state is None:
+        # Nothing has been published yet, so a fresh run that fails here is abandoned
+        # completely and the next run starts over instead of having to be resumed
+        for key_name, key_data in generated_keys.items():
+            for suffix in ['.key', '.txt']:
+                filename = key_name + "." + key_data['selector'] + suffix
+                for path in [filename, pending_filename( filename )]:
+                    if os.path.exists( path ):
+                        os.remove( path )
+        run_journal.finish()
+    else:
+        run_journal.close()
+    write_metrics()
+    sys.exit( 1 )
+keys.update( resumed_keys )
+# That also gives us the private key and public key txt files needed
+if state is not None:
+    state.add_keys( keys )
+
+failed_domains = []
+unpropagated_domains = []  # Domains whose new record hasn't reached their nameservers
+if should_update_dns:
+    run_metrics.phase( 'ini_parse' )
+    if state is not None:
+        update_data = state
+    else:
+        update_data = updatedata.load( dns_update_data_filename )
+    # Records a resumed run already added or removed are brought back into the update data,
+    # and domains it already added a record for are done
+    completed_domains = set()
+    if run_state is not None:
+        if update_data is None:
+            update_data = updatedata.UpdateData()
+        run_state.replay( update_data )
+        completed_domains = run_state.completed_domains()
+        for item in rotate_data:
+            if item[0] in completed_domains and item[1] in replaced_keys:
+                logging.info( "Adding DNS records for %s again for its new key", item[0] )
+                completed_domains.discard( item[0] )
+    run_metrics.phase( 'dns_update' )
 
     logging.info( "Updating DNS records" )
     # Discard records older than 10 weeks (roughly the midpoint of the month 2 months ago),
@@ -389,20 +1212,29 @@ if should_update_dns:
     # rotation is in use.
     cutoff_delta = datetime.timedelta( 70 )
     cutoff = datetime.datetime.now() - cutoff_delta
-    failed_domains = []
-    for item in domain_data:
+    # Each domain's update task is only given that domain's old records to work on
+    cleanup_domains = set()  # Domains whose old records have been handed to a task
+    dns_tasks = []  # (DNS API name, task function)
+    dns_task_domains = []  # List of domains for each task
+    dns_task_deletes_only = []  # For each task, True if it only deletes old records
+    dns_batches = collections.OrderedDict()  # Key = DNS API name, Value = list of updates for a batch client
+    dns_batch_deletes = collections.OrderedDict()  # Key = DNS API name, Value = list of updates with old records
+    dns_caps = { }  # Key = DNS API name, Value = maximum concurrent tasks
+    dnsapi_clients = { }  # Key = DNS API name, Value = client, opened when first needed
+    for item in rotate_data:
+        if item[0] in completed_domains:
+            logging.info( "DNS records for %s already updated", item[0] )
+            continue
         if len( item ) > 2:
             dnsapi_name = item[2]
             dnsapi_domain_data = item[3:len( item )]
+            # DNS API modules are only loaded once a domain needs them
             try:
-                if args.use_null_dnsapi:
-                    if dnsapi_name == 'fail':
-                        dnsapi_module = dnsapis[dnsapi_name]
-                    else:
-                        dnsapi_module = dnsapis['null']
-                else:
-                    dnsapi_module = dnsapis[dnsapi_name]
                 dnsapi_data = dnsapi_info[dnsapi_name]
+                if args.use_null_dnsapi and dnsapi_name != 'fail':
+                    dnsapi_module = dnsregistry.load( 'null' )
+                else:
+                    dnsapi_module = dnsregistry.load( dnsapi_name )
                 key_data = keys[item[1]].copy()
             except KeyError:
                 dnsapi_module = None
@@ -411,121 +1243,167 @@ if should_update_dns:
             if dnsapi_module is None:
                 logging.error( "No DNS API %s found for %s", dnsapi_name, item[0] )
             if dnsapi_module is not None and dnsapi_data is not None and key_data is not None:
+                if dnsapi_name not in dnsapi_clients:
+                    dnsapi_client = dnsregistry.open_client( dnsapi_module, dnsapi_name, dnsapi_data, args.log_debug )
+                    dnsapi_clients[dnsapi_name] = run_journal.journaled_client(
+                        run_metrics.timed_client( dnsapi_client, dnsapi_name ) )
+                dnsapi_client = dnsapi_clients[dnsapi_name]
+                if dnsapi_client is None:
+                    failed_domains.append( item[0] )
+                    continue
                 key_data['domain'] = item[0]
                 key_data['dnsapi'] = dnsapi_name
-                if args.cleanup_files and update_data is not None:
-                    # Clean up old records
-                    removed_count = 0
-                    new_update_data = []
-                    for record in update_data:
-                        if record[0] == item[0] and record[2] < cutoff:
-                            if removed_count == 0:
-                                logging.info( "Removing old records for %s", item[0] )
-                            removed_count += 1
-                            result = dnsapi_module.delete( dnsapi_data, dnsapi_domain_data, record, args.log_debug )
-                            if result is None:
-                                logging.info( "No support for removing old record for %s:%s via %s API",
-                                              record[0], record[1], dnsapi_name )
-                                # Preserve record if we encountered an error
-                                new_update_data.append( record )
-                            elif result:
-                                logging.info( "Removing %s:%s created at %s", record[0], record[1],
-                                              record[2].strftime( '%Y-%m-%d %H:%M:%S' ) )
-                            else:
-                                logging.error( "Error removing old record for %s:%s via %s API",
-                                               record[0], record[1], dnsapi_name )
-                                # Preserve record if we encountered an error
-                                new_update_data.append( record )
-                        else:
-                            new_update_data.append( record )
-                    update_data = new_update_data
-                # Add new record
-                logging.info( "Updating selector %s for %s with key %s", key_data['selector'], item[0], item[1] )
-                result = dnsapi_module.add( dnsapi_data, dnsapi_domain_data, key_data, args.log_debug )
-                if result[0]:
-                    logging.info( "Update succeeded." )
-                    records = list( result[1:] )
-                    if update_data is None:
-                        update_data = []
-                    update_data.append( records )
-                else:
-                    logging.error( "Error adding new record for %s with key %s via %s API",
-                                   item[0], item[1], dnsapi_name )
-                    failed_domains.append( item[0] )
+                old_records = []
+                if args.cleanup_files and update_data is not None and item[0] not in cleanup_domains:
+                    old_records = list( update_data.records_for( item[0] ) )
+                    cleanup_domains.add( item[0] )
+                update = (dnsapi_domain_data, item[1], key_data, old_records)
+                if dnsapi_name not in dns_caps:
+                    dns_caps[dnsapi_name] = dnsapi_concurrency( dnsapi_name )
+                # Clients that can batch changes get their domains split between a few tasks.
+                # Clients that only gain from batching deletes (see ModuleInterface.md) get
+                # all their old records deleted in one task and each new record added in a
+                # task of its own.
+                if hasattr( dnsapi_client, 'batch' ):
+                    if getattr( dnsapi_client, 'batch_adds', True ):
+                        dns_batches.setdefault( dnsapi_name, [] ).append( update )
+                        continue
+                    dns_batch_deletes.setdefault( dnsapi_name, [] ).append( update )
+                    update = (dnsapi_domain_data, item[1], key_data, [])
+                dns_tasks.append( (dnsapi_name,
+                                   functools.partial( update_domains_dns, dnsapi_client, dnsapi_name, [update],
+                                                      cutoff, args.log_debug )) )
+                dns_task_domains.append( [item[0]] )
+                dns_task_deletes_only.append( False )
+    for dnsapi_name, updates in dns_batches.items():
+        task_count = min( args.dns_jobs, dns_caps[dnsapi_name] or args.dns_jobs )
+        for task_updates in split_batch_updates( updates, task_count ):
+            dns_tasks.append( (dnsapi_name,
+                               functools.partial( update_domains_dns, dnsapi_clients[dnsapi_name], dnsapi_name,
+                                                  task_updates, cutoff, args.log_debug )) )
+            dns_task_domains.append( [update[2]['domain'] for update in task_updates] )
+            dns_task_deletes_only.append( False )
+    for dnsapi_name, updates in dns_batch_deletes.items():
+        dns_tasks.append( (dnsapi_name,
+                           functools.partial( delete_old_records, dnsapi_clients[dnsapi_name], dnsapi_name, updates,
+                                              cutoff, args.log_debug )) )
+        dns_task_domains.append( [update[2]['domain'] for update in updates] )
+        dns_task_deletes_only.append( True )
+
+    # Merge the results back in domain order, so the outcome is the same no matter what
+    # order the updates actually finished in.
+    dns_results = run_dns_tasks( dns_tasks, args.dns_jobs, dns_caps )
+    close_dnsapi_clients( dnsapi_clients )
+    run_metrics.phase( 'record_cleanup' )
+    domain_results = { }  # Key = domain, Value = (records removed, new record)
+    domain_removed = { }  # Key = domain, Value = old records removed by a task that only deletes
+    published_domains = set( completed_domains )  # Domains with a new record in DNS
+    for domains, deletes_only, results in zip( dns_task_domains, dns_task_deletes_only, dns_results ):
+        if results is None:
+            # Old records that couldn't be deleted are just left for the next run
+            if not deletes_only:
+                failed_domains.extend( domains )
+            continue
+        for domain, result in zip( domains, results ):
+            if deletes_only:
+                domain_removed[domain] = result
+            else:
+                domain_results[domain] = result
+    for item in rotate_data:
+        result = domain_results.pop( item[0], None )
+        removed = domain_removed.pop( item[0], [] )
+        if result is None and len( removed ) == 0:
+            continue
+        if update_data is None:
+            update_data = updatedata.UpdateData()
+        with update_data.transaction():
+            for record in removed + (result[0] if result is not None else []):
+                update_data.remove( record )
+            if result is None:
+                # The domain's add task failed as a whole, it's already in failed_domains
+                continue
+            if result[1] is None:
+                failed_domains.append( item[0] )
+            else:
+                new_record = updatedata.UpdateRecord.from_fields( result[1] )
+                if new_record is not None:
+                    update_data.add( new_record )
+                published_domains.add( item[0] )
+                # When checking propagation the table row waits until the record's propagated
+                if state is not None and not args.check_propagation:
+                    state.set_table_rows( [new_table_row( item[0], item[1], keys[item[1]] )] )
+
+    # Domains whose new record hasn't reached all their nameservers by the deadline keep
+    # their current table entries, the same as domains whose update failed. Records for
+    # the null API (or anything in debugging mode) were never really published.
+    if args.check_propagation and not args.log_debug and not args.use_null_dnsapi:
+        run_metrics.phase( 'propagation' )
+        checks = []  # (domain, record name, expected value)
+        for item in rotate_data:
+            if item[0] in published_domains and item[2] != 'null':
+                key_data = keys[item[1]]
+                checks.append( (item[0], key_data['selector'] + '._domainkey.' + item[0], key_data['plain']) )
+        logging.info( "Checking propagation of %d new records", len( checks ) )
+        import propagation
+        propagated = propagation.check_records( checks, args.check_propagation, propagation_ns )
+        for domain, record_name, expected in checks:
+            if domain not in propagated:
+                logging.warning( "New record for %s has not propagated, keeping its current key table entries",
+                                 domain )
+                unpropagated_domains.append( domain )
 
     if update_data is not None:
-        write_ini_file( dns_update_data_filename, update_data )
+        if state is None:
+            update_data.write( dns_update_data_filename )
 
+        run_metrics.phase( 'file_cleanup' )
         if args.cleanup_files:
-            target_list = []
-            # Find all files that match the name pattern for one of our domain name abbreviations
-            for target in key_names:
-                target_list += glob.glob( target + '.*.key' ) + glob.glob( target + '.*.txt' )
-            # Go through the update data and remove the entries from target_list that're still referred
-            # to by an update_data item.
-            for item in update_data:
-                if len( item ) < 2:
-                    continue
-                domain_key = find_key_for_domain( domain_data, item[0] )
-                if domain_key is not None:
-                    for suffix in ['.key', '.txt']:
-                        item_str = domain_key + '.' + item[1] + suffix
-                        try:
-                            i = target_list.index( item_str )
-                        except:
-                            i = -1
-                        if i >= 0:
-                            del target_list[i]
-            # Don't clean entries for domains that failed the DNS update
-            for item in failed_domains:
-                domain_key = find_key_for_domain( domain_data, item )
-                if domain_key is not None:
-                    new_list = [x for x in target_list if not x.startswith( domain_key + '.' )]
-                    target_list = new_list
-            # What's left in target_list are just the files that aren't referred to anymore and are
-            # eligible for being deleted.
-            for filename in target_list:
-                logging.info( "Removing obsolete file %s", filename )
-                try:
-                    os.remove( filename )
-                except:
-                    logging.warning( "Failed removing obsolete file %s", filename )
+            # Files for key names used by a domain that failed the DNS update are left alone
+            domain_keys = { }  # Key = domain, Value = key name
+            for item in domain_data:
+                domain_keys.setdefault( item[0], item[1] )
+            failed_keys = set( [domain_keys[domain] for domain in failed_domains + unpropagated_domains if
+                                domain in domain_keys] )
+            obsolete_files = keyfiles.obsolete_key_files( '.', key_names, update_data, domain_keys, failed_keys )
+            keyfiles.remove_key_files( '.', obsolete_files )
 
 # Generate the key.table and signing.table files
+run_metrics.phase( 'table_write' )
 logging.info( "Generating key and signing tables" )
-try:
-    key_table_file = open( "key.table", 'w' )
-    signing_table_file = open( "signing.table", 'w' )
-except IOError as e:
-    logging.critical( "Error creating new key or signing table file" )
-    logging.error( "%s", str( e ) )
-    sys.exit( 1 )
-# Write the unupdated entries back to the files
+table_rows = []
+# The unupdated entries go back in the files
+preserved_domains = skipped_domains.union( failed_domains, unpropagated_domains )
 for key_item in key_table_data:
     key_domain = key_item[1].split( ':' )[0]
-    if key_domain in failed_domains:
+    if key_domain in preserved_domains:
         logging.info( "Preserving entries for %s", key_domain )
-        try:
-            key_table_file.write( "%s\n" % (fields_to_line( key_item )) )
-            signing_table_file.write( "*@%s\t%s\n" % (key_domain, key_item[0]) )
-        except IOError as e:
-            logging.critical( "Error writing new key or signing table file" )
-            logging.error( "%s", str( e ) )
-            sys.exit( 1 )
-# Now write the updated lines to the files
-for item in domain_data:
-    if item[0] not in failed_domains:
-        code = item[0].replace( '.', '-' )
+        key_fields = key_item[1].split( ':', 2 )
+        if len( key_fields ) == 3:
+            table_rows.append( (key_item[0], key_fields[0], key_fields[1], key_fields[2]) )
+# Then the updated ones
+new_rows = []
+for item in rotate_data:
+    if item[0] not in preserved_domains:
         logging.info( "Adding entries for %s", item[0] )
-        try:
-            key_table_file.write( "%s\t%s:%s:%s/%s.%s.key\n" % \
-                                  (code, item[0], selector, opendkim_dir, item[1], selector) )
-            signing_table_file.write( "*@%s\t%s\n" % (item[0], code) )
-        except IOError as e:
-            logging.critical( "Error writing new key or signing table file" )
-            logging.error( "%s", str( e ) )
-            sys.exit( 1 )
-key_table_file.close()
-signing_table_file.close()
+        new_rows.append( new_table_row( item[0], item[1], keys[item[1]] ) )
+if state is not None:
+    # Failed and skipped domains' rows were never changed, the database has the old entries already.
+    # Domains no longer in domains.ini are left out of the tables.
+    state.set_table_rows( new_rows )
+    current_domains = set( [item[0] for item in domain_data] )
+    table_rows = [row for row in state.table_rows() if row[1] in current_domains]
+    state.close()
+else:
+    table_rows += new_rows
+if not write_tables( table_rows, args.db_tables ):
+    sys.exit( 1 )
+# Everything's saved, the run no longer needs resuming
+run_journal.finish()
+run_metrics.count( 'domains', len( domain_data ) )
+run_metrics.count( 'domains_rotated', len( rotate_data ) )
+run_metrics.count( 'keys_generated', len( keys ) )
+run_metrics.count( 'domains_failed', len( failed_domains ) )
+run_metrics.count( 'domains_unpropagated', len( unpropagated_domains ) )
+write_metrics()
 
 sys.exit( 0 )
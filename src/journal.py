@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, run journal
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Append-only record of what a run has done so far, so a run that dies part way through
+# can be resumed without losing track of the DNS records it already added or generating
+# the keys all over again. Each line is a JSON object, written to disk before the run
+# goes on to the next step:
+#
+#   {"op": "start", "selector": ..., "key_names": [...]} : start of the run, with the key
+#                                                         names being rotated
+#   {"op": "key", "key_name": ..., "key": {...}}         : key generated, with its key data
+#   {"op": "add", "domain": ..., "line": ...}            : DNS record added, with its update
+#                                                         data line
+#   {"op": "delete", "domain": ..., "line": ...}         : DNS record deleted
+#
+# The journal is removed once the run has finished and saved everything.
+
+import json
+import logging
+import os
+import threading
+
+import updatedata
+
+
+class Journal( object ):
+    def __init__( self, filename ):
+        self.filename = filename
+        self.journal_file = open( filename, 'a' )
+        # DNS updates are journaled from the DNS update worker threads
+        self.lock = threading.Lock()
+
+    # Appends an entry and waits until it's on disk
+    def append( self, entry ):
+        with self.lock:
+            self.journal_file.write( json.dumps( entry ) + '\n' )
+            self.journal_file.flush()
+            os.fsync( self.journal_file.fileno() )
+
+    def start( self, selector, key_names ):
+        self.append( { 'op': 'start', 'selector': selector, 'key_names': list( key_names ) } )
+
+    def key( self, key_name, key_data ):
+        self.append( { 'op': 'key', 'key_name': key_name, 'key': key_data } )
+
+    def add( self, domain, record ):
+        self.append( { 'op': 'add', 'domain': domain, 'line': record.line() } )
+
+    def delete( self, domain, record ):
+        self.append( { 'op': 'delete', 'domain': domain, 'line': record.line() } )
+
+    # Wraps a DNS API client so successful adds and deletes are journaled
+    def journaled_client( self, dnsapi_client ):
+        if dnsapi_client is None:
+            return None
+        return JournaledClient( dnsapi_client, self )
+
+    # Closes the journal and removes it, the run is complete
+    def finish( self ):
+        self.journal_file.close()
+        try:
+            os.remove( self.filename )
+        except OSError as e:
+            logging.warning( "Error removing journal %s", self.filename )
+            logging.warning( "%s", str( e ) )
+
+    # Closes the journal leaving it in place for --resume
+    def close( self ):
+        self.journal_file.close()
+
+
+# Passes calls through to a DNS API client, journaling each record it adds or deletes
+class JournaledClient( object ):
+    def __init__( self, dnsapi_client, run_journal ):
+        self.dnsapi_client = dnsapi_client
+        self.journal = run_journal
+        if hasattr( dnsapi_client, 'batch' ):
+            self.batch = self.journaled_batch
+
+    def add( self, dnsapi_domain_data, key_data, debugging = False ):
+        result = self.dnsapi_client.add( dnsapi_domain_data, key_data, debugging )
+        self.journal_add( key_data, result )
+        return result
+
+    def delete( self, dnsapi_domain_data, record_data, debugging = False ):
+        result = self.dnsapi_client.delete( dnsapi_domain_data, record_data, debugging )
+        if result:
+            self.journal.delete( record_data[0], record_data )
+        return result
+
+    def journaled_batch( self, operations, debugging = False ):
+        results = self.dnsapi_client.batch( operations, debugging )
+        for operation, result in zip( operations, results ):
+            if operation[0] == 'add':
+                self.journal_add( operation[2], result )
+            elif result:
+                self.journal.delete( operation[2][0], operation[2] )
+        return results
+
+    def journal_add( self, key_data, result ):
+        if result is not None and len( result ) > 1 and result[0]:
+            record = updatedata.UpdateRecord.from_fields( result[1:] )
+            if record is not None:
+                self.journal.add( key_data['domain'], record )
+
+    def close( self ):
+        self.dnsapi_client.close()
+
+    def __getattr__( self, name ):
+        return getattr( self.dnsapi_client, name )
+
+
+# What an unfinished run had done, read back from its journal
+class RunState( object ):
+    def __init__( self ):
+        self.selector = None
+        self.key_names = None
+        self.keys = { }  # Key = key name, Value = key data dict
+        self.adds = []  # (domain, update data line)
+        self.deletes = []  # (domain, update data line)
+
+    # Domains whose new record was added
+    def completed_domains( self ):
+        return set( [domain for domain, line in self.adds] )
+
+    # Brings update data (an UpdateData or StateDB) up to date with the records the run
+    # added and deleted. Records already there are left alone, so this can be done more
+    # than once.
+    def replay( self, update_data ):
+        with update_data.transaction():
+            for domain, line in self.deletes:
+                for record in list( update_data.records_for( domain ) ):
+                    if record.line() == line:
+                        update_data.remove( record )
+            for domain, line in self.adds:
+                if any( [record.line() == line for record in update_data.records_for( domain )] ):
+                    continue
+                record = updatedata.UpdateRecord.from_fields( line.split() )
+                if record is not None:
+                    update_data.add( record )
+
+
+# Reads a journal. Returns a RunState, or None if it couldn't be read. A partly-written
+# last line from a run that died while writing it is ignored.
+def load( filename ):
+    state = RunState()
+    try:
+        with open( filename, 'r' ) as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads( line )
+                except ValueError:
+                    logging.warning( "Ignoring incomplete journal entry in %s", filename )
+                    continue
+                op = entry.get( 'op' )
+                if op == 'start':
+                    if state.selector is None:
+                        state.selector = entry['selector']
+                        state.key_names = entry.get( 'key_names' )
+                elif op == 'key':
+                    state.keys[entry['key_name']] = entry['key']
+                elif op == 'add':
+                    state.adds.append( (entry['domain'], entry['line']) )
+                elif op == 'delete':
+                    state.deletes.append( (entry['domain'], entry['line']) )
+    except (IOError, KeyError) as e:
+        logging.error( "Error reading journal %s", filename )
+        logging.error( "%s", str( e ) )
+        return None
+    return state
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, key file cleanup
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Finding the key files that aren't needed anymore. Key files are named
+# <key name>.<selector>.key and <key name>.<selector>.txt, and a pair is still needed as
+# long as some record in the update data refers to that selector for a domain using the
+# key name.
+
+import logging
+import os
+
+key_file_suffixes = ('.key', '.txt')
+
+
+# Indexes the key files in a directory with a single scan. Returns a dict with
+# (key name, selector) as the key and the list of file names as the value. Only files
+# for the given key names are included.
+def index_key_files( directory, key_names ):
+    index = { }
+    for entry in os.scandir( directory ):
+        name = entry.name
+        if not name.endswith( key_file_suffixes ):
+            continue
+        parts = name.rsplit( '.', 2 )
+        if len( parts ) != 3 or parts[0] not in key_names:
+            continue
+        index.setdefault( (parts[0], parts[1]), [] ).append( name )
+    return index
+
+
+# Finds the key files in directory for the given key names that no update data record
+# refers to anymore. domain_keys is a dict with the domain as the key and its key name as
+# the value, and no files for the key names in keep_keys are returned. Returns a sorted
+# list of file names.
+def obsolete_key_files( directory, key_names, records, domain_keys, keep_keys = () ):
+    candidates = set( key_names ).difference( keep_keys )
+    index = index_key_files( directory, candidates )
+    for record in records:
+        if len( record ) < 2:
+            continue
+        key_name = domain_keys.get( record[0] )
+        if key_name is not None:
+            index.pop( (key_name, record[1]), None )
+    obsolete = []
+    for filenames in index.values():
+        obsolete.extend( filenames )
+    obsolete.sort()
+    return obsolete
+
+
+# Deletes the obsolete files found by obsolete_key_files()
+def remove_key_files( directory, filenames ):
+    for filename in filenames:
+        logging.info( "Removing obsolete file %s", filename )
+        try:
+            os.remove( os.path.join( directory, filename ) )
+        except OSError:
+            logging.warning( "Failed removing obsolete file %s", filename )
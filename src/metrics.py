@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, run metrics
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Timing for the phases of a genkeys.py run, for each key generated and for each call to
+# a DNS API, written out as a JSON report and/or a Prometheus node exporter textfile.
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+# The phases of a run, in the order they happen
+phase_names = ['ini_parse', 'keygen', 'dns_update', 'record_cleanup', 'propagation', 'file_cleanup',
+               'table_write']
+
+# Upper bounds of the latency histogram buckets, in seconds
+histogram_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+
+# Latency histogram in the same form as a Prometheus histogram: cumulative counts of
+# observations no larger than each bucket's bound, plus the total count and sum.
+class Histogram( object ):
+    def __init__( self ):
+        self.bucket_counts = [0] * len( histogram_buckets )
+        self.count = 0
+        self.sum = 0.0
+
+    def observe( self, seconds ):
+        self.count += 1
+        self.sum += seconds
+        for i, bound in enumerate( histogram_buckets ):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+
+    def report( self ):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': collections.OrderedDict( [(str( bound ), count) for bound, count in
+                                                 zip( histogram_buckets, self.bucket_counts )] ),
+        }
+
+    def prometheus_lines( self, name, labels ):
+        lines = []
+        for bound, count in zip( histogram_buckets, self.bucket_counts ):
+            lines.append( "%s_bucket%s %d" % (name, format_labels( labels + [('le', str( bound ))] ), count) )
+        lines.append( "%s_bucket%s %d" % (name, format_labels( labels + [('le', '+Inf')] ), self.count) )
+        lines.append( "%s_sum%s %f" % (name, format_labels( labels ), self.sum) )
+        lines.append( "%s_count%s %d" % (name, format_labels( labels ), self.count) )
+        return lines
+
+
+# Calls to one DNS API operation
+class CallStats( object ):
+    def __init__( self ):
+        self.calls = 0
+        self.failures = 0
+        self.unsupported = 0
+        self.latency = Histogram()
+
+    def report( self ):
+        return {
+            'calls': self.calls,
+            'failures': self.failures,
+            'unsupported': self.unsupported,
+            'latency': self.latency.report(),
+        }
+
+
+class Metrics( object ):
+    def __init__( self ):
+        self.started = time.time()
+        self.phases = collections.OrderedDict( [(name, 0.0) for name in phase_names] )
+        self.current_phase = None
+        self.phase_started = None
+        self.counts = collections.OrderedDict()
+        self.keygen = Histogram()
+        self.dns_calls = collections.OrderedDict()  # Key = (DNS API name, operation), Value = CallStats
+        # DNS calls are recorded from the DNS update worker threads
+        self.lock = threading.Lock()
+
+    # Ends the current phase, if any, and starts timing the named one. Time spent in a
+    # phase that's entered more than once is added up.
+    def phase( self, name ):
+        now = time.perf_counter()
+        if self.current_phase is not None:
+            self.phases[self.current_phase] = self.phases.get( self.current_phase, 0.0 ) + now - self.phase_started
+        self.current_phase = name
+        self.phase_started = now
+
+    def end_phase( self ):
+        if self.current_phase is not None:
+            self.phase( None )
+            self.current_phase = None
+
+    def count( self, name, value ):
+        self.counts[name] = value
+
+    def observe_keygen( self, seconds ):
+        self.keygen.observe( seconds )
+
+    # Records one call to a DNS API. ok is True, False or None for an operation the API
+    # doesn't support. seconds is None for a call that wasn't timed on its own.
+    def observe_dns_call( self, dnsapi_name, operation, seconds, ok ):
+        with self.lock:
+            stats = self.dns_calls.get( (dnsapi_name, operation) )
+            if stats is None:
+                stats = CallStats()
+                self.dns_calls[(dnsapi_name, operation)] = stats
+            stats.calls += 1
+            if ok is None:
+                stats.unsupported += 1
+            elif not ok:
+                stats.failures += 1
+            if seconds is not None:
+                stats.latency.observe( seconds )
+
+    # Wraps a DNS API client so its calls are timed
+    def timed_client( self, dnsapi_client, dnsapi_name ):
+        if dnsapi_client is None:
+            return None
+        return TimedClient( dnsapi_client, dnsapi_name, self )
+
+    def report( self ):
+        self.end_phase()
+        dns = collections.OrderedDict()
+        with self.lock:
+            for (dnsapi_name, operation), stats in self.dns_calls.items():
+                dns.setdefault( dnsapi_name, collections.OrderedDict() )[operation] = stats.report()
+        return {
+            'started': self.started,
+            'wall_time': time.time() - self.started,
+            'phases': self.phases,
+            'counts': self.counts,
+            'keygen': self.keygen.report(),
+            'dns': dns,
+        }
+
+    def log_summary( self ):
+        self.end_phase()
+        for name, seconds in self.phases.items():
+            logging.info( "Phase %s took %.3f seconds", name, seconds )
+        with self.lock:
+            for (dnsapi_name, operation), stats in self.dns_calls.items():
+                if stats.latency.count == 0:
+                    logging.info( "DNS API %s: %d %s calls, %d failed, all in batches", dnsapi_name, stats.calls,
+                                  operation, stats.failures )
+                else:
+                    logging.info( "DNS API %s: %d %s calls, %d failed, %.3f seconds average", dnsapi_name,
+                                  stats.calls, operation, stats.failures, stats.latency.sum / stats.latency.count )
+
+    # Writes the report to a temporary file and renames it into place. Returns False if
+    # the report couldn't be written.
+    def write_json( self, filename ):
+        report = self.report()
+        return write_file( filename, json.dumps( report, indent = 2 ) + '\n' )
+
+    # Writes the metrics in the Prometheus text format, for the node exporter's textfile
+    # collector. The file is renamed into place so the collector never reads a partly
+    # written file. Returns False if the file couldn't be written.
+    def write_textfile( self, filename ):
+        report = self.report()
+        lines = []
+        lines.append( "# HELP genkeys_last_run_timestamp_seconds Time the last genkeys.py run started." )
+        lines.append( "# TYPE genkeys_last_run_timestamp_seconds gauge" )
+        lines.append( "genkeys_last_run_timestamp_seconds %f" % self.started )
+        lines.append( "# HELP genkeys_run_duration_seconds Wall time of the last genkeys.py run." )
+        lines.append( "# TYPE genkeys_run_duration_seconds gauge" )
+        lines.append( "genkeys_run_duration_seconds %f" % report['wall_time'] )
+        lines.append( "# HELP genkeys_phase_duration_seconds Time spent in each phase of the last run." )
+        lines.append( "# TYPE genkeys_phase_duration_seconds gauge" )
+        for name, seconds in self.phases.items():
+            lines.append( "genkeys_phase_duration_seconds%s %f" % (format_labels( [('phase', name)] ), seconds) )
+        lines.append( "# HELP genkeys_run_items Counts from the last run." )
+        lines.append( "# TYPE genkeys_run_items gauge" )
+        for name, value in self.counts.items():
+            lines.append( "genkeys_run_items%s %d" % (format_labels( [('count', name)] ), value) )
+        lines.append( "# HELP genkeys_keygen_duration_seconds Time taken to generate each key." )
+        lines.append( "# TYPE genkeys_keygen_duration_seconds histogram" )
+        lines += self.keygen.prometheus_lines( 'genkeys_keygen_duration_seconds', [] )
+        with self.lock:
+            dns_calls = list( self.dns_calls.items() )
+        lines.append( "# HELP genkeys_dns_calls DNS API calls made in the last run." )
+        lines.append( "# TYPE genkeys_dns_calls gauge" )
+        for (dnsapi_name, operation), stats in dns_calls:
+            labels = [('api', dnsapi_name), ('operation', operation)]
+            lines.append( "genkeys_dns_calls%s %d" % (format_labels( labels ), stats.calls) )
+        lines.append( "# HELP genkeys_dns_failures DNS API calls that failed in the last run." )
+        lines.append( "# TYPE genkeys_dns_failures gauge" )
+        for (dnsapi_name, operation), stats in dns_calls:
+            labels = [('api', dnsapi_name), ('operation', operation)]
+            lines.append( "genkeys_dns_failures%s %d" % (format_labels( labels ), stats.failures) )
+        lines.append( "# HELP genkeys_dns_call_duration_seconds Time taken by each DNS API call in the last run." )
+        lines.append( "# TYPE genkeys_dns_call_duration_seconds histogram" )
+        for (dnsapi_name, operation), stats in dns_calls:
+            if stats.latency.count == 0:
+                continue
+            labels = [('api', dnsapi_name), ('operation', operation)]
+            lines += stats.latency.prometheus_lines( 'genkeys_dns_call_duration_seconds', labels )
+        return write_file( filename, '\n'.join( lines ) + '\n' )
+
+
+# Passes calls through to a DNS API client, recording how long each one took and whether
+# it succeeded. A batch call is timed as a single batch call, which failed if any of its
+# operations did, and each operation in it is counted as an add or delete call without a
+# time of its own, since the time of one operation in a batch isn't known. Listing a
+# domain's records is recorded as a single list call however many requests it took.
+class TimedClient( object ):
+    def __init__( self, dnsapi_client, dnsapi_name, run_metrics ):
+        self.dnsapi_client = dnsapi_client
+        self.dnsapi_name = dnsapi_name
+        self.metrics = run_metrics
+        # Only offer batch() if the client has it, genkeys.py checks for it
+        if hasattr( dnsapi_client, 'batch' ):
+            self.batch = self.timed_batch
+        if hasattr( dnsapi_client, 'list_records' ):
+            self.list_records = self.timed_list_records
+
+    def add( self, dnsapi_domain_data, key_data, debugging = False ):
+        start = time.perf_counter()
+        result = self.dnsapi_client.add( dnsapi_domain_data, key_data, debugging )
+        self.metrics.observe_dns_call( self.dnsapi_name, 'add', time.perf_counter() - start, add_succeeded( result ) )
+        return result
+
+    def delete( self, dnsapi_domain_data, record_data, debugging = False ):
+        start = time.perf_counter()
+        result = self.dnsapi_client.delete( dnsapi_domain_data, record_data, debugging )
+        self.metrics.observe_dns_call( self.dnsapi_name, 'delete', time.perf_counter() - start,
+                                       None if result is None else bool( result ) )
+        return result
+
+    def timed_batch( self, operations, debugging = False ):
+        start = time.perf_counter()
+        results = self.dnsapi_client.batch( operations, debugging )
+        seconds = time.perf_counter() - start
+        batch_ok = True
+        for operation, result in zip( operations, results ):
+            if operation[0] == 'add':
+                ok = add_succeeded( result )
+            else:
+                ok = None if result is None else bool( result )
+            if ok is False:
+                batch_ok = False
+            self.metrics.observe_dns_call( self.dnsapi_name, operation[0], None, ok )
+        self.metrics.observe_dns_call( self.dnsapi_name, 'batch', seconds, batch_ok )
+        return results
+
+    def timed_list_records( self, dnsapi_domain_data, domain, debugging = False ):
+        start = time.perf_counter()
+        result = self.dnsapi_client.list_records( dnsapi_domain_data, domain, debugging )
+        self.metrics.observe_dns_call( self.dnsapi_name, 'list', time.perf_counter() - start, result is not None )
+        return result
+
+    def close( self ):
+        self.dnsapi_client.close()
+
+    # Anything else the client offers is passed through untimed
+    def __getattr__( self, name ):
+        return getattr( self.dnsapi_client, name )
+
+
+def add_succeeded( result ):
+    return result is not None and len( result ) > 0 and bool( result[0] )
+
+
+def format_labels( labels ):
+    if len( labels ) == 0:
+        return ''
+    return '{' + ','.join( ['%s="%s"' % (name, escape_label( value )) for name, value in labels] ) + '}'
+
+
+def escape_label( value ):
+    return str( value ).replace( '\\', '\\\\' ).replace( '"', '\\"' ).replace( '\n', '\\n' )
+
+
+def write_file( filename, text ):
+    temp_filename = filename + '.new'
+    try:
+        with open( temp_filename, 'w' ) as output_file:
+            output_file.write( text )
+        os.rename( temp_filename, filename )
+    except (IOError, OSError) as e:
+        logging.error( "Error writing metrics file %s", filename )
+        logging.error( "%s", str( e ) )
+        return False
+    return True
@@ -0,0 +1,534 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, DNS propagation checks
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that new DKIM records have reached every authoritative nameserver for their
+# domains before the domains are switched over to the new selector. A DNS API returning
+# success only means the provider accepted the record, it can take a while longer before
+# the nameservers receiving mail servers ask are serving it.
+#
+# Everything is done with a small DNS client built on non-blocking UDP sockets and a
+# single selector loop, so the queries for every domain are in flight at the same time
+# and the whole check finishes at one deadline however many domains there are. Only the
+# standard library is used. For each domain:
+#
+#   1. The domain's NS records are looked up through the system's resolvers (from
+#      /etc/resolv.conf), along with the addresses of the nameservers when the answer
+#      doesn't include them. Domains sharing nameservers share the lookups.
+#   2. Each nameserver is asked directly for the TXT record, without recursion, until it
+#      answers with the expected key or the deadline passes. A nameserver that doesn't
+#      have the record yet is asked again every poll_interval seconds.
+#
+# The nameservers to ask can also be given outright (the --propagation-ns option of
+# genkeys.py), which skips the NS lookups and lets the check be run against a local
+# stand-in DNS server (see benchmarks/dns_standin.py).
+
+import heapq
+import logging
+import random
+import selectors
+import socket
+import struct
+import time
+
+# Seconds to wait for an answer before sending a query again, to the next server if there
+# are several to choose from
+query_timeout = 1.0
+# Times a query is sent before it's given up on, so queries to dead nameservers don't hold
+# on to their places among the max_outstanding ones
+max_attempts = 4
+# Seconds before asking a nameserver that doesn't have the record yet again
+poll_interval = 5.0
+# Most queries waiting for answers at any one time, the rest wait their turn
+max_outstanding = 256
+# UDP payload size offered with EDNS, large enough for 4096-bit keys
+edns_payload_size = 4096
+
+type_a = 1
+type_ns = 2
+type_cname = 5
+type_txt = 16
+type_aaaa = 28
+type_opt = 41
+class_in = 1
+rcode_nxdomain = 3
+
+
+class Record( object ):
+    __slots__ = ('name', 'rtype', 'data')
+
+    def __init__( self, name, rtype, data ):
+        self.name = name
+        self.rtype = rtype
+        self.data = data
+
+
+class Message( object ):
+    def __init__( self ):
+        self.id = 0
+        self.truncated = False
+        self.rcode = 0
+        self.question = None  # (name, type) of the first question
+        self.answers = []
+        self.authority = []
+        self.additional = []
+
+
+# Builds a query for name and qtype, with an EDNS OPT record offering a large UDP payload
+def build_query( query_id, name, qtype, recursion_desired = False ):
+    flags = 0x0100 if recursion_desired else 0x0000
+    return struct.pack( '>HHHHHH', query_id, flags, 1, 0, 0, 1 ) + encode_name( name ) + \
+        struct.pack( '>HH', qtype, class_in ) + b'\x00' + struct.pack( '>HHIH', type_opt, edns_payload_size, 0, 0 )
+
+
+def encode_name( name ):
+    encoded = b''
+    for label in name.rstrip( '.' ).encode( 'idna' ).split( b'.' ):
+        if len( label ) > 0:
+            encoded += struct.pack( 'B', len( label ) ) + label
+    return encoded + b'\x00'
+
+
+# Names are compared in lower case without the trailing dot, with international names
+# in their ASCII form
+def normalize_name( name ):
+    name = name.rstrip( '.' ).lower()
+    try:
+        return name.encode( 'idna' ).decode( 'ascii' )
+    except UnicodeError:
+        return name
+
+
+# Reads a possibly-compressed name. Returns (name, offset just past the name in the
+# record). Raises ValueError for a malformed name.
+def read_name( data, offset ):
+    labels = []
+    end_offset = None
+    jumps = 0
+    while True:
+        if offset >= len( data ):
+            raise ValueError( "name runs past end of message" )
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if offset + 1 >= len( data ):
+                raise ValueError( "truncated compression pointer" )
+            if end_offset is None:
+                end_offset = offset + 2
+            jumps += 1
+            if jumps > 64:
+                raise ValueError( "compression loop" )
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+        elif length == 0:
+            if end_offset is None:
+                end_offset = offset + 1
+            return normalize_name( '.'.join( labels ) ), end_offset
+        else:
+            labels.append( data[offset + 1:offset + 1 + length].decode( 'ascii', 'replace' ) )
+            offset += 1 + length
+
+
+# Parses a response. Returns a Message, or None if the response is malformed. Only the
+# record types the checks need are decoded, the rest are kept as raw bytes.
+def parse_message( data ):
+    try:
+        message = Message()
+        message.id, flags, qdcount, ancount, nscount, arcount = struct.unpack( '>HHHHHH', data[:12] )
+        message.truncated = bool( flags & 0x0200 )
+        message.rcode = flags & 0x000F
+        offset = 12
+        for i in range( qdcount ):
+            name, offset = read_name( data, offset )
+            qtype, qclass = struct.unpack( '>HH', data[offset:offset + 4] )
+            offset += 4
+            if message.question is None:
+                message.question = (name, qtype)
+        for section, count in ((message.answers, ancount), (message.authority, nscount),
+                               (message.additional, arcount)):
+            for i in range( count ):
+                name, offset = read_name( data, offset )
+                rtype, rclass, ttl, rdlength = struct.unpack( '>HHIH', data[offset:offset + 10] )
+                offset += 10
+                rdata = data[offset:offset + rdlength]
+                if len( rdata ) != rdlength:
+                    return None
+                section.append( Record( name, rtype, parse_rdata( data, offset, rtype, rdata ) ) )
+                offset += rdlength
+        return message
+    except (ValueError, struct.error, IndexError):
+        return None
+
+
+def parse_rdata( data, offset, rtype, rdata ):
+    if rtype in (type_ns, type_cname):
+        return read_name( data, offset )[0]
+    elif rtype == type_a and len( rdata ) == 4:
+        return socket.inet_ntop( socket.AF_INET, rdata )
+    elif rtype == type_aaaa and len( rdata ) == 16:
+        return socket.inet_ntop( socket.AF_INET6, rdata )
+    elif rtype == type_txt:
+        strings = []
+        i = 0
+        while i < len( rdata ):
+            length = rdata[i]
+            strings.append( rdata[i + 1:i + 1 + length] )
+            i += 1 + length
+        return b''.join( strings ).decode( 'utf-8', 'replace' )
+    return rdata
+
+
+# One query waiting for an answer
+class Query( object ):
+    def __init__( self, query_id, servers, name, qtype, recursion_desired, callback ):
+        self.id = query_id
+        self.servers = servers
+        self.name = normalize_name( name )
+        self.qtype = qtype
+        self.recursion_desired = recursion_desired
+        self.callback = callback
+        self.attempt = 0
+
+    @property
+    def server( self ):
+        return self.servers[self.attempt % len( self.servers )]
+
+
+# The DNS client. query() starts a query and returns at once, and the callback is called
+# from run() with the response Message when it arrives. Queries that get no answer are
+# sent again every query_timeout seconds, and after max_attempts tries the callback is
+# called with None instead.
+class Resolver( object ):
+    def __init__( self ):
+        self.selector = selectors.DefaultSelector()
+        self.sockets = { }  # Key = address family, Value = socket
+        self.pending = { }  # Key = query ID, Value = Query
+        self.waiting = []  # Queries not sent yet because too many are outstanding
+        self.timers = []  # Heap of (time, sequence, function)
+        self.timer_sequence = 0
+        self.random = random.SystemRandom()
+
+    # Sends a query for name and qtype to the first of servers, a list of (address, port)
+    def query( self, servers, name, qtype, callback, recursion_desired = False ):
+        query = Query( None, servers, name, qtype, recursion_desired, callback )
+        if len( self.pending ) >= max_outstanding:
+            self.waiting.append( query )
+        else:
+            self.start( query )
+
+    # Calls function with no arguments after delay seconds
+    def call_later( self, delay, function ):
+        self.timer_sequence += 1
+        heapq.heappush( self.timers, (time.monotonic() + delay, self.timer_sequence, function) )
+
+    def start( self, query ):
+        query.id = self.random.randrange( 0, 65536 )
+        while query.id in self.pending:
+            query.id = self.random.randrange( 0, 65536 )
+        self.pending[query.id] = query
+        self.send( query )
+
+    def send( self, query ):
+        address, port = query.server
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        try:
+            self.socket_for( family ).sendto( build_query( query.id, query.name, query.qtype,
+                                                           query.recursion_desired ), (address, port) )
+        except (OSError, UnicodeError) as e:
+            logging.debug( "Error sending DNS query for %s to %s: %s", query.name, address, str( e ) )
+        attempt = query.attempt
+        self.call_later( query_timeout, lambda: self.resend( query, attempt ) )
+
+    def resend( self, query, attempt ):
+        if self.pending.get( query.id ) is not query or query.attempt != attempt:
+            return
+        query.attempt += 1
+        if query.attempt >= max_attempts:
+            logging.debug( "No answer from %s for %s", query.server[0], query.name )
+            self.complete( query )
+            query.callback( None )
+        else:
+            self.send( query )
+
+    # Takes an answered or abandoned query out of pending, making room for a waiting one
+    def complete( self, query ):
+        del self.pending[query.id]
+        if len( self.waiting ) > 0:
+            self.start( self.waiting.pop( 0 ) )
+
+    def socket_for( self, family ):
+        sock = self.sockets.get( family )
+        if sock is None:
+            sock = socket.socket( family, socket.SOCK_DGRAM )
+            sock.setblocking( False )
+            self.sockets[family] = sock
+            self.selector.register( sock, selectors.EVENT_READ )
+        return sock
+
+    # Handles responses and timers until finished() returns True or the deadline (a
+    # time.monotonic() value) passes. Returns True if finished.
+    def run( self, deadline, finished ):
+        while not finished():
+            now = time.monotonic()
+            if now >= deadline:
+                return False
+            timeout = deadline - now
+            if len( self.timers ) > 0:
+                timeout = min( timeout, max( 0.0, self.timers[0][0] - now ) )
+            for key, events in self.selector.select( timeout ):
+                self.receive( key.fileobj )
+            now = time.monotonic()
+            while len( self.timers ) > 0 and self.timers[0][0] <= now:
+                function = heapq.heappop( self.timers )[2]
+                function()
+        return True
+
+    def receive( self, sock ):
+        while True:
+            try:
+                data, address = sock.recvfrom( 65535 )
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # An ICMP error from an earlier send, the query will be sent again
+                continue
+            message = parse_message( data )
+            if message is None:
+                continue
+            query = self.pending.get( message.id )
+            if query is None or address[0] != query.server[0] or message.question is None or \
+                    message.question != (query.name, query.qtype):
+                continue
+            if message.truncated:
+                message = tcp_query( query )
+                if message is None:
+                    continue
+            self.complete( query )
+            query.callback( message )
+
+    def close( self ):
+        for sock in self.sockets.values():
+            self.selector.unregister( sock )
+            sock.close()
+        self.selector.close()
+
+
+# Asks for a truncated answer again over TCP. This blocks, but answers too large for UDP
+# are rare enough that it isn't worth doing without blocking. Returns the Message, or None.
+def tcp_query( query ):
+    address, port = query.server
+    packet = build_query( query.id, query.name, query.qtype, query.recursion_desired )
+    try:
+        with socket.create_connection( (address, port), timeout = query_timeout * 2 ) as sock:
+            sock.sendall( struct.pack( '>H', len( packet ) ) + packet )
+            data = b''
+            length = None
+            while length is None or len( data ) < length + 2:
+                chunk = sock.recv( 65535 )
+                if not chunk:
+                    return None
+                data += chunk
+                if length is None and len( data ) >= 2:
+                    length = struct.unpack( '>H', data[:2] )[0]
+            return parse_message( data[2:length + 2] )
+    except OSError as e:
+        logging.debug( "Error in TCP DNS query for %s to %s: %s", query.name, address, str( e ) )
+        return None
+
+
+# Resolvers listed in /etc/resolv.conf, as (address, port)
+def system_resolvers( filename = '/etc/resolv.conf' ):
+    servers = []
+    try:
+        with open( filename, 'r' ) as resolv_file:
+            for line in resolv_file:
+                fields = line.split()
+                if len( fields ) >= 2 and fields[0] == 'nameserver':
+                    servers.append( (fields[1].split( '%' )[0], 53) )
+    except IOError as e:
+        logging.warning( "Error reading %s: %s", filename, str( e ) )
+    return servers
+
+
+# Parses a host:port (or [address]:port for IPv6, or just a host for port 53) nameserver
+# given on the command line into (address, port). Returns None if it's invalid or the host
+# can't be resolved.
+def parse_server( text ):
+    host, port = text, '53'
+    if text.startswith( '[' ) and ']' in text:
+        host, sep, rest = text[1:].partition( ']' )
+        if rest.startswith( ':' ):
+            port = rest[1:]
+    elif text.count( ':' ) == 1:
+        host, port = text.split( ':' )
+    try:
+        port = int( port )
+        address = socket.getaddrinfo( host, port, 0, socket.SOCK_DGRAM )[0][4][0]
+    except (ValueError, OSError) as e:
+        logging.error( "Invalid nameserver %s: %s", text, str( e ) )
+        return None
+    return address, port
+
+
+# Shares lookups between the domains that need them. Each key is looked up once, and
+# every callback asking for it gets the result.
+class SharedLookups( object ):
+    def __init__( self ):
+        self.results = { }  # Key = lookup key, Value = result
+        self.waiters = { }  # Key = lookup key, Value = list of callbacks
+
+    # Calls callback with the result for key, starting the lookup with start( done ) if
+    # it's the first time key has been asked for
+    def get( self, key, start, callback ):
+        if key in self.results:
+            callback( self.results[key] )
+        elif key in self.waiters:
+            self.waiters[key].append( callback )
+        else:
+            self.waiters[key] = [callback]
+            start( lambda result: self.finish( key, result ) )
+
+    def finish( self, key, result ):
+        self.results[key] = result
+        for callback in self.waiters.pop( key, [] ):
+            callback( result )
+
+
+# Runs the checks for a list of (domain, record name, expected TXT value) and returns the
+# set of domains whose record every nameserver is serving. The check gives up on whatever
+# is left after timeout seconds. nameservers, if given, is a list of (address, port) to
+# ask instead of each domain's own nameservers, and resolvers a list of (address, port)
+# to look up the nameservers with instead of the system's resolvers.
+def check_records( checks, timeout, nameservers = None, resolvers = None ):
+    checker = PropagationCheck( nameservers, resolvers )
+    try:
+        return checker.run( checks, timeout )
+    finally:
+        checker.resolver.close()
+
+
+class PropagationCheck( object ):
+    def __init__( self, nameservers = None, resolvers = None ):
+        self.resolver = Resolver()
+        self.nameservers = nameservers
+        self.resolvers = resolvers if resolvers is not None else system_resolvers()
+        self.lookups = SharedLookups()
+        self.propagated = set()
+        self.remaining = 0
+
+    def run( self, checks, timeout ):
+        deadline = time.monotonic() + timeout
+        if self.nameservers is None and len( self.resolvers ) == 0:
+            logging.error( "No resolvers found to look up nameservers with" )
+            return self.propagated
+        self.remaining = len( checks )
+        for domain, record_name, expected in checks:
+            self.check( domain, normalize_name( record_name ), ''.join( expected.split() ) )
+        self.resolver.run( deadline, lambda: self.remaining == 0 )
+        return self.propagated
+
+    def check( self, domain, record_name, expected ):
+        # One entry per nameserver, True once it's serving the record
+        confirmed = []
+
+        def have_nameservers( hosts ):
+            if not hosts:
+                logging.warning( "No nameservers found for %s", domain )
+                self.remaining -= 1
+                return
+            confirmed.extend( [False] * len( hosts ) )
+            for i, addresses in enumerate( hosts ):
+                ask( i, addresses )
+
+        def ask( i, addresses ):
+            self.resolver.query( addresses, record_name, type_txt,
+                                 lambda message: answered( i, addresses, message ) )
+
+        # message is None if the nameserver didn't answer, it's asked again like one that
+        # doesn't have the record yet
+        def answered( i, addresses, message ):
+            values = []
+            if message is not None:
+                values = [''.join( record.data.split() ) for record in message.answers if
+                          record.rtype == type_txt and record.name == record_name]
+            if expected not in values:
+                logging.debug( "Nameserver %s doesn't have %s yet", addresses[0][0], record_name )
+                self.resolver.call_later( poll_interval, lambda: ask( i, addresses ) )
+                return
+            confirmed[i] = True
+            if all( confirmed ):
+                logging.info( "%s has propagated to %d nameservers", record_name, len( confirmed ) )
+                self.propagated.add( domain )
+                self.remaining -= 1
+
+        if self.nameservers is not None:
+            have_nameservers( [[nameserver] for nameserver in self.nameservers] )
+        else:
+            self.zone_nameservers( normalize_name( domain ), have_nameservers )
+
+    # Finds the nameservers for the zone a domain is in. Calls callback with a list holding
+    # the list of (address, port) for each nameserver, or None if there aren't any.
+    def zone_nameservers( self, zone, callback ):
+        def start( done ):
+            self.resolver.query( self.resolvers, zone, type_ns, lambda message: have_ns( message, done ),
+                                 recursion_desired = True )
+
+        def have_ns( message, done ):
+            if message is None:
+                done( None )
+                return
+            hosts = [record.data for record in message.answers if record.rtype == type_ns and record.name == zone]
+            if len( hosts ) == 0:
+                hosts = [record.data for record in message.authority if record.rtype == type_ns]
+            if len( hosts ) == 0:
+                # Not a zone of its own, the records are in the parent's zone
+                if message.rcode != rcode_nxdomain and zone.count( '.' ) > 1:
+                    self.zone_nameservers( zone.split( '.', 1 )[1], done )
+                else:
+                    done( None )
+                return
+            glue = { }  # Key = nameserver name, Value = list of addresses
+            for record in message.additional:
+                if record.rtype in (type_a, type_aaaa) and isinstance( record.data, str ):
+                    glue.setdefault( record.name, [] ).append( (record.data, 53) )
+            results = [None] * len( hosts )
+            left = [len( hosts )]
+
+            def have_addresses( i, addresses ):
+                results[i] = addresses
+                left[0] -= 1
+                if left[0] == 0:
+                    found = [result for result in results if result]
+                    done( found if found else None )
+
+            for i, host in enumerate( hosts ):
+                if host in glue:
+                    have_addresses( i, glue[host] )
+                else:
+                    self.host_addresses( host, lambda addresses, i = i: have_addresses( i, addresses ) )
+
+        self.lookups.get( ('ns', zone), start, callback )
+
+    # Looks up a nameserver's IPv4 addresses. Calls callback with the list of (address,
+    # port), empty if there aren't any.
+    def host_addresses( self, host, callback ):
+        def start( done ):
+            self.resolver.query( self.resolvers, host, type_a,
+                                 lambda message: done( [(record.data, 53) for record in
+                                                        (message.answers if message is not None else []) if
+                                                        record.rtype == type_a and isinstance( record.data, str )] ),
+                                 recursion_desired = True )
+
+        self.lookups.get( ('a', host), start, callback )
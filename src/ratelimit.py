@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, request pacing and retries for DNS APIs
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Not a DNS API module itself. Paces the requests made to each DNS API with a token
+# bucket and retries requests the provider turned away or failed to answer, so a run
+# goes at the fastest rate the provider will put up with instead of losing domains to
+# rate limiting. dnshttp sessions use this for every HTTP request, and modules that don't
+# use HTTP can call call() directly with their own send function.
+#
+# Settings for each API come from the rate=, burst= and retries= options in dnsapi.ini
+# (see configure()). Without them requests aren't paced, but are still retried.
+
+import datetime
+import email.utils
+import logging
+import random
+import threading
+import time
+
+# Retries of a failed request when dnsapi.ini doesn't say otherwise
+default_retries = 3
+# Exponential backoff between retries when the provider doesn't give a Retry-After time
+backoff_base = 1.0
+backoff_max = 60.0
+# Longest Retry-After we'll wait for, a request asked to wait longer fails instead
+max_retry_after = 300.0
+
+# Responses that mean the request wasn't carried out and can be sent again
+retry_always_statuses = (429, 503)
+# Responses that may mean the request was carried out, only retried for idempotent requests
+retry_idempotent_statuses = (500, 502, 504)
+
+
+# Token bucket for one DNS API. Holds up to burst tokens and gains rate tokens a second,
+# and each request takes one. When the provider asks us to back off, every request to the
+# API waits, not just the one that was turned away.
+class Limiter( object ):
+    def __init__( self, rate = None, burst = None, retries = default_retries ):
+        self.rate = rate
+        self.burst = burst if burst is not None else max( 1.0, rate or 0.0 )
+        self.retries = retries
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    # Waits until a request may be sent
+    def acquire( self ):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.rate is None:
+                        return
+                    self.tokens = min( self.burst, self.tokens + (now - self.updated) * self.rate )
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep( wait )
+
+    # Holds up all requests for the given number of seconds
+    def pause( self, seconds ):
+        with self.lock:
+            self.paused_until = max( self.paused_until, time.monotonic() + seconds )
+
+
+limiters = { }  # Key = DNS API name, Value = Limiter
+limiters_lock = threading.Lock()
+
+
+# Sets up pacing and retries for a DNS API from its dnsapi.ini options:
+#   rate:    requests per second, no pacing if not given
+#   burst:   requests that can be sent at once before pacing starts, default max(1, rate)
+#   retries: times a failed request is retried, default default_retries
+# Returns False if an option's value is invalid, in which case the defaults are used.
+def configure( dnsapi_name, options ):
+    try:
+        rate = float( options['rate'] ) if 'rate' in options else None
+        burst = float( options['burst'] ) if 'burst' in options else None
+        retries = int( options.get( 'retries', default_retries ) )
+        if (rate is not None and rate <= 0) or (burst is not None and burst < 1) or retries < 0:
+            raise ValueError( "out of range" )
+    except ValueError as e:
+        logging.error( "Invalid rate limit setting for DNS API %s: %s", dnsapi_name, str( e ) )
+        return False
+    with limiters_lock:
+        limiters[dnsapi_name] = Limiter( rate, burst, retries )
+    return True
+
+
+def get_limiter( dnsapi_name ):
+    with limiters_lock:
+        limiter = limiters.get( dnsapi_name )
+        if limiter is None:
+            limiter = Limiter()
+            limiters[dnsapi_name] = limiter
+    return limiter
+
+
+# Sends a request to a DNS API, pacing and retrying it. send is a function taking no
+# arguments that sends the request and returns a response with status_code and headers
+# attributes. idempotent says whether the request can safely be repeated if it might have
+# been carried out already. transient_error is a function taking an exception raised by
+# send and idempotent, and returning True if the request can be retried. Returns the last
+# response, or raises the last exception if every attempt raised one.
+def call( dnsapi_name, send, idempotent = True, transient_error = None ):
+    limiter = get_limiter( dnsapi_name )
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            response = send()
+        except Exception as e:
+            if attempt >= limiter.retries or transient_error is None or not transient_error( e, idempotent ):
+                raise
+            delay = backoff( attempt )
+            logging.warning( "DNS API %s: request failed (%s), retrying in %.1f seconds", dnsapi_name, str( e ),
+                             delay )
+            time.sleep( delay )
+            attempt += 1
+            continue
+
+        status = response.status_code
+        if status not in retry_always_statuses and not (idempotent and status in retry_idempotent_statuses):
+            return response
+        if attempt >= limiter.retries:
+            return response
+        retry_after = parse_retry_after( response.headers.get( 'Retry-After' ) )
+        if retry_after is not None and retry_after > max_retry_after:
+            logging.warning( "DNS API %s: HTTP %d asking to retry after %.0f seconds, giving up", dnsapi_name, status,
+                             retry_after )
+            return response
+        delay = retry_after if retry_after is not None else backoff( attempt )
+        logging.warning( "DNS API %s: HTTP %d, retrying in %.1f seconds", dnsapi_name, status, delay )
+        if status == 429:
+            # Being rate limited applies to every request, hold them all up
+            limiter.pause( delay )
+        else:
+            time.sleep( delay )
+        attempt += 1
+
+
+# Backoff before retry number attempt + 1, doubling each time up to backoff_max and
+# randomized so parallel requests don't all retry at the same moment
+def backoff( attempt ):
+    delay = min( backoff_max, backoff_base * (2 ** attempt) )
+    return delay * random.uniform( 0.5, 1.0 )
+
+
+# Retry-After is either a number of seconds or an HTTP date. Returns seconds from now,
+# or None if there's no usable value.
+def parse_retry_after( value ):
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return max( 0.0, float( value ) )
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime( value )
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+    if when.tzinfo is None:
+        when = when.replace( tzinfo = datetime.timezone.utc )
+    return max( 0.0, (when - datetime.datetime.now( datetime.timezone.utc )).total_seconds() )
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, reconciling update data with the DNS providers
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The update data is the only record genkeys.py keeps of the DKIM records it's added, and
+# records it lost track of (a run that died before saving, a module that can't delete)
+# stay in DNS forever. Reconciling compares the update data against the records actually
+# in each domain's zone, as listed by the DNS API client's list_records() method (see
+# ModuleInterface.md), and sorts out the differences:
+#
+#   orphans : records in DNS that aren't in the update data and aren't wanted, to be deleted
+#   missing : records in DNS for a key still in use that aren't in the update data, to be
+#             added to it
+#   stale   : records in the update data that aren't in DNS any more, to be removed from it
+#
+# Only records with selectors genkeys.py could have created are ever treated as orphans,
+# so DKIM records for other senders (a mail service's own selector, say) are left alone.
+
+import logging
+import re
+
+import updatedata
+
+# Selectors genkeys.py generates automatically, YYYYMM with an optional suffix from -a
+auto_selector_pattern = re.compile( r'^[0-9]{6}[A-Z]?$' )
+
+
+# Lists the DKIM records in a domain's zone through a client's list_records(). Returns a
+# list of UpdateRecord, or None if the records couldn't be listed.
+def list_domain_records( dnsapi_client, dnsapi_domain_data, domain, debugging = False ):
+    listed = dnsapi_client.list_records( dnsapi_domain_data, domain, debugging )
+    if listed is None:
+        return None
+    records = []
+    for fields in listed:
+        record = updatedata.UpdateRecord.from_fields( fields )
+        if record is not None:
+            records.append( record )
+    return records
+
+
+# Whether a listed record and an update data record are the same record. Records are
+# matched on the selector and the module's first field (normally the provider's record
+# ID). If either side doesn't have that field, or it doesn't match, the rest of the
+# module's fields (the record value, for modules that keep it) are compared instead.
+def same_record( known, listed ):
+    if known.selector != listed.selector:
+        return False
+    if len( known.data ) == 0 or len( listed.data ) == 0:
+        return True
+    if str( known.data[0] ) == str( listed.data[0] ):
+        return True
+    return len( known.data ) > 1 and ' '.join( known.data[1:] ) == ' '.join( listed.data[1:] )
+
+
+# Compares the records listed for a domain against its update data records. in_use is a
+# function taking a selector and returning True if the domain's key for that selector is
+# still in use, and managed_selectors the set of selectors genkeys.py is known to have
+# used. Returns (orphans, missing, stale) lists of records as described above.
+#
+# A listed record that doesn't match any update data record but has the selector of one
+# that isn't in DNS any more is the same record with a new ID (eg. it was re-created). It's
+# adopted, added to the update data with the new ID in place of the stale record, rather
+# than being taken for a duplicate. Only a second record for a selector whose update data
+# record was found in DNS is a duplicate.
+def diff_records( listed, known, in_use, managed_selectors ):
+    orphans = []
+    missing = []
+    matched = set()  # Indexes of known records found in DNS
+    unmatched = []  # Listed records not found in the update data
+    for record in listed:
+        match = None
+        for i, known_record in enumerate( known ):
+            if i not in matched and same_record( known_record, record ):
+                match = i
+                break
+        if match is not None:
+            matched.add( match )
+        else:
+            unmatched.append( record )
+    recorded = set( [known[i].selector for i in matched] )  # Selectors with a record in DNS
+    stale = [known_record for i, known_record in enumerate( known ) if i not in matched]
+    replaceable = { }  # Key = selector, Value = stale records for it that haven't been adopted
+    for known_record in stale:
+        replaceable.setdefault( known_record.selector, [] ).append( known_record )
+    for record in unmatched:
+        if record.selector not in recorded and len( replaceable.get( record.selector, [] ) ) > 0:
+            stale_record = replaceable[record.selector].pop( 0 )
+            created = stale_record.created_text() or record.created_text()
+            missing.append( updatedata.UpdateRecord( record.domain, record.selector, created, record.data ) )
+            recorded.add( record.selector )
+        elif in_use( record.selector ) and record.selector not in recorded:
+            missing.append( record )
+            recorded.add( record.selector )
+        elif record.selector in managed_selectors or auto_selector_pattern.match( record.selector ):
+            # A second record for a selector that's already recorded is a duplicate left by
+            # a failed run, and a record for a key that's gone is no use to anyone
+            orphans.append( record )
+        else:
+            logging.info( "Leaving %s:%s alone, not created by genkeys.py", record.domain, record.selector )
+    return orphans, missing, stale
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, SQLite state store
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Optional replacement for the flat state files. Holds the DNS update data records, the
+# keys generated for each selector and the key/signing table rows for each domain, so a
+# run only reads and changes the rows for the domains it actually touches. The flat files
+# can be exported from it whenever they're needed.
+#
+# StateDB can be used anywhere an updatedata.UpdateData is.
+
+import contextlib
+import logging
+import os
+import sqlite3
+
+import updatedata
+
+schema = """
+CREATE TABLE IF NOT EXISTS update_records (
+    id       INTEGER PRIMARY KEY,
+    domain   TEXT NOT NULL,
+    selector TEXT,
+    created  TEXT,
+    data     TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS update_records_domain ON update_records ( domain );
+CREATE TABLE IF NOT EXISTS keys (
+    key_name TEXT NOT NULL,
+    selector TEXT NOT NULL,
+    plain    TEXT NOT NULL,
+    chunked  TEXT NOT NULL,
+    created  TEXT NOT NULL DEFAULT ( strftime( '%Y-%m-%dT%H:%M:%S', 'now' ) ),
+    PRIMARY KEY ( key_name, selector )
+);
+CREATE TABLE IF NOT EXISTS table_rows (
+    domain   TEXT PRIMARY KEY,
+    tag      TEXT NOT NULL,
+    selector TEXT NOT NULL,
+    key_file TEXT NOT NULL
+);
+"""
+
+
+class StateDB( object ):
+    def __init__( self, filename ):
+        self.filename = filename
+        self.is_new = not os.path.exists( filename )
+        # Transactions are started explicitly, everything else is committed as it's done
+        self.db = sqlite3.connect( filename, isolation_level = None )
+        self.db.executescript( schema )
+        self.in_transaction = False
+
+    def close( self ):
+        self.db.close()
+
+    # Groups everything done inside the with block into a single transaction. Nested
+    # uses join the outermost transaction.
+    @contextlib.contextmanager
+    def transaction( self ):
+        if self.in_transaction:
+            yield
+            return
+        self.db.execute( "BEGIN" )
+        self.in_transaction = True
+        try:
+            yield
+        except BaseException:
+            self.db.execute( "ROLLBACK" )
+            raise
+        else:
+            self.db.execute( "COMMIT" )
+        finally:
+            self.in_transaction = False
+
+    # Update data records
+
+    def records_for( self, domain ):
+        cursor = self.db.execute( "SELECT id, domain, selector, created, data FROM update_records "
+                                  "WHERE domain = ? ORDER BY id", (domain,) )
+        return [make_record( row ) for row in cursor]
+
+    def add( self, record ):
+        cursor = self.db.execute( "INSERT INTO update_records ( domain, selector, created, data ) "
+                                  "VALUES ( ?, ?, ?, ? )", record_row( record ) )
+        record.row_id = cursor.lastrowid
+
+    def remove( self, record ):
+        if record.row_id is not None:
+            self.db.execute( "DELETE FROM update_records WHERE id = ?", (record.row_id,) )
+
+    def __iter__( self ):
+        cursor = self.db.execute( "SELECT id, domain, selector, created, data FROM update_records ORDER BY id" )
+        for row in cursor:
+            yield make_record( row )
+
+    def __len__( self ):
+        return self.db.execute( "SELECT COUNT(*) FROM update_records" ).fetchone()[0]
+
+    # Exports the update data records to a dns_update_data.ini file
+    def write( self, filename ):
+        updatedata.write_records( self, filename )
+
+    # Keys generated for a selector, keys is a dict with key name as the key and the key data
+    # dict from gen_key() as the value.
+    def add_keys( self, keys ):
+        with self.transaction():
+            self.db.executemany( "INSERT OR REPLACE INTO keys ( key_name, selector, plain, chunked ) "
+                                 "VALUES ( ?, ?, ?, ? )",
+                                 [(key_name, key_data['selector'], key_data['plain'], key_data['chunked'])
+                                  for key_name, key_data in keys.items()] )
+
+    # Key and signing table rows, each a tuple of (tag, domain, selector, key file)
+
+    def set_table_rows( self, rows ):
+        with self.transaction():
+            self.db.executemany( "INSERT OR REPLACE INTO table_rows ( tag, domain, selector, key_file ) "
+                                 "VALUES ( ?, ?, ?, ? )", rows )
+
+    def table_rows( self ):
+        cursor = self.db.execute( "SELECT tag, domain, selector, key_file FROM table_rows ORDER BY domain" )
+        for row in cursor:
+            yield row
+
+    # Loads the existing flat files into a new state database
+    def import_files( self, update_data_filename, key_table_filename ):
+        with self.transaction():
+            update_data = updatedata.load( update_data_filename )
+            if update_data is not None:
+                for record in update_data:
+                    self.add( record )
+                logging.info( "Imported %d update data records from %s", len( update_data ), update_data_filename )
+            rows = []
+            try:
+                with open( key_table_filename, 'r' ) as key_table_file:
+                    for line in key_table_file:
+                        fields = line.split()
+                        if len( fields ) < 2 or fields[0][0] == '#':
+                            continue
+                        key_fields = fields[1].split( ':', 2 )
+                        if len( key_fields ) == 3:
+                            rows.append( (fields[0], key_fields[0], key_fields[1], key_fields[2]) )
+            except IOError as e:
+                logging.warning( "Error accessing file %s", key_table_filename )
+                logging.warning( "%s", str( e ) )
+            self.set_table_rows( rows )
+            logging.info( "Imported %d key table entries from %s", len( rows ), key_table_filename )
+
+
+def record_row( record ):
+    return (record.domain, record.selector, record.created_text(),
+            '\t'.join( [str( field ) for field in record.data] ))
+
+
+def make_record( row ):
+    data = row[4].split( '\t' ) if row[4] else []
+    record = updatedata.UpdateRecord( row[1], row[2], row[3], data )
+    record.row_id = row[0]
+    return record
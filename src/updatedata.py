@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, DNS update data
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# In-memory form of dns_update_data.ini. Each line of the file is one record: the domain,
+# the selector, the time the record was created and then the DNS API module's own fields
+# identifying the record at the provider.
+
+import collections
+import contextlib
+import datetime
+import logging
+import os
+
+timestamp_format = '%Y-%m-%dT%H:%M:%S'
+
+
+# One record from the update data. Records behave like the list of fields from the file
+# line (record[0] is the domain, record[3:] the module's fields and so on), which is what
+# the DNS API modules' delete functions expect. The creation timestamp is only parsed the
+# first time it's needed, most records are just read and written back unchanged.
+class UpdateRecord( object ):
+    __slots__ = ('domain', 'selector', '_created', '_created_text', 'data', 'row_id')
+
+    # created is either a datetime or the timestamp text from the file
+    def __init__( self, domain, selector, created, data ):
+        self.domain = domain
+        self.selector = selector
+        if isinstance( created, datetime.datetime ):
+            self._created = created
+            self._created_text = None
+        else:
+            self._created = None
+            self._created_text = created
+        self.data = data
+        self.row_id = None  # Set by statedb for records stored there
+
+    # Creates a record from a list of fields, as read from the file or returned by a
+    # DNS API module's add function (without the success flag). Returns None if there
+    # are no fields.
+    @staticmethod
+    def from_fields( fields ):
+        if len( fields ) == 0:
+            return None
+        return UpdateRecord( fields[0], fields[1] if len( fields ) > 1 else None,
+                             fields[2] if len( fields ) > 2 else None, list( fields[3:] ) )
+
+    @property
+    def created( self ):
+        if self._created is None and self._created_text is not None:
+            self._created = parse_timestamp( self._created_text )
+        return self._created
+
+    def created_before( self, cutoff ):
+        created = self.created
+        return created is not None and created < cutoff
+
+    # The creation timestamp as written to the file, None if the record doesn't have one
+    def created_text( self ):
+        if self._created_text is not None:
+            return self._created_text
+        elif self._created is not None:
+            return self._created.strftime( timestamp_format )
+        return None
+
+    def fields( self ):
+        fields = [self.domain]
+        if self.selector is not None:
+            fields.append( self.selector )
+            if self._created is not None or self._created_text is not None:
+                fields.append( self.created )
+                fields.extend( self.data )
+        return fields
+
+    def line( self ):
+        fields = [self.domain]
+        if self.selector is not None:
+            fields.append( self.selector )
+            created_text = self.created_text()
+            if created_text is None:
+                return '\t'.join( fields )
+            fields.append( created_text )
+            for field in self.data:
+                fields.append( str( field ) )
+        return '\t'.join( fields )
+
+    def __len__( self ):
+        if self.selector is None:
+            return 1
+        if self._created is None and self._created_text is None:
+            return 2
+        return 3 + len( self.data )
+
+    def __getitem__( self, i ):
+        if isinstance( i, slice ) or i < 0 or i >= len( self ):
+            return self.fields()[i]
+        if i == 0:
+            return self.domain
+        elif i == 1:
+            return self.selector
+        elif i == 2:
+            return self.created
+        return self.data[i - 3]
+
+    def __repr__( self ):
+        return 'UpdateRecord(%r)' % (self.fields(),)
+
+
+# Parses a timestamp in the format written to the update data file. The fixed format lets
+# us use fromisoformat(), which is much faster than strptime().
+def parse_timestamp( text ):
+    try:
+        return datetime.datetime.fromisoformat( text )
+    except (AttributeError, ValueError):
+        return datetime.datetime.strptime( text, timestamp_format )
+
+
+# All the update data records, indexed by domain so operations on one domain's records
+# don't have to look at anyone else's. Iterating over it gives all the records, grouped by
+# domain in the order the domains were first seen.
+class UpdateData( object ):
+    def __init__( self ):
+        self.domains = collections.OrderedDict()  # Key = domain, Value = list of records
+        self.count = 0
+
+    def records_for( self, domain ):
+        return self.domains.get( domain, [] )
+
+    def add( self, record ):
+        self.domains.setdefault( record.domain, [] ).append( record )
+        self.count += 1
+
+    def remove( self, record ):
+        records = self.domains.get( record.domain )
+        if records is None:
+            return
+        for i, r in enumerate( records ):
+            if r is record:
+                del records[i]
+                self.count -= 1
+                break
+        if len( records ) == 0:
+            del self.domains[record.domain]
+
+    def __iter__( self ):
+        for records in self.domains.values():
+            for record in records:
+                yield record
+
+    def __len__( self ):
+        return self.count
+
+    # Changes are made in memory and only saved by write(), so there's nothing to group
+    @contextlib.contextmanager
+    def transaction( self ):
+        yield
+
+    def write( self, filename ):
+        write_records( self, filename )
+
+
+# Writes all the records to the file in one pass. The data is written to a temporary
+# file which then replaces the old file, so a failure part way through doesn't lose the
+# existing data.
+def write_records( records, filename ):
+    temp_filename = filename + '.new'
+    try:
+        with open( temp_filename, 'w' ) as update_file:
+            for record in records:
+                update_file.write( record.line() + '\n' )
+        os.rename( temp_filename, filename )
+    except (IOError, OSError) as e:
+        logging.critical( "Error writing file %s", filename )
+        logging.error( "%s", str( e ) )
+
+
+# Reads the update data file a line at a time. Returns an UpdateData, or None if the file
+# couldn't be read.
+def load( filename ):
+    update_data = UpdateData()
+    try:
+        with open( filename, 'r' ) as update_file:
+            for line in update_file:
+                fields = line.split()
+                if len( fields ) > 0 and fields[0][0] != '#':
+                    update_data.add( UpdateRecord.from_fields( fields ) )
+    except IOError as e:
+        logging.warning( "Error accessing file %s", filename )
+        logging.warning( "%s", str( e ) )
+        return None
+    return update_data
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, zone ID lookup cache
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Not a DNS API module itself. Lets DNS API modules find the provider's ID for a domain's
+# zone (Cloudflare zone ID, Route 53 hosted zone ID, Linode domain ID) from the domain
+# name, so domains.ini doesn't have to carry it. A module gives lookup() a function that
+# lists every zone in the account, and the listing is kept in cache_filename in the
+# working directory so it's only done once per account per cache period (the
+# zone_cache_ttl= option in dnsapi.ini, default_ttl seconds if not given). A domain that
+# isn't in a cached listing causes the account to be listed again, once per run, so new
+# domains are picked up without waiting for the cache to expire.
+#
+# Accounts are told apart by a hash of the API credentials, the credentials themselves
+# are never written to the cache.
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+cache_filename = 'zone_ids.json'
+# Seconds a listing is used for when dnsapi.ini doesn't say otherwise
+default_ttl = 86400
+# Pages of a listing fetched at the same time
+page_jobs = 4
+
+ttls = { }  # Key = DNS API name, Value = seconds
+cache = None  # Key = cache key, Value = { 'fetched': time, 'zones': { zone name: ID } }, loaded when needed
+refreshed = set()  # Cache keys listed during this run
+cache_lock = threading.Lock()
+account_locks = { }  # Key = cache key, Value = lock held while the account's zones are listed
+
+
+# Sets the cache period for a DNS API from its dnsapi.ini zone_cache_ttl= option.
+# Returns False if the value is invalid, in which case the default is used.
+def configure( dnsapi_name, options ):
+    if 'zone_cache_ttl' not in options:
+        return True
+    try:
+        ttl = int( options['zone_cache_ttl'] )
+        if ttl < 0:
+            raise ValueError( "out of range" )
+    except ValueError as e:
+        logging.error( "Invalid zone cache setting for DNS API %s: %s", dnsapi_name, str( e ) )
+        return False
+    ttls[dnsapi_name] = ttl
+    return True
+
+
+# Whether a zone ID field from domains.ini means the ID should be looked up
+def wants_lookup( value ):
+    return value is None or value == '' or value.lower() == 'auto'
+
+
+# Returns the ID of the zone domain is in, or None if it can't be found. credentials is
+# the list of values identifying the account (normally dnsapi_data), and list_zones a
+# function taking no arguments that returns a dict of every zone name in the account
+# and its ID, or None if the zones couldn't be listed.
+def lookup( dnsapi_name, credentials, domain, list_zones ):
+    zone = lookup_zone( dnsapi_name, credentials, domain, list_zones )
+    if zone is None:
+        return None
+    return zone[1]
+
+
+# The same as lookup(), but returns (zone name, zone ID), for providers whose record names
+# are relative to the zone. The zone may be a parent of domain if domain has no zone of
+# its own.
+def lookup_zone( dnsapi_name, credentials, domain, list_zones ):
+    key = dnsapi_name + ':' + hashlib.sha256( '\0'.join( credentials ).encode( 'utf-8' ) ).hexdigest()[:16]
+    with cache_lock:
+        load()
+        lock = account_locks.setdefault( key, threading.Lock() )
+    # Only one thread lists an account's zones, the others wait for its listing
+    with lock:
+        with cache_lock:
+            entry = cache.get( key )
+        ttl = ttls.get( dnsapi_name, default_ttl )
+        zones = None
+        if entry is not None and time.time() - entry['fetched'] < ttl:
+            zones = entry['zones']
+        if zones is None or (find_zone_name( zones, domain ) is None and key not in refreshed):
+            logging.info( "Listing zones for DNS API %s", dnsapi_name )
+            listed = list_zones()
+            if listed is not None:
+                zones = listed
+                with cache_lock:
+                    refreshed.add( key )
+                    cache[key] = { 'fetched': time.time(), 'zones': zones }
+                    save()
+            elif entry is not None:
+                logging.warning( "Using expired zone list for DNS API %s", dnsapi_name )
+                zones = entry['zones']
+            else:
+                return None
+    zone_name = find_zone_name( zones, domain )
+    if zone_name is None:
+        logging.error( "DNS API %s: no zone found for %s", dnsapi_name, domain )
+        return None
+    return zone_name, zones[zone_name]
+
+
+# The name of the closest zone containing domain, the domain's own zone if it has one, or
+# None if there isn't one
+def find_zone_name( zones, domain ):
+    name = domain.rstrip( '.' ).lower()
+    while True:
+        if name in zones:
+            return name
+        if '.' not in name:
+            return None
+        name = name.split( '.', 1 )[1]
+
+
+# Fetches every page of a paginated listing, the first on its own to find out how many
+# pages there are and the rest page_jobs at a time. fetch_page is a function taking a
+# page number (starting at 1) and returning (list of items, total number of pages), or
+# None if the page couldn't be fetched. Returns the list of items from all the pages in
+# page order, or None if any page couldn't be fetched.
+def fetch_all_pages( fetch_page ):
+    first = fetch_page( 1 )
+    if first is None:
+        return None
+    items, total_pages = first
+    items = list( items )
+    if total_pages <= 1:
+        return items
+    with concurrent.futures.ThreadPoolExecutor( max_workers = page_jobs ) as executor:
+        pages = list( executor.map( fetch_page, range( 2, total_pages + 1 ) ) )
+    for page in pages:
+        if page is None:
+            return None
+        items.extend( page[0] )
+    return items
+
+
+def load():
+    global cache
+    if cache is not None:
+        return
+    cache = { }
+    try:
+        with open( cache_filename, 'r' ) as cache_file:
+            cache = json.load( cache_file )
+    except IOError:
+        pass
+    except ValueError as e:
+        logging.warning( "Ignoring invalid zone cache %s: %s", cache_filename, str( e ) )
+
+
+def save():
+    temp_filename = cache_filename + '.new'
+    try:
+        with open( temp_filename, 'w' ) as cache_file:
+            json.dump( cache, cache_file, indent = 1, sort_keys = True )
+        os.rename( temp_filename, cache_filename )
+    except (IOError, OSError) as e:
+        logging.warning( "Error writing zone cache %s: %s", cache_filename, str( e ) )
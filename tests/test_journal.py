@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, run journal tests
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'src' ) )
+
+import journal
+import updatedata
+
+key_data = { 'selector': '202601', 'plain': 'v=DKIM1; p=AAAA', 'chunked': '"v=DKIM1; p=AAAA"' }
+
+
+def record( domain, record_id ):
+    return updatedata.UpdateRecord( domain, '202601', '2026-01-01T00:00:00', [record_id] )
+
+
+class JournalTest( unittest.TestCase ):
+    def setUp( self ):
+        self.work_dir = tempfile.mkdtemp()
+        self.filename = os.path.join( self.work_dir, 'genkeys.journal' )
+
+    def tearDown( self ):
+        shutil.rmtree( self.work_dir, True )
+
+    # A journal as a run that died after adding one record and deleting another leaves it
+    def write_journal( self ):
+        run_journal = journal.Journal( self.filename )
+        run_journal.start( '202601', ['ka', 'kb'] )
+        run_journal.key( 'ka', key_data )
+        run_journal.add( 'a.example', record( 'a.example', 'id-1' ) )
+        run_journal.delete( 'a.example', updatedata.UpdateRecord( 'a.example', '202510', '2025-10-01T00:00:00',
+                                                                  ['id-0'] ) )
+        run_journal.close()
+
+    def test_load( self ):
+        self.write_journal()
+        state = journal.load( self.filename )
+        self.assertEqual( state.selector, '202601' )
+        self.assertEqual( state.key_names, ['ka', 'kb'] )
+        self.assertEqual( state.keys, { 'ka': key_data } )
+        self.assertEqual( state.adds, [('a.example', record( 'a.example', 'id-1' ).line())] )
+        self.assertEqual( len( state.deletes ), 1 )
+        self.assertEqual( state.completed_domains(), set( ['a.example'] ) )
+
+    # The run died while writing the last entry
+    def test_load_partial_entry( self ):
+        self.write_journal()
+        with open( self.filename, 'a' ) as journal_file:
+            journal_file.write( '{"op": "add", "domain": "b.exa' )
+        state = journal.load( self.filename )
+        self.assertEqual( state.completed_domains(), set( ['a.example'] ) )
+
+    def test_load_missing( self ):
+        self.assertIsNone( journal.load( self.filename ) )
+
+    def test_replay( self ):
+        self.write_journal()
+        state = journal.load( self.filename )
+        update_data = updatedata.UpdateData()
+        update_data.add( updatedata.UpdateRecord( 'a.example', '202510', '2025-10-01T00:00:00', ['id-0'] ) )
+        update_data.add( record( 'b.example', 'id-2' ) )
+        state.replay( update_data )
+        # Replaying again changes nothing
+        state.replay( update_data )
+        self.assertEqual( [r.line() for r in update_data.records_for( 'a.example' )],
+                          [record( 'a.example', 'id-1' ).line()] )
+        self.assertEqual( [r.line() for r in update_data.records_for( 'b.example' )],
+                          [record( 'b.example', 'id-2' ).line()] )
+
+    def test_finish( self ):
+        self.write_journal()
+        run_journal = journal.Journal( self.filename )
+        run_journal.finish()
+        self.assertFalse( os.path.exists( self.filename ) )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, key generation backend tests
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# genkeys.py does its work when it's loaded, so it's run as a command in a scratch
+# directory. The opendkim backend runs the benchmarks' opendkim-genkey stand-in, which
+# writes the same .txt file opendkim-genkey -r does.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+top_dir = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' )
+genkeys_script = os.path.join( top_dir, 'src', 'genkeys.py' )
+fake_genkey = os.path.join( top_dir, 'benchmarks', 'fake-opendkim-genkey' )
+
+try:
+    import cryptography
+except ImportError:
+    cryptography = None
+
+
+# Runs genkeys.py with the given key generation backend for a single domain and returns
+# the quoted chunks of the public key .txt file it wrote.
+def generate( backend ):
+    work_dir = tempfile.mkdtemp()
+    try:
+        bin_dir = os.path.join( work_dir, 'bin' )
+        os.mkdir( bin_dir )
+        shutil.copy( fake_genkey, os.path.join( bin_dir, 'opendkim-genkey' ) )
+        os.chmod( os.path.join( bin_dir, 'opendkim-genkey' ), 0o755 )
+        with open( os.path.join( work_dir, 'domains.ini' ), 'w' ) as domains_file:
+            domains_file.write( 'example.com\texample\tnull\n' )
+        with open( os.path.join( work_dir, 'dnsapi.ini' ), 'w' ) as dnsapi_file:
+            dnsapi_file.write( 'null\n' )
+        open( os.path.join( work_dir, 'dns_update_data.ini' ), 'w' ).close()
+        env = dict( os.environ )
+        env['PATH'] = bin_dir + os.pathsep + env.get( 'PATH', '' )
+        subprocess.check_call( [sys.executable, genkeys_script, '--no-dns', '--keygen', backend, '202601'],
+                               cwd = work_dir, env = env, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL )
+        with open( os.path.join( work_dir, 'example.202601.txt' ), 'r' ) as txt_file:
+            text = txt_file.read()
+    finally:
+        shutil.rmtree( work_dir, True )
+    return text.strip().split( '"' )[1::2]
+
+
+class KeygenTest( unittest.TestCase ):
+    @unittest.skipIf( cryptography is None, "the native backend needs the cryptography package" )
+    def test_native_matches_opendkim( self ):
+        native = generate( 'native' )
+        opendkim = generate( 'opendkim' )
+        # Same tags in the same order, then the key on its own from the next chunk on
+        self.assertEqual( native[0], 'v=DKIM1; h=sha256; k=rsa; s=email; ' )
+        self.assertEqual( native[0], opendkim[0] )
+        self.assertTrue( native[1].startswith( 'p=' ) )
+        self.assertTrue( opendkim[1].startswith( 'p=' ) )
+
+
+if __name__ == '__main__':
+    unittest.main()
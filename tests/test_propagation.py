@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, propagation check tests
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The wire format code is tested directly, and the checks against the benchmarks' stand-in
+# DNS server running on localhost.
+
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import unittest
+import unittest.mock
+
+top_dir = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' )
+sys.path.insert( 0, os.path.join( top_dir, 'src' ) )
+sys.path.insert( 0, os.path.join( top_dir, 'benchmarks' ) )
+
+import dns_standin
+import propagation
+
+value = "v=DKIM1; h=sha256; k=rsa; p=MIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEAu5oIs2tYF1pz"
+
+
+def txt_rdata( text ):
+    data = text.encode( 'ascii' )
+    return b''.join( [struct.pack( 'B', len( data[i:i + 255] ) ) + data[i:i + 255]
+                      for i in range( 0, len( data ), 255 )] )
+
+
+def resource( name_bytes, rtype, rdata ):
+    return name_bytes + struct.pack( '>HHIH', rtype, propagation.class_in, 300, len( rdata ) ) + rdata
+
+
+class WireFormatTest( unittest.TestCase ):
+    def test_build_query( self ):
+        data = propagation.build_query( 0x1234, 'Sel._DomainKey.Example.COM.', propagation.type_txt, True )
+        self.assertEqual( struct.unpack( '>HH', data[:4] ), (0x1234, 0x0100) )
+        message = propagation.parse_message( data )
+        self.assertEqual( message.id, 0x1234 )
+        self.assertEqual( message.question, ('sel._domainkey.example.com', propagation.type_txt) )
+        self.assertEqual( [record.rtype for record in message.additional], [propagation.type_opt] )
+        no_recursion = propagation.build_query( 1, 'example.com', propagation.type_ns )
+        self.assertEqual( struct.unpack( '>H', no_recursion[2:4] )[0], 0 )
+
+    def test_parse_response( self ):
+        question = propagation.encode_name( 'example.com' ) + struct.pack( '>HH', propagation.type_ns,
+                                                                           propagation.class_in )
+        long_value = value * 5  # Split between several strings
+        data = struct.pack( '>HHHHHH', 7, 0x8400 | 0x0200, 1, 2, 1, 2 ) + question
+        # Names compressed against the question name at offset 12
+        data += resource( b'\xc0\x0c', propagation.type_ns, propagation.encode_name( 'ns1.example.com' ) )
+        data += resource( b'\x03sel\xc0\x0c', propagation.type_txt, txt_rdata( long_value ) )
+        data += resource( b'\xc0\x0c', propagation.type_ns, b'\x03ns2\xc0\x0c' )
+        data += resource( b'\x03ns1\xc0\x0c', propagation.type_a, socket.inet_aton( '192.0.2.1' ) )
+        data += resource( b'\x03ns1\xc0\x0c', propagation.type_aaaa,
+                          socket.inet_pton( socket.AF_INET6, '2001:db8::1' ) )
+        message = propagation.parse_message( data )
+        self.assertEqual( message.id, 7 )
+        self.assertTrue( message.truncated )
+        self.assertEqual( message.question, ('example.com', propagation.type_ns) )
+        self.assertEqual( [(r.name, r.data) for r in message.answers],
+                          [('example.com', 'ns1.example.com'), ('sel.example.com', long_value)] )
+        self.assertEqual( message.authority[0].data, 'ns2.example.com' )
+        self.assertEqual( [r.data for r in message.additional], ['192.0.2.1', '2001:db8::1'] )
+
+    def test_parse_malformed( self ):
+        data = propagation.build_query( 1, 'example.com', propagation.type_txt )
+        self.assertIsNone( propagation.parse_message( data[:20] ) )
+        self.assertIsNone( propagation.parse_message( b'\x00\x01' ) )
+        # A compression pointer pointing at itself
+        loop = struct.pack( '>HHHHHH', 1, 0, 1, 0, 0, 0 ) + b'\xc0\x0c' + struct.pack( '>HH', 16, 1 )
+        self.assertIsNone( propagation.parse_message( loop ) )
+
+
+class StandInTest( unittest.TestCase ):
+    def setUp( self ):
+        self.sockets = []
+        self.threads = []
+        patches = [unittest.mock.patch.object( propagation, 'query_timeout', 0.1 ),
+                   unittest.mock.patch.object( propagation, 'poll_interval', 0.2 )]
+        for patch in patches:
+            patch.start()
+            self.addCleanup( patch.stop )
+
+    def tearDown( self ):
+        # Shutting the sockets down wakes up the threads blocked on them
+        for sock in self.sockets:
+            try:
+                sock.shutdown( socket.SHUT_RDWR )
+            except OSError:
+                pass
+            sock.close()
+        for thread in self.threads:
+            thread.join( 5 )
+
+    def start( self, target, sock ):
+        self.sockets.append( sock )
+        thread = threading.Thread( target = target, args = (sock,) )
+        thread.daemon = True
+        thread.start()
+        self.threads.append( thread )
+
+    # Starts a stand-in server on localhost, with a TCP listener on the same port if
+    # tcp is True. Returns (stand-in, (address, port)).
+    def standin( self, tcp = False, **kwargs ):
+        standin = dns_standin.StandIn( **kwargs )
+        standin.random.seed( 1 )
+        for attempt in range( 10 ):
+            sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+            sock.bind( ('127.0.0.1', 0) )
+            if not tcp:
+                break
+            listener = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+            try:
+                listener.bind( sock.getsockname() )
+            except OSError:
+                sock.close()
+                listener.close()
+                continue
+            listener.listen( 4 )
+            self.start( standin.serve_tcp, listener )
+            break
+        server = sock.getsockname()
+        self.start( standin.serve, sock )
+        return standin, server
+
+    # A server that never answers
+    def dead_server( self ):
+        sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+        sock.bind( ('127.0.0.1', 0) )
+        self.sockets.append( sock )
+        return sock.getsockname()
+
+    def test_propagated( self ):
+        standin, server = self.standin()
+        standin.add( '202601._domainkey.a.example', value )
+        standin.add( '202601._domainkey.b.example', 'v=DKIM1; p=other' )
+        checks = [('a.example', '202601._domainkey.a.example', value),
+                  ('b.example', '202601._domainkey.b.example', value)]
+        start = time.monotonic()
+        self.assertEqual( propagation.check_records( checks, 2.0, [server] ), set( ['a.example'] ) )
+        self.assertGreaterEqual( time.monotonic() - start, 1.5 )
+
+    def test_not_yet_propagated( self ):
+        standin, server = self.standin( delay = 1.0 )
+        standin.add( '202601._domainkey.a.example', value )
+        self.assertEqual( propagation.check_records( [('a.example', '202601._domainkey.a.example', value)], 0.5,
+                                                     [server] ), set() )
+        # Served once the delay is over, and picked up by the next poll
+        self.assertEqual( propagation.check_records( [('a.example', '202601._domainkey.a.example', value)], 3.0,
+                                                     [server] ), set( ['a.example'] ) )
+
+    def test_dropped_queries( self ):
+        standin, server = self.standin( drop = 0.5 )
+        standin.add( '202601._domainkey.a.example', value )
+        self.assertEqual( propagation.check_records( [('a.example', '202601._domainkey.a.example', value)], 3.0,
+                                                     [server] ), set( ['a.example'] ) )
+        self.assertGreater( standin.queries, 1 )
+
+    # Every nameserver has to be serving the record
+    def test_unresponsive_server( self ):
+        standin, server = self.standin()
+        standin.add( '202601._domainkey.a.example', value )
+        self.assertEqual( propagation.check_records( [('a.example', '202601._domainkey.a.example', value)], 1.0,
+                                                     [server, self.dead_server()] ), set() )
+
+    def test_truncated( self ):
+        standin, server = self.standin( tcp = True, max_udp_size = 100 )
+        long_value = value * 8
+        standin.add( '202601._domainkey.a.example', long_value )
+        self.assertEqual( propagation.check_records( [('a.example', '202601._domainkey.a.example', long_value)],
+                                                     2.0, [server] ), set( ['a.example'] ) )
+        # Once truncated over UDP and once in full over TCP
+        self.assertEqual( standin.answered, 2 )
+
+    # Queries to a dead server are given up on, so they don't keep the queries waiting
+    # behind them from being sent
+    def test_dead_server_gives_up( self ):
+        standin, server = self.standin()
+        standin.add( '202601._domainkey.a.example', value )
+        dead = self.dead_server()
+        results = []
+        resolver = propagation.Resolver()
+        try:
+            with unittest.mock.patch.object( propagation, 'max_outstanding', 2 ):
+                for i in range( 3 ):
+                    resolver.query( [dead], "%d._domainkey.dead.example" % i, propagation.type_txt,
+                                    lambda message, i = i: results.append( (i, message) ) )
+                resolver.query( [server], '202601._domainkey.a.example', propagation.type_txt,
+                                lambda message: results.append( ('live', message) ) )
+                start = time.monotonic()
+                self.assertTrue( resolver.run( start + 10.0, lambda: len( results ) == 4 ) )
+        finally:
+            resolver.close()
+        self.assertLess( time.monotonic() - start, 5.0 )
+        self.assertEqual( [message for i, message in results if i != 'live'], [None, None, None] )
+        live = [message for i, message in results if i == 'live'][0]
+        self.assertEqual( live.answers[0].data, value )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, request pacing and retry tests
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import email.utils
+import os
+import sys
+import time
+import unittest
+import unittest.mock
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'src' ) )
+
+import ratelimit
+
+try:
+    import requests
+    import dnshttp
+except ImportError:
+    requests = None
+
+
+class Response( object ):
+    def __init__( self, status_code, retry_after = None ):
+        self.status_code = status_code
+        self.headers = { 'Retry-After': retry_after } if retry_after is not None else { }
+
+
+# A send function returning the given responses in turn, counting the calls in sent
+class Sender( object ):
+    def __init__( self, responses ):
+        self.responses = list( responses )
+        self.sent = 0
+
+    def __call__( self, *args, **kwargs ):
+        response = self.responses[min( self.sent, len( self.responses ) - 1 )]
+        self.sent += 1
+        return response
+
+
+class LimiterTest( unittest.TestCase ):
+    def test_pacing( self ):
+        limiter = ratelimit.Limiter( rate = 20.0, burst = 1.0 )
+        start = time.monotonic()
+        for i in range( 5 ):
+            limiter.acquire()
+        # The first goes at once, the rest a twentieth of a second apart
+        self.assertGreaterEqual( time.monotonic() - start, 0.18 )
+
+    def test_burst( self ):
+        limiter = ratelimit.Limiter( rate = 1.0, burst = 5.0 )
+        start = time.monotonic()
+        for i in range( 5 ):
+            limiter.acquire()
+        self.assertLess( time.monotonic() - start, 0.5 )
+
+    def test_pause( self ):
+        limiter = ratelimit.Limiter()
+        limiter.pause( 0.2 )
+        start = time.monotonic()
+        limiter.acquire()
+        self.assertGreaterEqual( time.monotonic() - start, 0.18 )
+
+
+class RetryAfterTest( unittest.TestCase ):
+    def test_seconds( self ):
+        self.assertEqual( ratelimit.parse_retry_after( '5' ), 5.0 )
+        self.assertEqual( ratelimit.parse_retry_after( ' 2.5 ' ), 2.5 )
+        self.assertEqual( ratelimit.parse_retry_after( '-3' ), 0.0 )
+
+    def test_http_date( self ):
+        when = datetime.datetime.now( datetime.timezone.utc ) + datetime.timedelta( seconds = 30 )
+        seconds = ratelimit.parse_retry_after( email.utils.format_datetime( when, usegmt = True ) )
+        self.assertTrue( 28.0 <= seconds <= 30.0 )
+        self.assertEqual( ratelimit.parse_retry_after( 'Wed, 21 Oct 2015 07:28:00 GMT' ), 0.0 )
+
+    def test_unusable( self ):
+        self.assertIsNone( ratelimit.parse_retry_after( None ) )
+        self.assertIsNone( ratelimit.parse_retry_after( 'soon' ) )
+
+
+class CallTest( unittest.TestCase ):
+    def setUp( self ):
+        self.dnsapi_name = 'test-' + self.id()
+        self.addCleanup( ratelimit.limiters.pop, self.dnsapi_name, None )
+
+    def test_retries( self ):
+        send = Sender( [Response( 429, '0' ), Response( 503, '0' ), Response( 200 )] )
+        self.assertEqual( ratelimit.call( self.dnsapi_name, send, idempotent = False ).status_code, 200 )
+        self.assertEqual( send.sent, 3 )
+
+    def test_retries_exhausted( self ):
+        ratelimit.configure( self.dnsapi_name, { 'retries': '2' } )
+        send = Sender( [Response( 503, '0' )] )
+        self.assertEqual( ratelimit.call( self.dnsapi_name, send ).status_code, 503 )
+        self.assertEqual( send.sent, 3 )
+
+    # Waiting longer than max_retry_after isn't worth it
+    def test_retry_after_cap( self ):
+        send = Sender( [Response( 429, str( int( ratelimit.max_retry_after ) + 1 ) ), Response( 200 )] )
+        start = time.monotonic()
+        self.assertEqual( ratelimit.call( self.dnsapi_name, send ).status_code, 429 )
+        self.assertEqual( send.sent, 1 )
+        self.assertLess( time.monotonic() - start, 1.0 )
+
+    # A 5xx on a request that isn't idempotent may mean it was carried out
+    def test_server_error_not_idempotent( self ):
+        send = Sender( [Response( 502, '0' ), Response( 200 )] )
+        self.assertEqual( ratelimit.call( self.dnsapi_name, send, idempotent = False ).status_code, 502 )
+        self.assertEqual( send.sent, 1 )
+        send = Sender( [Response( 502, '0' ), Response( 200 )] )
+        self.assertEqual( ratelimit.call( self.dnsapi_name, send, idempotent = True ).status_code, 200 )
+        self.assertEqual( send.sent, 2 )
+
+    def test_exceptions( self ):
+        def send():
+            raise IOError( "connection refused" )
+        with unittest.mock.patch.object( ratelimit, 'backoff', lambda attempt: 0.0 ):
+            with self.assertRaises( IOError ):
+                ratelimit.call( self.dnsapi_name, send, transient_error = lambda e, idempotent: True )
+
+
+@unittest.skipIf( requests is None, "dnshttp needs the requests package" )
+class SessionTest( unittest.TestCase ):
+    def setUp( self ):
+        self.dnsapi_name = 'test-' + self.id()
+        self.addCleanup( ratelimit.limiters.pop, self.dnsapi_name, None )
+
+    def send( self, method, responses ):
+        sender = Sender( responses )
+        session = dnshttp.Session( self.dnsapi_name )
+        with unittest.mock.patch.object( requests.Session, 'request', sender ):
+            response = session.request( method, 'https://api.example/records' )
+        return response.status_code, sender.sent
+
+    def test_post_not_retried( self ):
+        self.assertEqual( self.send( 'POST', [Response( 500, '0' ), Response( 200 )] ), (500, 1) )
+        self.assertEqual( self.send( 'POST', [Response( 429, '0' ), Response( 200 )] ), (200, 2) )
+
+    def test_delete_retried( self ):
+        self.assertEqual( self.send( 'DELETE', [Response( 500, '0' ), Response( 200 )] ), (200, 2) )
+
+    def test_transient_error( self ):
+        self.assertTrue( dnshttp.transient_error( requests.exceptions.ConnectTimeout(), False ) )
+        self.assertFalse( dnshttp.transient_error( requests.exceptions.ConnectionError(), False ) )
+        self.assertTrue( dnshttp.transient_error( requests.exceptions.ReadTimeout(), True ) )
+        self.assertFalse( dnshttp.transient_error( ValueError(), True ) )
+
+
+if __name__ == '__main__':
+    unittest.main()
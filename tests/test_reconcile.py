@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, reconcile tests
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import unittest
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'src' ) )
+
+import reconcile
+import updatedata
+
+
+def record( selector, record_id, created = '2023-02-01T00:00:00' ):
+    return updatedata.UpdateRecord( 'b.example', selector, created, [record_id] )
+
+
+def in_use( selector ):
+    return selector == '202302'
+
+
+class DiffRecordsTest( unittest.TestCase ):
+    def test_matched( self ):
+        orphans, missing, stale = reconcile.diff_records( [record( '202302', 'sim-3' )], [record( '202302', 'sim-3' )],
+                                                          in_use, set( ['202302'] ) )
+        self.assertEqual( (orphans, missing, stale), ([], [], []) )
+
+    # The record was re-created with a new ID: it's adopted, not deleted as a duplicate
+    def test_id_changed( self ):
+        known = record( '202302', 'sim-99', '2023-02-01T12:00:00' )
+        listed = record( '202302', 'sim-3', '2024-01-01T00:00:00' )
+        orphans, missing, stale = reconcile.diff_records( [listed], [known], in_use, set( ['202302'] ) )
+        self.assertEqual( orphans, [] )
+        self.assertEqual( stale, [known] )
+        self.assertEqual( len( missing ), 1 )
+        self.assertEqual( missing[0].selector, '202302' )
+        self.assertEqual( missing[0].data, ['sim-3'] )
+        self.assertEqual( missing[0].created_text(), '2023-02-01T12:00:00' )
+
+    # A key no longer in use keeps its record through an ID change the same way
+    def test_id_changed_old_key( self ):
+        known = record( '202301', 'sim-98' )
+        listed = record( '202301', 'sim-2' )
+        orphans, missing, stale = reconcile.diff_records( [listed], [known], in_use, set( ['202301'] ) )
+        self.assertEqual( orphans, [] )
+        self.assertEqual( stale, [known] )
+        self.assertEqual( [r.data for r in missing], [['sim-2']] )
+
+    def test_duplicate( self ):
+        known = record( '202302', 'sim-3' )
+        duplicate = record( '202302', 'sim-4' )
+        orphans, missing, stale = reconcile.diff_records( [record( '202302', 'sim-3' ), duplicate], [known],
+                                                          in_use, set( ['202302'] ) )
+        self.assertEqual( orphans, [duplicate] )
+        self.assertEqual( (missing, stale), ([], []) )
+
+    def test_untracked( self ):
+        unknown = record( '202302', 'sim-5' )
+        old = record( '202301', 'sim-6' )
+        foreign = record( 'google', 'sim-7' )
+        orphans, missing, stale = reconcile.diff_records( [unknown, old, foreign], [], in_use, set() )
+        self.assertEqual( missing, [unknown] )
+        self.assertEqual( orphans, [old] )
+        self.assertEqual( stale, [] )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+#    OpenDKIM genkeys tool, interrupted run tests
+#    Copyright (C) 2016 Todd Knarr <tknarr@silverglass.org>
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Runs genkeys.py against the sim DNS API through a wrapper module that kills the process
+# part way through the DNS updates, then finishes the run with --resume and checks that
+# every domain ends up with exactly one record in DNS and in the update data. Keys come
+# from the benchmarks' opendkim-genkey stand-in.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+top_dir = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' )
+src_dir = os.path.join( top_dir, 'src' )
+genkeys_script = os.path.join( src_dir, 'genkeys.py' )
+fake_genkey = os.path.join( top_dir, 'benchmarks', 'fake-opendkim-genkey' )
+
+sys.path.insert( 0, src_dir )
+
+import dnsapi_sim
+
+# Passes everything through to the sim module, except that adding the record for
+# c.example kills the process while a file named crash exists
+crash_module = '''
+import os
+
+import dnsapi_sim
+
+
+def open( dnsapi_data, debugging = False ):
+    return Client( dnsapi_sim.open( dnsapi_data, debugging ) )
+
+
+class Client( object ):
+    def __init__( self, client ):
+        self.client = client
+
+    def add( self, dnsapi_domain_data, key_data, debugging = False ):
+        if os.path.exists( 'crash' ) and key_data['domain'] == 'c.example':
+            os._exit( 3 )
+        return self.client.add( dnsapi_domain_data, key_data, debugging )
+
+    def delete( self, dnsapi_domain_data, record_data, debugging = False ):
+        return self.client.delete( dnsapi_domain_data, record_data, debugging )
+
+    def close( self ):
+        self.client.close()
+'''
+
+domains = ['a.example', 'b.example', 'c.example', 'd.example']
+
+
+class ResumeTest( unittest.TestCase ):
+    def setUp( self ):
+        self.work_dir = tempfile.mkdtemp()
+        self.bin_dir = os.path.join( self.work_dir, 'bin' )
+        self.module_dir = os.path.join( self.work_dir, 'modules' )
+        os.mkdir( self.bin_dir )
+        os.mkdir( self.module_dir )
+        shutil.copy( fake_genkey, os.path.join( self.bin_dir, 'opendkim-genkey' ) )
+        os.chmod( os.path.join( self.bin_dir, 'opendkim-genkey' ), 0o755 )
+        with open( os.path.join( self.module_dir, 'dnsapi_crash.py' ), 'w' ) as module_file:
+            module_file.write( crash_module )
+        self.write( 'dnsapi.ini', 'null\ncrash store=sim.json\n' )
+        self.write( 'domains.ini', ''.join( ["%s\tk%s\tcrash\n" % (domain, 'ab'[i % 2])
+                                             for i, domain in enumerate( domains )] ) )
+        self.write( 'dns_update_data.ini', '' )
+
+    def tearDown( self ):
+        shutil.rmtree( self.work_dir, True )
+
+    def write( self, filename, text ):
+        with open( os.path.join( self.work_dir, filename ), 'w' ) as output_file:
+            output_file.write( text )
+
+    def path( self, filename ):
+        return os.path.join( self.work_dir, filename )
+
+    def run_genkeys( self, *args ):
+        env = dict( os.environ )
+        env['PATH'] = self.bin_dir + os.pathsep + env.get( 'PATH', '' )
+        env['PYTHONPATH'] = self.module_dir + os.pathsep + src_dir
+        return subprocess.call( [sys.executable, genkeys_script, '--dns-jobs', '1'] + list( args ),
+                                cwd = self.work_dir, env = env, stdout = subprocess.DEVNULL,
+                                stderr = subprocess.DEVNULL )
+
+    # Record IDs in the simulated provider, key = domain, value = list of record IDs
+    def sim_records( self ):
+        simulator = dnsapi_sim.Simulator( ['store=' + self.path( 'sim.json' )] )
+        records = { }
+        for record_id, record in simulator.records.items():
+            records.setdefault( record[0], [] ).append( record_id )
+        return records
+
+    # Record IDs in the update data, key = domain, value = list of record IDs
+    def update_records( self ):
+        records = { }
+        with open( self.path( 'dns_update_data.ini' ), 'r' ) as update_file:
+            for line in update_file:
+                fields = line.split()
+                records.setdefault( fields[0], [] ).append( fields[3] )
+        return records
+
+    def crash( self ):
+        self.write( 'crash', '' )
+        self.assertEqual( self.run_genkeys( '202601' ), 3 )
+        os.remove( self.path( 'crash' ) )
+        self.assertTrue( os.path.exists( self.path( 'genkeys.journal' ) ) )
+
+    def check_one_record_each( self ):
+        self.assertFalse( os.path.exists( self.path( 'genkeys.journal' ) ) )
+        sim_records = self.sim_records()
+        self.assertEqual( sorted( sim_records.keys() ), domains )
+        self.assertTrue( all( [len( record_ids ) == 1 for record_ids in sim_records.values()] ) )
+        self.assertEqual( self.update_records(), sim_records )
+        return sim_records
+
+    def test_resume( self ):
+        self.crash()
+        # The sim module's changes are only in its log until a client is closed
+        self.assertTrue( os.path.exists( self.path( 'sim.json.log' ) ) )
+        added = self.sim_records()
+        self.assertEqual( sorted( added.keys() ), ['a.example', 'b.example'] )
+        # A fresh run would add the records all over again
+        self.assertEqual( self.run_genkeys( '202601' ), 1 )
+        self.assertEqual( self.run_genkeys( '--resume' ), 0 )
+        records = self.check_one_record_each()
+        self.assertEqual( records['a.example'], added['a.example'] )
+        self.assertEqual( records['b.example'], added['b.example'] )
+        self.assertFalse( os.path.exists( self.path( 'sim.json.log' ) ) )
+
+    # Keys journaled with their files already in place are reused, not generated again
+    def test_resume_keeps_keys( self ):
+        self.crash()
+        with open( self.path( 'ka.202601.key' ), 'a' ) as key_file:
+            key_file.write( 'marker\n' )
+        self.assertEqual( self.run_genkeys( '--resume' ), 0 )
+        with open( self.path( 'ka.202601.key' ), 'r' ) as key_file:
+            self.assertTrue( key_file.read().endswith( 'marker\n' ) )
+        self.check_one_record_each()
+
+    # The run died after journaling a key but before renaming its files into place
+    def test_resume_pending_key( self ):
+        self.crash()
+        added = self.sim_records()
+        for suffix in ['.key', '.txt']:
+            os.rename( self.path( 'ka.202601' + suffix ), self.path( 'ka.202601' + suffix + '.new' ) )
+        self.assertEqual( self.run_genkeys( '--resume' ), 0 )
+        self.assertTrue( os.path.exists( self.path( 'ka.202601.key' ) ) )
+        self.assertFalse( os.path.exists( self.path( 'ka.202601.key.new' ) ) )
+        records = self.check_one_record_each()
+        self.assertEqual( records['a.example'], added['a.example'] )
+
+    # A key whose files were lost is generated again and its domains' records replaced
+    def test_resume_lost_key( self ):
+        self.crash()
+        added = self.sim_records()
+        os.remove( self.path( 'ka.202601.key' ) )
+        self.assertEqual( self.run_genkeys( '--resume' ), 0 )
+        self.assertTrue( os.path.exists( self.path( 'ka.202601.key' ) ) )
+        records = self.check_one_record_each()
+        self.assertNotEqual( records['a.example'], added['a.example'] )
+        self.assertEqual( records['b.example'], added['b.example'] )
+
+    # A fresh run whose key generation fails leaves nothing behind to resume
+    def test_keygen_failure( self ):
+        with open( os.path.join( self.bin_dir, 'opendkim-genkey' ), 'w' ) as script:
+            script.write( '#!/bin/sh\ncase "$*" in *"-d kb"*) exit 2;; esac\nexec %s "$@"\n' % fake_genkey )
+        self.assertEqual( self.run_genkeys( '202601' ), 1 )
+        self.assertFalse( os.path.exists( self.path( 'genkeys.journal' ) ) )
+        self.assertFalse( os.path.exists( self.path( 'ka.202601.key' ) ) )
+        self.assertFalse( os.path.exists( self.path( 'ka.202601.txt' ) ) )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,7 +21,8 @@ import argparse
 import logging
 import sys
 
-import requests
+import dnsapi_cloudflare
+import dnshttp
 
 # Set up command-line argument parser and parse arguments
 parser = argparse.ArgumentParser( description = "List CloudFlare zones and zone IDs" )
@@ -42,46 +43,15 @@ elif email is None:
     sys.exit( 1 )
 domain = args.domain
 
-zones = []
-current_page = 0
-total_pages = 1
-
-while current_page < total_pages:
-
-    result = False
-    current_page += 1
-    logging.info( "Retrieving page %d of %d", current_page, total_pages )
-    endpoint = "https://api.cloudflare.com/client/v4/zones?page={0}&order=name&direction=asc".format( current_page )
-    if domain:
-        endpoint = endpoint + "&name={0}".format( domain )
-    hdr = {
-        'Content-Type': 'application/json',
-        'X-Auth-Key': api_key,
-        'X-Auth-Email': email
-    }
-    resp = requests.get( endpoint, headers = hdr )
-    logging.info( "HTTP status: %d", resp.status_code )
-    result = resp.json()
-    success = result['success']
-    errors = result['errors']
-    messages = result['messages']
-    result_info = result['result_info']
-    results = result['result']
-
-    if not success:
-        logging.info( "Operation failed." )
-    for item in errors:
-        logging.error( str( item ) )
-    for item in messages:
-        logging.warning( str( item ) )
-
-    for item in results:
-        zones.append( (item['id'], item['name']) )
-
-    current_page = result_info['page']
-    total_pages = result_info['total_pages']
+# The pages after the first are fetched at the same time, a domain is looked up by name
+session = dnshttp.new_session()
+zones = dnsapi_cloudflare.list_zones( [api_key, email], session, domain )
+session.close()
+if zones is None:
+    logging.info( "Operation failed." )
+    sys.exit( 1 )
 
-for id, name in zones:
-    print( "{0}\t{1}".format( id, name ) )
+for name in sorted( zones.keys() ):
+    print( "{0}\t{1}".format( zones[name], name ) )
 
 sys.exit( 0 )
@@ -24,10 +24,18 @@
 # of the month the keys are for.
 GENKEY="genkeys.py -n"
 
+# Edit this to add --check-propagation <seconds> to wait for the new DNS records to reach
+# the domains' nameservers before the tables are written and uploaded. Domains whose
+# records haven't got there in time keep their current selector until the next rotation.
+GENKEY_OPTIONS=""
+
 # Edit this space-separated list of the usernames, hosts and directories to upload
 # OpenDKIM keys to after generating them. Do not use trailing slashes.
 TARGETS="user1@host1:relative/directory user2@host2:/absolute/directory"
 
+# Edit this to add key.db and signing.db if genkeys.py is run with --db-tables.
+TABLES="key.table signing.table"
+
 # Edit to reflect the location you generate keys in
 cd /key/location
 
@@ -35,7 +43,7 @@ cd /key/location
 selector=`${GENKEY} --selector`
 
 # Generate the keys and tables
-${GENKEY} ${selector} || exit 1
+${GENKEY} ${GENKEY_OPTIONS} ${selector} || exit 1
 # Set permissions correctly
 for x in *.${selector}.key
 do
@@ -51,7 +59,7 @@ for x in $TARGETS
 do
     h=`echo $x | cut -d: -f1`
     d=`echo $x | cut -d: -f2-`
-    scp *.${selector}.key key.table signing.table ${h}:${d}/ && \
+    scp *.${selector}.key ${TABLES} ${h}:${d}/ && \
         ssh -x ${h} touch ${d}/.uploaded && \
         echo "DKIM key upload to $x completed successfully."
 done
@@ -50,16 +50,16 @@ do
     fi
 done
 
-# Back up the old .table files
-for x in *.table
+# Back up the old .table and .db files
+for x in *.table *.db
 do
     if [ -f $x ]
     then
         cp -p $x ${x}.bak || exit 1
     fi
 done
-# Copy the new .table files
-for x in ${SRC_DIR}/*.table
+# Copy the new .table and .db files
+for x in ${SRC_DIR}/*.table ${SRC_DIR}/*.db
 do
     if [ -f $x ]
     then
@@ -71,7 +71,7 @@ do
 done
 
 # Clear out the old files if everything succeeded
-rm -f ${SRC_DIR}/*.key ${SRC_DIR}/*.table ${SRC_DIR}/.uploaded || exit 1
+rm -f ${SRC_DIR}/*.key ${SRC_DIR}/*.table ${SRC_DIR}/*.db ${SRC_DIR}/.uploaded || exit 1
 
 echo "DKIM key update completed successfully."
 
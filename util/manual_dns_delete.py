@@ -20,13 +20,14 @@
 import argparse
 import datetime
 import glob
-import importlib
 import logging
 import os
 import os.path
 import string
 import sys
 
+import dnsregistry
+
 # Internal settings, should not need changed
 domain_filename = 'domains.ini'
 dns_api_defs_filename = 'dnsapi.ini'
@@ -65,29 +66,6 @@ def fields_to_line( fields ):
     return line
 
 
-def find_dnsapi_modules( pn ):
-    # Go through all possible names (pulled from what's mentioned in the
-    # dnsapi.ini file) and for each one X see if we can load a module named
-    # dnsapi_X (file will be dnsapi_X.py).
-    dnsapis = { }
-    possible_names = pn
-    # Make sure null is included
-    if 'null' not in possible_names:
-        possible_names.append( 'null' )
-    for api_name in possible_names:
-        module_name = "dnsapi_" + api_name
-        try:
-            module = importlib.import_module( module_name )
-        except ImportError as e:
-            module = None
-            logging.error( "Module %s for DNS API %s not found", module_name, api_name )
-            logging.info( "%s", str( e ) )
-        if module is not None:
-            logging.debug( "DNS API module %s loaded", api_name )
-            dnsapis[api_name] = module
-    return dnsapis
-
-
 # Set up command-line argument parser and parse arguments
 parser = argparse.ArgumentParser( description = "Generate OpenDKIM key data for a set of domains" )
 parser.add_argument( "-v", "--verbose", dest = 'log_info', action = 'store_true',
@@ -117,13 +95,14 @@ if len( args.data ) == 0:
 
 # Process dnsapi.ini
 dnsapi_info = { }  # Key = DNS API name, Value = remainder of fields
+dnsapi_options = { }  # Key = DNS API name, Value = dict of genkeys.py options for the API
 dnsapi_data = process_ini_file( dns_api_defs_filename )
 if dnsapi_data is None:
     logging.critical( "No DNS API definitions found in %s", dns_api_defs_filename )
     sys.exit( 1 )
 else:
     for item in dnsapi_data:
-        dnsapi_info[item[0]] = item[1:len( item )]
+        dnsapi_info[item[0]], dnsapi_options[item[0]] = dnsregistry.split_options( item[1:len( item )] )
 # Insure we have the null API
 if dnsapi_info['null'] is None:
     dnsapi_info['null'] = []
@@ -143,13 +122,6 @@ for item in domain_data:
     if item[1] not in key_names:
         key_names.append( item[1] )
 
-# Check for our DNS API modules. If we don't have any, there's no sense in
-# trying to go further.
-dnsapis = find_dnsapi_modules( dnsapi_info.keys() )  # Key = DNS API name, Value = module
-if len( dnsapis ) == 0:
-    logging.error( "No DNS API modules found" )
-    sys.exit( 1 )
-
 dnsapi_domain_data = None
 dnsapi_name = 'null'
 for item in domain_data:
@@ -161,16 +133,27 @@ if dnsapi_domain_data is None:
     logging.error( "Domain %s data not found", args.domain )
     sys.exit( 1 )
 
-if dnsapi_name not in dnsapis:
-    logging.error( "DNS API module %s not found", dnsapi_name )
+# Only the module for the domain's API is loaded
+if dnsapi_name not in dnsapi_info:
+    logging.error( "DNS API %s not found in %s", dnsapi_name, dns_api_defs_filename )
+    sys.exit( 1 )
+dnsapi_module = dnsregistry.load( dnsapi_name )
+if dnsapi_module is None:
     sys.exit( 1 )
-dnsapi_module = dnsapis[dnsapi_name]
 dnsapi_data = dnsapi_info[dnsapi_name]
+# The delete goes through a client so it's paced and retried the same way genkeys.py's are
+if set( dnsapi_options[dnsapi_name] ).intersection( ['rate', 'burst', 'retries'] ):
+    import ratelimit
+    ratelimit.configure( dnsapi_name, dnsapi_options[dnsapi_name] )
+dnsapi_client = dnsregistry.open_client( dnsapi_module, dnsapi_name, dnsapi_data )
+if dnsapi_client is None:
+    sys.exit( 1 )
 
 record = [ args.domain, args.selector, None ]
 record.extend( args.data )
 
-result = dnsapi_module.delete( dnsapi_data, dnsapi_domain_data, record, False )
+result = dnsapi_client.delete( dnsapi_domain_data, record, False )
+dnsapi_client.close()
 if result is None:
     logging.info( "No support for removing old record for %s:%s via %s API",
                   record[0], record[1], dnsapi_name )